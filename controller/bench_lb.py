@@ -0,0 +1,257 @@
+from __future__ import division
+
+import sys, time, itertools, contextlib, os, tempfile
+from multiprocessing import Process, Queue, cpu_count
+
+import numpy as np
+from scipy import stats as sc_stats
+
+from ryu.controller import ofp_event
+from ryu.ofproto import ofproto_v1_3, ofproto_v1_3_parser
+from ryu.lib.packet import packet, ethernet, ipv4, arp, udp
+from ryu.lib.packet import ether_types
+import netaddr
+
+from ryu_lb import Ryu_LB, parse_packet_in
+
+'''
+Offline benchmarks of Ryu_LB, no Mininet/OVS needed.
+- parse  : packet-in decoding, compare the old path (ryu Packet object,
+           get_protocols for every protocol and netaddr conversion for
+           hashing) with the struct based fast path (parse_packet_in).
+- replay : drive Ryu_LB._packet_in_handler with synthetic ARP/IPv4
+           packet-ins on a fake leaf-spine fabric and compare lb methods.
+- shards : same replay split over sharded Ryu_LB workers, one process
+           each, every worker handle packet-ins of switches it is master of.
+usage: python bench_lb.py parse [packets]
+       python bench_lb.py replay [spines] [leaves] [hosts_per_leaf] [packets] [methods,...] [lldp]
+       python bench_lb.py shards [workers] [spines] [leaves] [hosts_per_leaf] [packets] [method]
+lldp feed fabric links to the topology model, as LLDP discovery would.
+'''
+
+class FakeWSGI(object):
+   def register(self, *args, **kwargs):
+      pass
+
+class FakeDatapath(object):
+   """ Datapath that serialize and record every message sent by controller """
+   def __init__(self, dpid, ports):
+      self.id = dpid
+      self.ofproto = ofproto_v1_3
+      self.ofproto_parser = ofproto_v1_3_parser
+      self.ports = dict((port, None) for port in ports)
+      self.xid = 0
+      self.sent = []
+
+   def set_xid(self, msg):
+      self.xid += 1
+      msg.set_xid(self.xid)
+      return self.xid
+
+   def send_msg(self, msg):
+      if msg.xid is None:
+         self.set_xid(msg)
+      msg.serialize()
+      self.sent.append(msg)
+
+@contextlib.contextmanager
+def quiet():
+   """ Ryu_LB print topology on every switch join """
+   stdout = sys.stdout
+   sys.stdout = open(os.devnull, 'w')
+   try:
+      yield
+   finally:
+      sys.stdout.close()
+      sys.stdout = stdout
+
+def build_fabric(lb_method, spine_num, leaf_num, host_per_leaf, lldp=False):
+   """ Ryu_LB with same dpid/port layout as LeafSpine in mininet/ta_topo.py """
+   app = Ryu_LB(wsgi=FakeWSGI())
+   app.set_lb_method(lb_method)
+   datapaths = {}
+   with quiet():
+      for x in range(1, spine_num+1):
+         datapaths[100+x] = FakeDatapath(100+x, range(1, leaf_num+2))
+         app._add_switch(datapaths[100+x])
+      # Leaf 0 is l2_sw with the 2 servers
+      for x in range(0, leaf_num+1):
+         hosts = 2 if x == 0 else host_per_leaf
+         datapaths[200+x] = FakeDatapath(200+x, range(1, spine_num+hosts+1))
+         app._add_switch(datapaths[200+x])
+      if lldp:
+         # Spine 100+x port leaf+1 <-> leaf 200+leaf port x, both directions
+         for x in range(1, spine_num+1):
+            for leaf in range(0, leaf_num+1):
+               app.topology.add_link(100+x, leaf+1, 200+leaf)
+               app.topology.add_link(200+leaf, x, 100+x)
+         # Model settle when a second quiet check find the same tiers
+         app._apply_topology()
+         app._apply_topology()
+   return app, datapaths
+
+def build_packet_ins(datapaths, leaf_num, host_per_leaf, num):
+   """
+   Packet-in at source leaf of `num` src/dst pairs (ARP then IPv4 for every
+   pair), every host talk to the servers and to hosts of other leaves.
+   """
+   hosts = [(x, y) for x in range(1, leaf_num+1) for y in range(1, host_per_leaf+1)]
+   dsts = [(0, 1), (0, 2)] + hosts
+   pairs = itertools.cycle([(src, dst) for dst in dsts for src in hosts if src[0] != dst[0]])
+   events = []
+   parser = ofproto_v1_3_parser
+   while len(events) < num:
+      src, dst = next(pairs)
+      ip_src = '10.0.%s.%s' % src
+      ip_dst = '10.0.%s.%s' % dst
+      datapath = datapaths[200+src[0]]
+      for proto in ('arp', 'ip'):
+         pkt = packet.Packet()
+         if proto == 'arp':
+            pkt.add_protocol(ethernet.ethernet(ethertype=ether_types.ETH_TYPE_ARP))
+            pkt.add_protocol(arp.arp_ip(arp.ARP_REQUEST, '00:00:00:00:00:01', ip_src, '00:00:00:00:00:00', ip_dst))
+         else:
+            pkt.add_protocol(ethernet.ethernet(ethertype=ether_types.ETH_TYPE_IP))
+            pkt.add_protocol(ipv4.ipv4(src=ip_src, dst=ip_dst, proto=17))
+            pkt.add_protocol(udp.udp(src_port=5001, dst_port=5001))
+         pkt.serialize()
+         in_port = len([p for p in datapath.ports]) - host_per_leaf + src[1]
+         msg = parser.OFPPacketIn(datapath, buffer_id=datapath.ofproto.OFP_NO_BUFFER,
+                                  match=parser.OFPMatch(in_port=in_port), data=str(pkt.data))
+         events.append(ofp_event.EventOFPPacketIn(msg))
+   return events[:num]
+
+def replay(lb_method, spine_num, leaf_num, host_per_leaf, num, lldp=False):
+   """
+   example output :
+   {
+      "decisions_per_sec" : ...,
+      "flow_mods" : ...,
+      "packet_outs" : ...,
+      "gateways" : [flows per spine uplink],
+      "sem" : sem/mean of flows per spine
+   }
+   """
+   app, datapaths = build_fabric(lb_method, spine_num, leaf_num, host_per_leaf, lldp)
+   events = [ev for ev in build_packet_ins(datapaths, leaf_num, host_per_leaf, num) if app.owns(ev.msg.datapath.id)]
+   for datapath in datapaths.values():
+      del datapath.sent[:]
+   time1 = time.time()
+   for ev in events:
+      app._packet_in_handler(ev)
+   elapsed = time.time()-time1
+   sent = [msg for datapath in datapaths.values() for msg in datapath.sent]
+   flow_mods = [msg for msg in sent if isinstance(msg, ofproto_v1_3_parser.OFPFlowMod)]
+   gateways = np.zeros(spine_num)
+   for msg in flow_mods:
+      # Host flow of IPv4 at source leaf, its output port is the spine uplink
+      fields = dict(msg.match.items())
+      if 'ipv4_src' in fields:
+         gateways[msg.instructions[0].actions[0].port-1] += 1
+   return {
+      'decisions_per_sec': len(events)/elapsed,
+      'flow_mods': len(flow_mods),
+      'packet_outs': len([msg for msg in sent if isinstance(msg, ofproto_v1_3_parser.OFPPacketOut)]),
+      'gateways': list(gateways),
+      'sem': sc_stats.sem(gateways)/np.mean(gateways) if gateways.sum() > 0 else float('nan')
+   }
+
+def replay_shard(queue, shard, shards, store, lb_method, spine_num, leaf_num, host_per_leaf, num):
+   """ Worker process, Ryu_LB read its shard from environment as under run_ryu_rest """
+   os.environ.update({ 'LB_SHARD': str(shard), 'LB_SHARDS': str(shards), 'LB_STORE': store })
+   queue.put((shard, replay(lb_method, spine_num, leaf_num, host_per_leaf, num)))
+
+def replay_shards(shards, lb_method, spine_num, leaf_num, host_per_leaf, num):
+   """ Return { shard : replay result }, workers run concurrently """
+   store = tempfile.mktemp(suffix='.sqlite')
+   queue = Queue()
+   procs = [Process(target=replay_shard, args=(queue, shard, shards, store, lb_method, spine_num, leaf_num, host_per_leaf, num))
+            for shard in range(shards)]
+   for proc in procs:
+      proc.start()
+   results = dict(queue.get() for _ in procs)
+   for proc in procs:
+      proc.join()
+   if os.path.exists(store):
+      os.remove(store)
+   return results
+
+def build_frames(num):
+   frames = []
+   for i in range(num):
+      src = '10.0.%s.%s' % (i % 12 + 1, i % 2 + 1)
+      dst = '10.0.0.%s' % (i % 2 + 1)
+      pkt = packet.Packet()
+      pkt.add_protocol(ethernet.ethernet(ethertype=ether_types.ETH_TYPE_ARP if i % 2 else ether_types.ETH_TYPE_IP))
+      if i % 2:
+         pkt.add_protocol(arp.arp_ip(arp.ARP_REQUEST, '00:00:00:00:00:01', src, '00:00:00:00:00:00', dst))
+      else:
+         pkt.add_protocol(ipv4.ipv4(src=src, dst=dst, proto=17))
+         pkt.add_protocol(udp.udp(src_port=5001, dst_port=5001))
+         pkt.add_protocol('x' * 64)
+      pkt.serialize()
+      frames.append(str(pkt.data))
+   return frames
+
+def legacy_parse(data):
+   """ Decode as _packet_in_handler did before the fast path """
+   pkt = packet.Packet(data)
+   eth_pkt = pkt.get_protocols(ethernet.ethernet)[0]
+   if eth_pkt.ethertype == ether_types.ETH_TYPE_LLDP:
+      return None
+   if len(pkt.get_protocols(ipv4.ipv4))>0 :
+      ip4_pkt = pkt.get_protocols(ipv4.ipv4)[0]
+      ip_src = ip4_pkt.src
+      ip_dst = ip4_pkt.dst
+   if len(pkt.get_protocols(arp.arp))>0:
+      arp_pkt = pkt.get_protocols(arp.arp)[0]
+      ip_src = arp_pkt.src_ip
+      ip_dst = arp_pkt.dst_ip
+   ip_src.split('.')
+   ip_dst.split('.')
+   return (eth_pkt.ethertype, int(hex(netaddr.IPAddress(ip_src)), 16), int(hex(netaddr.IPAddress(ip_dst)), 16))
+
+def bench_parse(parse, frames, repeat=3):
+   """ Best packets per second of `repeat` runs """
+   best = 0
+   for _ in range(repeat):
+      time1 = time.time()
+      for data in frames:
+         parse(data)
+      best = max(best, len(frames)/(time.time()-time1))
+   return best
+
+if __name__ == '__main__':
+   mode = sys.argv[1] if len(sys.argv) > 1 else 'parse'
+   if mode == 'parse':
+      num = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+      frames = build_frames(num)
+      assert [legacy_parse(data) for data in frames[:100]] == [parse_packet_in(data) for data in frames[:100]]
+      before = bench_parse(legacy_parse, frames)
+      after = bench_parse(parse_packet_in, frames)
+      print '*** Packet-in decoding, %s frames (ARP + IPv4) ***' % (num)
+      print 'legacy (ryu Packet) : %12.0f pkt/s' % (before)
+      print 'fast path (struct)  : %12.0f pkt/s' % (after)
+      print 'speedup             : %12.1fx' % (after/before)
+   elif mode == 'shards':
+      workers, spine_num, leaf_num, host_per_leaf, num = [int(x) for x in (sys.argv[2:7] + ['2', '4', '4', '2', '10000'][len(sys.argv[2:7]):])]
+      lb_method = sys.argv[7] if len(sys.argv) > 7 else 'rr'
+      print '*** Replay %s packet-ins over %s workers (%s cores), %s spines, %s leaves, %s hosts/leaf, %s ***' % (
+         num, workers, cpu_count(), spine_num, leaf_num, host_per_leaf, lb_method)
+      results = replay_shards(workers, lb_method, spine_num, leaf_num, host_per_leaf, num)
+      print '%-8s %14s %10s' % ('worker', 'decisions/s', 'flow_mods')
+      for shard in sorted(results):
+         print '%-8s %14.0f %10d' % (shard, results[shard]['decisions_per_sec'], results[shard]['flow_mods'])
+      print '%-8s %14.0f %10d' % ('total', sum(result['decisions_per_sec'] for result in results.values()),
+                                  sum(result['flow_mods'] for result in results.values()))
+   else:
+      spine_num, leaf_num, host_per_leaf, num = [int(x) for x in (sys.argv[2:6] + ['4', '4', '2', '10000'][len(sys.argv[2:6]):])]
+      methods = sys.argv[6].split(',') if len(sys.argv) > 6 else ['rr', 'iphash', 'least', 'p2c']
+      lldp = len(sys.argv) > 7 and sys.argv[7] == 'lldp'
+      print '*** Replay %s packet-ins, %s spines, %s leaves, %s hosts/leaf, %s ***' % (
+         num, spine_num, leaf_num, host_per_leaf, 'lldp topology' if lldp else 'addressing scheme')
+      print '%-8s %14s %10s %10s %10s  %s' % ('method', 'decisions/s', 'flow_mods', 'pkt_outs', 'sem', 'flows per spine')
+      for lb_method in methods:
+         result = replay(lb_method, spine_num, leaf_num, host_per_leaf, num, lldp)
+         print '%-8s %14.0f %10d %10d %10.4f  %s' % (lb_method, result['decisions_per_sec'], result['flow_mods'],
+                                                  result['packet_outs'], result['sem'], [int(x) for x in result['gateways']])
@@ -0,0 +1,91 @@
+from __future__ import division
+
+import sys, time, argparse, resource
+from multiprocessing import Process, Queue
+
+import numpy as np
+import pandas as pd
+
+from main import MainMachineLearning, SOLVERS
+from reward import OBJECTIVES
+
+'''
+Scalability benchmark of the optimizer, no Mininet needed. Synthetic flows
+with skewed (zipf / lognormal) loads are balanced by every solver for every
+spine and flow count, train time, reward quality and peak memory are
+written to CSV.
+usage: python bench_ml.py [--spines 2,4,8] [--flows 100,1000] [--solvers egreedy,greedy] [--objective sem] [--out file.csv]
+'''
+
+def build_flows(flows_num, spines_num, dist, seed):
+   """ example output :
+   [ip_src, ip_dst, gw, size], gw is random current gateway
+   """
+   rng = np.random.RandomState(seed)
+   if dist == 'zipf':
+      # Load of flow with rank r is proportional to 1/r
+      loads = 1e6 / np.arange(1, flows_num+1)
+      rng.shuffle(loads)
+   else:
+      loads = rng.lognormal(mean=10, sigma=1.5, size=flows_num)
+   gws = rng.randint(1, spines_num+1, size=flows_num)
+   return [('10.%s.%s.%s' % (i // 65536 % 256, i // 256 % 256, i % 256), '10.0.0.1', str(gws[i]), loads[i])
+           for i in range(flows_num)]
+
+def run_case(queue, spines_num, flows_num, solver, dist, episodes, epsilon, seed, objective):
+   """ Run in its own process, so ru_maxrss is the peak of this case only """
+   flows = build_flows(flows_num, spines_num, dist, seed)
+   ml = MainMachineLearning(range(101, 101+spines_num), flows, objective=objective)
+   time1 = time.time()
+   route_plan, train_time, reward, gw_loads, sem = SOLVERS[solver](ml, episodes, epsilon, 100, seed)
+   wall_time = time.time()-time1
+   queue.put({
+      'dist': dist,
+      'spines': spines_num,
+      'flows': flows_num,
+      'solver': solver,
+      'objective': objective,
+      'episodes': episodes,
+      'train_time': train_time,
+      'wall_time': wall_time,
+      'flows_per_sec': flows_num/max(train_time, 1e-9),
+      'reward': reward,
+      'sem': sem,
+      'max_min_ratio': np.max(gw_loads)/max(np.min(gw_loads), 1e-9),
+      'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+   })
+
+def run_bench(spines, flows, solvers, dist, episodes, epsilon, seed, objective='sem'):
+   results = []
+   for spines_num in spines:
+      for flows_num in flows:
+         for solver in solvers:
+            queue = Queue()
+            proc = Process(target=run_case, args=(queue, spines_num, flows_num, solver, dist, episodes, epsilon, seed, objective))
+            proc.start()
+            result = queue.get()
+            proc.join()
+            print '%-8s spines=%-3s flows=%-7s train_time=%9.4fs reward=%.6f sem=%.6f peak=%7.1fMB' % (
+               solver, spines_num, flows_num, result['train_time'], result['reward'], result['sem'], result['peak_rss_mb'])
+            sys.stdout.flush()
+            results.append(result)
+   return results
+
+def int_list(value):
+   return [int(x) for x in value.split(',')]
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description='Optimizer scalability benchmark')
+   parser.add_argument('--spines', type=int_list, default=[2, 4, 8, 16, 32, 64])
+   parser.add_argument('--flows', type=int_list, default=[100, 1000, 10000, 100000])
+   parser.add_argument('--solvers', default='egreedy,greedy,local')
+   parser.add_argument('--dist', choices=['zipf', 'lognormal'], default='lognormal')
+   parser.add_argument('--objective', choices=OBJECTIVES, default='sem')
+   parser.add_argument('--episodes', type=int, default=1000)
+   parser.add_argument('--epsilon', type=float, default=0.15)
+   parser.add_argument('--seed', type=int, default=1)
+   parser.add_argument('--out', default='bench_ml.csv')
+   args = parser.parse_args()
+   results = run_bench(args.spines, args.flows, args.solvers.split(','), args.dist, args.episodes, args.epsilon, args.seed, args.objective)
+   pd.DataFrame(results).to_csv(args.out, index=False)
+   print 'results written to', args.out
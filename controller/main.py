@@ -1,126 +1,806 @@
 from __future__ import division
 
-import pprint, json, sys, time, os, cmd, random, subprocess, logging
+import pprint, json, sys, time, os, cmd, random, subprocess, logging, heapq, threading, struct, socket, Queue, collections
 from operator import itemgetter
-from multiprocessing import Process
+from multiprocessing import Process, Pool, cpu_count
 
 import pandas as pd
 import numpy as np
 from scipy import stats as sc_stats
 
 import requests
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
 
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
+from werkzeug.datastructures import MultiDict
+
+from reward import RewardEngine, OBJECTIVES
 
 RYU_API = "http://localhost:8080"
+RYU_API_POOL = 16 # Concurrent connections (and threads) used to poll switches
+RYU_SHARDS = int(os.environ.get('LB_SHARDS', 1)) # Ryu_LB workers (LB_SHARDS env, as ryu_lb.py and mininet/ta_topo.py), worker i listen OpenFlow on port 6653+i and REST on 8080+i
+RYU_APIS = ["http://localhost:%s" % (8080+i) for i in range(RYU_SHARDS)]
+RYU_STORE = '/tmp/ryu_lb_store.sqlite' # LB state shared by Ryu_LB workers
+RATE_MODES = ['ewma', 'window', 'last', 'forecast'] # flow rates of TelemetrySampler.refresh
+
+def ryu_api(dpid):
+   """ REST API of Ryu_LB worker that is master of the switch (dpid % RYU_SHARDS, see Ryu_LB.owns) """
+   return RYU_APIS[dpid % len(RYU_APIS)]
+
+def lpt_assign(loads, order, gw_loads, actions, scale=None):
+   """
+   Longest processing time greedy, flows in `order` are assigned one by one
+   to least loaded gateway (load/scale, scale is gateway capacity for
+   utilization objectives). `gw_loads` and `actions` are updated in place.
+   """
+   if scale is None:
+      scale = np.ones(len(gw_loads))
+   heap = [(gw_loads[gw]/scale[gw], gw) for gw in range(len(gw_loads))]
+   heapq.heapify(heap)
+   for i in order:
+      load, gw = heapq.heappop(heap)
+      actions[i] = gw
+      gw_loads[gw] += loads[i]
+      heapq.heappush(heap, (gw_loads[gw]/scale[gw], gw))
+   return actions
+
+def gateway_members(loads, actions, free, spines_num):
+   """ Free flows of every gateway sorted by load (list of id arrays) """
+   idx = np.flatnonzero(free)
+   order = idx[np.lexsort((loads[idx], actions[idx]))]
+   counts = np.bincount(actions[order], minlength=spines_num)
+   return np.split(order, np.cumsum(counts)[:-1])
+
+def move_member(members, loads, flow, gw_from, gw_to):
+   """ Flow moved from gw_from to gw_to, keep gateway_members sorted """
+   members[gw_from] = members[gw_from][members[gw_from] != flow]
+   members[gw_to] = np.insert(members[gw_to], np.searchsorted(loads[members[gw_to]], loads[flow]), flow)
+
+def find_move(engine, members, gw_from, targets):
+   """
+   Best single move or swap from gw_from to one of `targets` gateways,
+   candidates are rewarded at once by RewardEngine.transfer_gain (delta_move
+   / delta_swap of every candidate, reward change minus move_cost for every
+   flow moved away from its current gateway). `members` are gateway_members.
+   Return (gain, x, flow_from, flow_to, moved, gw_to), flow_to is -1 for
+   single move, or None if no move has positive gain.
+   """
+   idx_from = members[gw_from]
+   if len(idx_from) == 0:
+      return None
+   loads = engine.loads
+   n = len(idx_from)
+   # Single move to every target
+   flows_from = [np.tile(idx_from, len(targets))]
+   flows_to = [np.full(len(flows_from[0]), -1, dtype=int)]
+   gws_to = [np.repeat(targets, n)]
+   sizes = np.array([len(members[gw_to]) for gw_to in targets])
+   targets, sizes = targets[sizes > 0], sizes[sizes > 0]
+   if len(targets) > 0:
+      # Swap, for every flow in gw_from and target take flows of the target
+      # around x-target. Targets members are concatenated, every segment is
+      # offset by `span` so one searchsorted find positions in all of them
+      pool = np.concatenate([members[gw_to] for gw_to in targets])
+      ends = np.cumsum(sizes)
+      starts = ends - sizes
+      span = 2*np.max(loads[pool]) + 1
+      keys = np.repeat(np.arange(len(targets)), sizes)*span + loads[pool]
+      rep_from = np.tile(idx_from, len(targets))
+      rep_seg = np.repeat(np.arange(len(targets)), n)
+      wanted = loads[rep_from] - engine.target_transfer(gw_from, targets[rep_seg])
+      pos = np.searchsorted(keys, rep_seg*span + np.clip(wanted, 0, span/2))
+      pos = np.clip(pos, starts[rep_seg]+1, ends[rep_seg]) - 1
+      for shift in (0, 1):
+         swap_to = pool[np.minimum(pos+shift, ends[rep_seg]-1)]
+         flows_from.append(rep_from)
+         flows_to.append(swap_to)
+         gws_to.append(targets[rep_seg])
+   flows_from = np.concatenate(flows_from)
+   flows_to = np.concatenate(flows_to)
+   gws_to = np.concatenate(gws_to)
+   swap = flows_to >= 0
+   xs = loads[flows_from] - np.where(swap, loads[flows_to], 0)
+   moved = engine.moved_delta(flows_from, gw_from, gws_to)
+   moved[swap] += engine.moved_delta(flows_to[swap], gws_to[swap], gw_from)
+   gain = engine.transfer_gain(gw_from, gws_to, xs, moved)
+   k = np.argmax(gain)
+   if not gain[k] > 0:
+      return None
+   return (gain[k], xs[k], flows_from[k], flows_to[k], moved[k], gws_to[k])
+
+def local_search(engine, actions, free, max_passes, monitor=None):
+   """
+   Move/swap local search, every pass apply the best improving move from the
+   most loaded gateway that have one to any less loaded gateway. `engine`
+   must be reset to `actions`, its running sums are updated by every move.
+   Free flows of every gateway are kept sorted by load, targets are checked
+   least loaded first, in chunks of doubling size rewarded at once. Pairs
+   without improving move are not checked again until one of their
+   gateways changed.
+   monitor : called with progress (0-1) every 100 passes
+   """
+   members = gateway_members(engine.loads, actions, free, engine.spines_num)
+   failed = set()
+   for passes in xrange(max_passes):
+      if monitor is not None and passes % 100 == 0:
+         monitor(passes/max_passes)
+      levels = engine.levels()
+      by_load = np.argsort(levels)
+      move = None
+      for gw_from in by_load[::-1]:
+         targets = np.array([gw_to for gw_to in by_load
+                             if levels[gw_to] < levels[gw_from] and (gw_from, gw_to) not in failed], dtype=int)
+         # The least loaded targets usually have a move, check them first
+         # in chunks of doubling size
+         start = 0
+         while start < len(targets):
+            chunk = targets[start:2*start+1]
+            move = find_move(engine, members, gw_from, chunk)
+            if move is not None:
+               break
+            failed.update((gw_from, gw_to) for gw_to in chunk)
+            start = 2*start+1
+         if move is not None:
+            break
+      if move is None:
+         break
+      _, x, flow_from, flow_to, moved, gw_to = move
+      if flow_to >= 0:
+         engine.apply_swap(actions, flow_from, flow_to)
+         move_member(members, engine.loads, flow_to, gw_to, gw_from)
+      else:
+         engine.apply_move(actions, flow_from, gw_to)
+      move_member(members, engine.loads, flow_from, gw_from, gw_to)
+      failed = set(pair for pair in failed if gw_from not in pair and gw_to not in pair)
+   return actions
+
+def restart_worker(args):
+   """ One random restart: perturbed LPT order followed by local search """
+   engine, actions, gw_loads, free, max_passes, seed = args
+   rng = np.random.RandomState(seed)
+   loads = engine.loads
+   free_idx = np.flatnonzero(free)
+   noise = loads[free_idx] * rng.uniform(0.5, 1.5, len(free_idx))
+   order = free_idx[np.argsort(-noise, kind='mergesort')]
+   lpt_assign(loads, order, gw_loads, actions, engine.scale)
+   engine.reset(actions)
+   local_search(engine, actions, free, max_passes)
+   return actions
+
+def water_fill(levels, load):
+   """
+   Split `load` over gateways so the least loaded ones are raised to one
+   common level, return the part of every gateway.
+   example : levels [1, 3, 7], load 4 -> [3, 1, 0] (level 4)
+   """
+   ordered = np.sort(levels)
+   filled = np.cumsum(ordered)
+   for k in range(1, len(ordered)+1):
+      level = (load+filled[k-1])/k
+      if k == len(ordered) or level <= ordered[k]:
+         break
+   return np.maximum(level-levels, 0)
+
+def remap_ids(values, ids, fill, capacity=None):
+   """
+   State indexed by flow id (last axis) after FlowTable.compact, column of
+   old id ids[i] become column i, ids beyond `values` and free columns are
+   `fill`. capacity is the new columns count, default is the old one.
+   """
+   capacity = max(capacity or values.shape[-1], len(ids))
+   new = np.full(values.shape[:-1] + (capacity,), fill, dtype=values.dtype)
+   known = np.flatnonzero(ids < values.shape[-1])
+   new[..., known] = values[..., ids[known]]
+   return new
+
+def ip_to_int(ip):
+   return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+def int_to_ip(value):
+   return socket.inet_ntoa(struct.pack('!I', int(value)))
+
+class JobCancelled(Exception):
+   pass
+
+class FlowTable():
+   """
+   Array backed flow table shared by sampler, optimizer, stats and route
+   executor. IPs are interned as uint32 and a flow is the (ip_src, ip_dst,
+   leaf) key, its id is stable until the table is compacted so arrays of
+   different samples line up without joins. `active` mark flows of the
+   last update, `gateway` is installed gateway (spine port, 0 unknown).
+   """
+   def __init__(self, capacity=1024):
+      self.lock = threading.Lock()
+      self.ips = {} # ip string : uint32
+      self.index = {} # (ip_src, ip_dst, leaf) : flow id
+      self.size = 0
+      self.ip_src = np.zeros(capacity, dtype=np.uint32)
+      self.ip_dst = np.zeros(capacity, dtype=np.uint32)
+      self.leaf = np.zeros(capacity, dtype=np.int32)
+      self.gateway = np.zeros(capacity, dtype=np.int32)
+      self.load = np.zeros(capacity)
+      self.active = np.zeros(capacity, dtype=bool)
+
+   @classmethod
+   def from_flows(cls, flows):
+      table = cls(max(len(flows), 1))
+      table.load_flows(flows)
+      return table
+
+   def grow(self, size):
+      capacity = len(self.load)
+      if size <= capacity:
+         return
+      capacity = max(size, capacity*2)
+      for name in ('ip_src', 'ip_dst', 'leaf', 'gateway', 'load', 'active'):
+         old = getattr(self, name)
+         new = np.zeros(capacity, dtype=old.dtype)
+         new[:len(old)] = old
+         setattr(self, name, new)
+
+   def intern(self, ip):
+      """ uint32 of dotted ip, integers (Ryu_LB /lb/stats) are already interned """
+      if isinstance(ip, (int, long)):
+         return ip
+      value = self.ips.get(ip)
+      if value is None:
+         value = self.ips[ip] = ip_to_int(ip)
+      return value
+
+   def flow_ids(self, flows, leaf=None):
+      """
+      Ids of [ip_src, ip_dst, gw, size] flows, unknown flows are appended.
+      leaf is the dpid the flows were read from, default is the leaf of
+      ip_src (10.0.<leaf>.<host>).
+      """
+      ids = np.empty(len(flows), dtype=int)
+      with self.lock:
+         for i in range(len(flows)):
+            ip_src = self.intern(flows[i][0])
+            ip_dst = self.intern(flows[i][1])
+            key = (ip_src, ip_dst, leaf if leaf is not None else 200 + (ip_src >> 8 & 0xff))
+            fid = self.index.get(key)
+            if fid is None:
+               fid = self.index[key] = self.size
+               self.grow(fid+1)
+               self.ip_src[fid] = ip_src
+               self.ip_dst[fid] = ip_dst
+               self.leaf[fid] = key[2]
+               self.size += 1
+            ids[i] = fid
+      return ids
+
+   def update(self, ids, load, gateway=None):
+      """ Flows `ids` become the active flows with their load (and installed gateway) """
+      with self.lock:
+         self.active[:] = False
+         self.active[ids] = True
+         self.load[ids] = load
+         if gateway is not None:
+            self.gateway[ids] = gateway
+
+   def snapshot(self):
+      """ (ids, load, gateway) copies of active flows, consistent with concurrent update """
+      with self.lock:
+         ids = np.flatnonzero(self.active[:self.size])
+         return ids, self.load[ids], self.gateway[ids]
+
+   def load_flows(self, flows):
+      """ Update from list of [ip_src, ip_dst, gw, size], return ids """
+      ids = self.flow_ids(flows)
+      self.update(ids, [flow[3] for flow in flows], [int(flow[2]) for flow in flows])
+      return ids
+
+   def active_ids(self):
+      return np.flatnonzero(self.active[:self.size])
+
+   def compact(self, keep=None, min_inactive=0.5):
+      """
+      Reclaim ids of flows that are not active (nor in `keep` mask) when
+      they are more than `min_inactive` of the table. Kept flows get ids
+      0..n-1 in their old order. Return old ids of kept flows (new id is
+      their position, see remap_ids) or None when table is not compacted.
+      """
+      with self.lock:
+         alive = self.active[:self.size].copy()
+         if keep is not None:
+            alive[np.flatnonzero(keep[:self.size])] = True
+         ids = np.flatnonzero(alive)
+         if self.size == 0 or self.size-len(ids) <= min_inactive*self.size:
+            return None
+         for name in ('ip_src', 'ip_dst', 'leaf', 'gateway', 'load', 'active'):
+            setattr(self, name, remap_ids(getattr(self, name), ids, 0, len(self.load)))
+         self.size = len(ids)
+         self.index = dict(((int(ip_src), int(ip_dst), int(leaf)), fid) for fid, (ip_src, ip_dst, leaf)
+                           in enumerate(zip(self.ip_src[:self.size], self.ip_dst[:self.size], self.leaf[:self.size])))
+         used = set(self.ip_src[:self.size]) | set(self.ip_dst[:self.size])
+         self.ips = dict((ip, value) for ip, value in self.ips.items() if value in used)
+         return ids
+
+class RoutePlan():
+   """
+   New gateway of flows `ids` of a FlowTable, iterate as the
+   (ip_src, ip_dst, gw, load) tuples of the old list route plan.
+   """
+   def __init__(self, table, ids, gateway, load):
+      self.table = table
+      self.ids = ids
+      self.gateway = np.asarray(gateway, dtype=int)
+      self.load = load
+
+   def __len__(self):
+      return len(self.ids)
+
+   def __iter__(self):
+      for i in range(len(self.ids)):
+         yield self[i]
+
+   def __getitem__(self, i):
+      fid = self.ids[i]
+      return (int_to_ip(self.table.ip_src[fid]), int_to_ip(self.table.ip_dst[fid]), int(self.gateway[i]), float(self.load[i]))
+
+   def changed(self):
+      """ Mask of flows whose new gateway differ from installed one """
+      return self.gateway != self.table.gateway[self.ids]
 
 class MainMachineLearning():
-   def __init__(self, spine_sw, flows):
+   CHUNK_CELLS = 2**18 # episodes x flows sampled and rewarded at once by train
+
+   def __init__(self, spine_sw, flows, move_cost=0, current=None, objective='sem', capacity=None):
+      """
+      flows     : FlowTable (active flows are balanced) or list of
+                  [ip_src, ip_dst, gw, size]
+      move_cost : reward penalty for every flow that is moved from its
+                  current gateway
+      current   : current gateway index of every flow (-1 unknown), default
+                  is taken from installed gateway in flows
+      objective : reward objective and gateway capacity, see RewardEngine
+      """
       self.spines = spine_sw		
       self.spines_num = len(self.spines)
-      self.flows = flows
-      self.flows_num = len(self.flows)
-      self.loads_arr = [load[3] for load in self.flows]
+      if not isinstance(flows, FlowTable):
+         flows = FlowTable.from_flows(flows)
+      self.table = flows
+      self.ids, self.loads_arr, gateway = flows.snapshot()
+      self.flows_num = len(self.ids)
+      self.move_cost = move_cost
+      if current is None:
+         current = gateway-1
+      self.current = np.array(current, dtype=int).reshape(-1)
+      self.current[(self.current < 0) | (self.current >= self.spines_num)] = -1
+      self.engine = RewardEngine(self.loads_arr, self.spines_num, objective, capacity, move_cost, self.current)
+      self.monitor = None # progress callback (0-1), may raise JobCancelled to stop training
+
+   def report(self, progress):
+      if self.monitor is not None:
+         self.monitor(progress)
 
    def getReward(self, actions):
-      gateways_load = np.zeros(self.spines_num)
-      for i in xrange(0, len(actions)):
-         gateways_load[actions[i]] += self.loads_arr[i]
-      mean = np.mean(gateways_load)
-      sem = sc_stats.sem(gateways_load)
-      reward = (mean-sem)/mean
-      return (gateways_load, reward)
+      gateways_load, reward = self.getBatchReward(np.asarray(actions).reshape(1, -1))
+      return (gateways_load[0], reward[0])
+
+   def getBatchReward(self, actions):
+      """
+      actions : matrix (episodes x flows) of gateway index,
+      return gateways load matrix (episodes x spines) and reward of every episode
+      """
+      return self.engine.batch(actions)
+
+   def moved(self, actions):
+      """ Number of flows moved from current gateway in every episode """
+      return self.engine.count_moved(actions)
 
    def create_route_plan(self, actions):
-      new_flow = []
-      for i in range(len(self.flows)):
-           load = self.flows[i]
-           new_flow.append((load[0], load[1], actions[i]+1, load[3]))
-      return new_flow
-
-   def train(self, episodes, epsilon):
-      best_idx = 0
-      history = [] 
+      return RoutePlan(self.table, self.ids, np.asarray(actions)+1, self.loads_arr)
+
+   def sample_actions(self, draws, epsilon, best_actions, free=None):
+      # ----- Epsilon Greedy Algorithm -----
+      # Every flow of every episode get one random number from 0 to 1 (float),
+      # it will decide ML explore new actions or use best previous actions
+      # for each flow_id. Smaller exploration rate (epsilon), smaller probability
+      # ML to find new actions and more higher to use previous best actions.
+      # The explored action is taken from the same number (draws/epsilon is
+      # uniform too), so one draw per flow give the same result whatever
+      # the batch size is. Only `free` flows are explored when it is given.
+      if best_actions is None:
+         return np.minimum((draws * self.spines_num).astype(int), self.spines_num-1)
+      if epsilon <= 0:
+         return np.tile(best_actions, (draws.shape[0], 1))
+      explore = draws < epsilon
+      if free is not None:
+         explore &= free
+      random_actions = np.minimum((draws / epsilon * self.spines_num).astype(int), self.spines_num-1)
+      return np.where(explore, random_actions, best_actions)
+
+   def train(self, episodes, epsilon, batch_size=100, seed=None, init_actions=None, free=None):
+      """
+      Run `episodes` of epsilon greedy search, `batch_size` episodes are
+      sampled from the best actions at batch start and rewarded at once, the
+      best episode of the batch replace them if it improved the reward.
+      Draws don't depend on `batch_size`, batch_size=1 is the per-episode
+      path (every episode sampled from the best actions so far).
+
+      init_actions : start search from these actions instead of random one,
+                     flow with action -1 get random gateway
+      free         : boolean mask of flows that may be explored (need init_actions)
+      """
+      rng = np.random.RandomState(seed) if seed is not None else np.random
+      best_actions = None
+      best_reward = None
+      best_gw_loads = None
+      time1 = time.time()
+      if init_actions is not None:
+         best_actions = np.array(init_actions, dtype=int)
+         unknown = best_actions < 0
+         best_actions[unknown] = rng.randint(self.spines_num, size=np.count_nonzero(unknown))
+         best_gw_loads, best_reward = self.getReward(best_actions)
+      done = 0
+      while done < episodes:
+         batch = min(batch_size, episodes-done)
+         # The batch is sampled and rewarded in chunks of rows that fit in
+         # cache, draws and incumbent are the same so is the result
+         chunk = max(1, min(batch, self.CHUNK_CELLS // max(self.flows_num, 1)))
+         batch_actions = best_actions
+         for rows in [chunk]*(batch // chunk) + [batch % chunk]*(batch % chunk > 0):
+            draws = rng.random_sample((rows, self.flows_num))
+            actions = self.sample_actions(draws, epsilon, batch_actions, free)
+            gw_loads, rewards = self.getBatchReward(actions)
+            # First best episode, as the per-episode path keeps the first of equal rewards
+            idx = int(np.argmax(rewards))
+            if best_actions is None or rewards[idx] > best_reward:
+               best_actions = actions[idx]
+               best_reward = rewards[idx]
+               best_gw_loads = gw_loads[idx]
+         done += batch
+         self.report(done/episodes)
+      return self.result(best_actions, time1)
+
+   def fixed_actions(self, init_actions, free):
+      """ Start point of constructive solvers, flows outside `free` keep init action """
+      actions = np.full(self.flows_num, -1, dtype=int)
+      if free is None:
+         free = np.ones(self.flows_num, dtype=bool)
+      if init_actions is not None:
+         actions[~free] = np.asarray(init_actions)[~free]
+      gw_loads = np.bincount(actions[~free], weights=self.loads_arr[~free], minlength=self.spines_num).astype(float)
+      return actions, gw_loads, free
+
+   def train_greedy(self, episodes, epsilon, batch_size=100, seed=None, init_actions=None, free=None):
+      """ Sorted greedy (LPT), assign biggest free flow first to least loaded gateway """
       time1 = time.time()
-      for i in range(episodes):
-         actions = []
-         for j in xrange(0, self.flows_num):
-            # ----- Epsilon Greedy Algorithm -----
-            # Generate random number from 0 to 1 (float) will ML explore 
-            # new actions or use best previous actions for each flow_id. 
-            # Smaller exploration rate (epsilon), smaller probability ML 
-            # to find new actions and more higher to use previous best actions.
-            is_explore = np.random.rand(1) < epsilon
-            if is_explore or i==0:
-               actions.append(np.random.randint(self.spines_num))
-            else:
-               actions.append(history[best_idx][0][j])
-         gw_load, reward = self.getReward(actions)
-         if len(history) < 1:
-            best_idx = i
-         elif reward > history[best_idx][1]:
-            best_idx = i
-         history.append([actions, reward, gw_load])
-      best_history = history[best_idx]
-      best_actions_final = best_history[0]
-      best_reward_final = best_history[1]
-      best_gw_loads_final = best_history[2]
-      route_plan = self.create_route_plan(best_actions_final)
+      actions, gw_loads, free = self.fixed_actions(init_actions, free)
+      free_idx = np.flatnonzero(free)
+      order = free_idx[np.argsort(-self.loads_arr[free_idx], kind='mergesort')]
+      lpt_assign(self.loads_arr, order, gw_loads, actions, self.engine.scale)
+      return self.result(actions, time1)
+
+   def train_local(self, episodes, epsilon, batch_size=100, seed=None, init_actions=None, free=None):
+      """
+      Move/swap local search for at most max(episodes, flows) moves, start
+      from init_actions (unknown flows placed greedily) or from LPT.
+      """
+      time1 = time.time()
+      actions, gw_loads, free = self.fixed_actions(init_actions, free)
+      start = np.full(self.flows_num, -1, dtype=int) if init_actions is None else np.asarray(init_actions)
+      placed = free & (start >= 0)
+      actions[placed] = start[placed]
+      gw_loads += np.bincount(actions[placed], weights=self.loads_arr[placed], minlength=self.spines_num)
+      unplaced = np.flatnonzero(free & (start < 0))
+      order = unplaced[np.argsort(-self.loads_arr[unplaced], kind='mergesort')]
+      lpt_assign(self.loads_arr, order, gw_loads, actions, self.engine.scale)
+      self.engine.reset(actions)
+      local_search(self.engine, actions, free, max(episodes, self.flows_num), self.report)
+      return self.result(actions, time1)
+
+   def train_restart(self, episodes, epsilon, batch_size=100, seed=None, init_actions=None, free=None, processes=None):
+      """
+      Parallel random restart, every restart run perturbed LPT and local search
+      (at most max(episodes, flows) moves) in a process pool, best actions are kept.
+      """
+      time1 = time.time()
+      actions, gw_loads, free = self.fixed_actions(init_actions, free)
+      processes = processes or cpu_count()
+      base_seed = seed if seed is not None else np.random.randint(2**31-processes*4)
+      jobs = [(self.engine, actions.copy(), gw_loads.copy(), free, max(episodes, self.flows_num), base_seed+i)
+              for i in range(processes*4)]
+      pool = Pool(processes)
+      candidates = []
+      try:
+         for candidate in pool.imap(restart_worker, jobs):
+            candidates.append(candidate)
+            self.report(len(candidates)/len(jobs))
+      finally:
+         # All restarts are done, or training was cancelled
+         pool.terminate()
+         pool.join()
+      _, rewards = self.getBatchReward(np.array(candidates))
+      return self.result(candidates[int(np.nanargmax(rewards))], time1)
+
+   def result(self, best_actions, time1):
+      best_gw_loads, best_reward = self.getReward(best_actions)
+      route_plan = self.create_route_plan(best_actions)
       training_time = time.time()-time1
-      predicted_sem = sc_stats.sem(best_gw_loads_final)/np.mean(best_gw_loads_final)
-      return route_plan, training_time, best_reward_final, best_gw_loads_final, predicted_sem
+      predicted_sem = sc_stats.sem(best_gw_loads)/np.mean(best_gw_loads)
+      return route_plan, training_time, best_reward, best_gw_loads, predicted_sem
+
+# Solvers of /optimize. Train time of one solve on lognormal flows (bench_ml.py):
+#   spines  flows   greedy  local  restart (4 restarts per cpu)
+#   8       10000   0.03s   0.06s  0.3s
+#   64      10000   0.03s   0.8s   3.5s
+#   64      100000  0.3s    3.4s   16s
+# local and restart cost grow with spines*flows, above ~64 spines or ~100k
+# flows prefer greedy (egreedy only for small tables, its batches sample
+# every flow for every episode).
+SOLVERS = {
+   'egreedy': MainMachineLearning.train,
+   'greedy': MainMachineLearning.train_greedy,
+   'local': MainMachineLearning.train_local,
+   'restart': MainMachineLearning.train_restart
+}
+
+class OnlineOptimizer():
+   """
+   Long-lived optimizer, keep best actions and flow loads of previous run.
+   Next run start from previous best actions and only explore flows that
+   are new or whose load changed more than `threshold` (relative).
+   Every flow moved away from its installed gateway cost `move_cost` reward.
+   `objective` and `capacity` select the reward, see RewardEngine.
+   SETTINGS are defaults, one run can override them (see optimize).
+   """
+   SETTINGS = ('threshold', 'move_cost', 'objective', 'capacity', 'episodes', 'warm_episodes')
+
+   def __init__(self, threshold=0.1, episodes=1000, warm_episodes=200, move_cost=0, objective='sem', capacity=None):
+      self.threshold = threshold
+      self.move_cost = move_cost
+      self.objective = objective
+      self.capacity = capacity
+      self.episodes = episodes
+      self.warm_episodes = warm_episodes
+      self.reset()
+
+   def reset(self):
+      self.spines = None
+      self.table = None
+      self.actions = np.zeros(0, dtype=int) # flow id : gateway index, -1 unknown
+      self.loads = np.zeros(0) # flow id : load used by previous run
+      self.free_num = 0
+
+   def remap(self, ids):
+      """ Flow table was compacted, see FlowTable.compact """
+      self.actions = remap_ids(self.actions, ids, -1, len(ids))
+      self.loads = remap_ids(self.loads, ids, 0, len(ids))
+
+   def init_actions(self, ml, threshold):
+      # New flow start from gateway that already installed in switch
+      init_actions = ml.current.copy()
+      free = np.ones(ml.flows_num, dtype=bool)
+      prev_actions = np.full(ml.flows_num, -1, dtype=int)
+      old = ml.ids < len(self.actions)
+      prev_actions[old] = self.actions[ml.ids[old]]
+      known = prev_actions >= 0
+      init_actions[known] = prev_actions[known]
+      prev_load = self.loads[ml.ids[known]]
+      free[known] = np.abs(ml.loads_arr[known]-prev_load) > threshold*prev_load
+      return init_actions, free
+
+   def optimize(self, spine_sw, flows, epsilon, batch_size=100, seed=None, solver='egreedy', monitor=None, settings=None):
+      """
+      flows    : FlowTable, state is kept by flow id so it must be the same table every run
+      monitor  : training progress callback, see MainMachineLearning.monitor
+      settings : { SETTINGS name : value } of this run only, None values keep the default
+      """
+      opts = dict((name, getattr(self, name)) for name in self.SETTINGS)
+      opts.update((name, value) for name, value in (settings or {}).items() if value is not None)
+      if not isinstance(flows, FlowTable):
+         table = self.table if self.table is not None else FlowTable()
+         table.load_flows(flows)
+         flows = table
+      if self.spines != list(spine_sw) or self.table is not flows:
+         self.reset()
+         self.spines = list(spine_sw)
+         self.table = flows
+      ml = MainMachineLearning(spine_sw, flows, opts['move_cost'], objective=opts['objective'], capacity=opts['capacity'])
+      ml.monitor = monitor
+      train = SOLVERS[solver]
+      init_actions, free = self.init_actions(ml, opts['threshold'])
+      if np.any(self.actions >= 0):
+         episodes = opts['warm_episodes'] if free.any() else 0
+         result = train(ml, episodes, epsilon, batch_size, seed, init_actions, free)
+      else:
+         result = train(ml, opts['episodes'], epsilon, batch_size, seed, init_actions)
+      self.free_num = int(np.count_nonzero(free))
+      # Rebuild state from current flows, so removed flows are forgotten
+      route_plan = result[0]
+      self.actions = np.full(flows.size, -1, dtype=int)
+      self.actions[route_plan.ids] = route_plan.gateway-1
+      self.loads = np.zeros(flows.size)
+      self.loads[route_plan.ids] = route_plan.load
+      return result
+
+def flow_deltas(table, sample1, sample2):
+   """
+   Join two leaves samples ({ leaf: (timestamp, [[ip_src, ip_dst, gw, bytes]]) })
+   through (ip_src, ip_dst, leaf) flow ids of `table`, return (ids, gw, rate)
+   arrays of flows in second sample. Flow that expired before second sample
+   is dropped, flow that appeared or had its counter reset (reinstalled)
+   count its bytes since then.
+   """
+   ids1 = [np.zeros(0, dtype=int)]
+   bytes1 = [np.zeros(0)]
+   for leaf, (timestamp, flows) in sample1.items():
+      ids1.append(table.flow_ids(flows, leaf))
+      bytes1.append(np.array([flow[3] for flow in flows], dtype=float))
+   ids2 = [np.zeros(0, dtype=int)]
+   gws = [np.zeros(0, dtype=int)]
+   bytes2 = [np.zeros(0)]
+   elapsed = [np.zeros(0)]
+   for leaf, (timestamp, flows) in sample2.items():
+      if leaf not in sample1:
+         continue
+      ids2.append(table.flow_ids(flows, leaf))
+      gws.append(np.array([int(flow[2]) for flow in flows], dtype=int))
+      bytes2.append(np.array([flow[3] for flow in flows], dtype=float))
+      elapsed.append(np.full(len(flows), timestamp-sample1[leaf][0]))
+   prev = np.zeros(table.size)
+   prev[np.concatenate(ids1)] = np.concatenate(bytes1)
+   ids = np.concatenate(ids2)
+   counters = np.concatenate(bytes2)
+   delta = counters - prev[ids]
+   delta = np.where(delta < 0, counters, delta)
+   return ids, np.concatenate(gws), delta/np.concatenate(elapsed)
 
 class TopologyHelper():
    def __init__(self):
       self.SPINE_SW = []
       self.LEAF_SW = []
-      self.LOADS = []
+      self.UPLINKS = {} # leaf : { uplink port : gateway }, gateway g is uplink toward SPINE_SW[g-1]
+      self.table = FlowTable() # Flows of last stats, gateway is the installed one
+      self.lock = threading.RLock() # Flow ids read from table are valid until compact_flows
+      self.RECONFIG = {} # Ryu_LB report of last route plan installation
+      self.interval = 1
+      self.session = requests.Session()
+      self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=RYU_API_POOL))
+      self.pool = None
+      self.sampler = None # TelemetrySampler, answer stats from memory when running
+      self.rate_mode = 'ewma'
+      self.measure = 'flows' # flows : sum of leaves flow entries, ports : spines port counters
+      self.source = 'ofctl' # ofctl : poll switches through ofctl_rest, native : stats polled by Ryu_LB
+
+   def get_pool(self):
+      # Created on first use, threads don't survive the fork of run_parallel
+      if self.pool is None:
+         self.pool = ThreadPool(RYU_API_POOL)
+      return self.pool
 
    def get_switches(self):
-      req = requests.get(RYU_API+'/stats/switches')
-      switches = req.json()
-      spine = [x for x in switches if x//100==1] # All spine sw have id 100-199
-      leaf = [x for x in switches if x//200==1] # All leaf sw have id 200-299 (include l2_switch)
-      self.SPINE_SW = sorted(spine)
-      self.LEAF_SW = sorted(leaf)
+      """
+      Spines and leaves of Ryu_LB topology model (tiers from LLDP links,
+      dpid ranges 1xx/2xx until links are discovered)
+      """
+      topology = self.session.get(RYU_API+'/lb/topology').json()
+      self.SPINE_SW = topology['spines']
+      self.LEAF_SW = topology['leaves']
+      self.UPLINKS = dict((int(leaf), dict((port, gw+1) for gw, port in enumerate(ports) if port is not None))
+                          for leaf, ports in topology['uplinks'].items())
 
    def get_switch_stats(self, dpid):
       """ example output :
       [ip_src, ip_dst, gw, size]
       """
-      req = requests.get(RYU_API+'/stats/flow/'+str(dpid))
+      req = self.session.get(ryu_api(dpid)+'/stats/flow/'+str(dpid))
       resp = req.json()
       data = []
       for flow in [flow for flow in resp[str(dpid)] if len(flow['match'])>0] :
          if flow['match']['dl_type']==2048:
             match = flow['match']
-            gw = flow['actions'][0].split(':')[1]
+            action, gw = flow['actions'][0].split(':')
             flowsize = flow['byte_count']
-            if 'nw_src' in match:
-               data.append((match['nw_src'], match['nw_dst'], gw, flowsize))
+            if action == 'GROUP' and 'nw_dst' in match:
+               # Select group mode: aggregate of the leaf to one destination leaf, gateway is unknown.
+               # Destination is the 10.0.X.0/255.255.255.0 subnet, interned without mask
+               data.append(('10.0.%s.0' % (dpid % 100), match['nw_dst'].split('/')[0], '0', flowsize))
+            elif 'nw_src' in match:
+               # Output port to gateway, 0 when it is not a spine uplink
+               gw = self.UPLINKS.get(dpid, {}).get(int(gw), 0)
+               data.append((match['nw_src'], match['nw_dst'], str(gw), flowsize))
       return data
 
-   def get_leafes_stats(self):
+   def get_switch_sample(self, dpid):
       """ example output :
-      [
-         [ip_src, ip_dst, gw, size]
-      ]
-      """      
-      self.get_switches()
-      flows1 = []		
-      for leaf in self.LEAF_SW:
-         flows1 += self.get_switch_stats(leaf)
-      time.sleep(1)
-      flows2 = []		
-      for leaf in self.LEAF_SW:
-         flows2 += self.get_switch_stats(leaf)
-      flows1 = sorted(flows1)
-      flows2 = sorted(flows2)
-      flows = [(flows1[i][0], flows1[i][1], flows1[i][2], flows2[i][3]-flows1[i][3]) for i in range(len(flows1))]
-      self.LOADS = flows
-      return flows
-
-   def get_gateways_flows(self):
+      (timestamp, [[ip_src, ip_dst, gw, size]])
+      timestamp is the middle of request and response time
+      """
+      time1 = time.time()
+      data = self.get_switch_stats(dpid)
+      return ((time1+time.time())/2, data)
+
+   def get_leafes_sample(self):
+      """ Poll all leaves concurrently, return { leaf: (timestamp, flows) } """
+      samples = self.get_pool().map(self.get_switch_sample, self.LEAF_SW)
+      return dict(zip(self.LEAF_SW, samples))
+
+   def post_shards(self, path, bodies):
+      """ POST { api : body } to Ryu_LB workers concurrently, return their replies """
+      return self.get_pool().map(lambda item: self.session.post(item[0]+path, json=item[1]).json(), bodies.items())
+
+   def set_source(self, source):
+      """ native source ask Ryu_LB to poll stats every `interval` seconds """
+      if source != self.source:
+         interval = self.interval if source == 'native' else 0
+         self.post_shards('/lb/stats', dict((api, {'interval': interval}) for api in RYU_APIS))
+      self.source = source
+
+   def get_native_stats(self):
+      """ example output :
+      {
+         "spines" : [dpid], "leaves" : [dpid],
+         "gateways" : { "101" : rx byte rate },
+         "flows" : { "201" : [[ip_src, ip_dst, gw, rate]] }
+      }
+      rates are computed by Ryu_LB between its last two samples, ips are integers,
+      stats of every worker are merged
+      """
+      shards = self.get_pool().map(lambda api: self.session.get(api+'/lb/stats').json(), RYU_APIS)
+      stats = shards[0]
+      if stats.get('shards', RYU_SHARDS) != RYU_SHARDS:
+         logging.warning('Ryu_LB workers run %s shards, LB_SHARDS is %s here, switches of other shards are not polled',
+                         stats['shards'], RYU_SHARDS)
+      for shard in shards[1:]:
+         # Every worker report switches it is master of
+         stats['flows'].update(shard['flows'])
+         stats['gateways'].update(shard['gateways'])
+         stats['time'] = max(stats['time'], shard['time'])
+      self.SPINE_SW = stats['spines']
+      self.LEAF_SW = stats['leaves']
+      return stats
+
+   def compact_flows(self):
+      """
+      Reclaim ids of flows that left, flows in newest sample of the sampler
+      are kept. Sampler state is remapped too, return FlowTable.compact result.
+      """
+      with self.lock:
+         if self.sampler is None:
+            return self.table.compact()
+         with self.sampler.lock:
+            ids = self.table.compact(self.sampler.alive())
+            if ids is not None:
+               self.sampler.remap(ids)
+            return ids
+
+   def get_leafes_stats(self, rate_mode=None, source=None):
+      """
+      Update flow table load to byte rate (per second) between two samples
+      of the leaves, return ids of active flows
+      rate_mode : TelemetrySampler.refresh mode, default is rate_mode attribute
+      source    : ofctl or native, default is source attribute
+      """
+      with self.lock:
+         if (source or self.source) == 'native':
+            stats = self.get_native_stats()
+            ids = [np.zeros(0, dtype=int)]
+            gws = [np.zeros(0, dtype=int)]
+            rates = [np.zeros(0)]
+            for leaf, flows in stats['flows'].items():
+               ids.append(self.table.flow_ids(flows, int(leaf)))
+               gws.append(np.array([flow[2] for flow in flows], dtype=int))
+               rates.append(np.array([flow[3] for flow in flows], dtype=float))
+            ids = np.concatenate(ids)
+            self.table.update(ids, np.concatenate(rates), np.concatenate(gws))
+            return ids
+         if self.sampler is not None and self.sampler.ready():
+            return self.sampler.refresh(rate_mode or self.rate_mode)
+         self.get_switches()
+         sample1 = self.get_leafes_sample()
+         time.sleep(self.interval)
+         sample2 = self.get_leafes_sample()
+         ids, gws, rate = flow_deltas(self.table, sample1, sample2)
+         self.table.update(ids, rate, gws)
+         return ids
+
+   def get_gateways_flows(self, rate_mode=None, source=None):
       """ example output :
       {
          "101" : {
@@ -134,19 +814,25 @@ class TopologyHelper():
       }
       """
       gateways = {}
-      flows = self.get_leafes_stats()
-      for gw in self.SPINE_SW:
-         gateways[str(gw)] = {'flows':[], 'total':0}
-      for flow in flows:
-         gwid = str(100 + int(flow[2]))
-         flows = {
-            "ip_src": flow[0],
-            "ip_dst": flow[1],
-            "size": flow[3]
-         }
-         gateways[gwid]["flows"].append(flows)
-         gateways[gwid]["total"] += flow[3]
-      return gateways
+      table = self.table
+      with self.lock:
+         ids = self.get_leafes_stats(rate_mode, source)
+         for gw in self.SPINE_SW:
+            gateways[str(gw)] = {'flows':[], 'total':0}
+         for i in ids:
+            gw = table.gateway[i]
+            if not 0 < gw <= len(self.SPINE_SW):
+               # Select group aggregate, gateway is chosen by switch
+               continue
+            gwid = str(self.SPINE_SW[gw-1])
+            load = float(table.load[i])
+            gateways[gwid]["flows"].append({
+               "ip_src": int_to_ip(table.ip_src[i]),
+               "ip_dst": int_to_ip(table.ip_dst[i]),
+               "size": load
+            })
+            gateways[gwid]["total"] += load
+         return gateways
 
    def calc_sem_total(self, loads):
       loads = np.array(loads)
@@ -155,49 +841,591 @@ class TopologyHelper():
       sem = sc_stats.sem(loads)/mean
       return sem, total
 
-   def get_stats(self):
-      gateways = self.get_gateways_flows()
-      loads = []
-      for gw in gateways:
-         loads.append(gateways[gw]["total"])
+   def get_spine_sample(self, dpid):
+      """ example output :
+      (timestamp, rx_bytes)
+      rx_bytes is summed over spine ports, traffic of every flow that use this gateway
+      """
+      time1 = time.time()
+      req = self.session.get(ryu_api(dpid)+'/stats/port/'+str(dpid))
+      ports = req.json()[str(dpid)]
+      # Reserved ports (LOCAL) are reported by name
+      rx_bytes = sum(port['rx_bytes'] for port in ports if isinstance(port['port_no'], int))
+      return ((time1+time.time())/2, rx_bytes)
+
+   def get_spines_sample(self):
+      """ Poll all spines concurrently, return { spine: (timestamp, rx_bytes) } """
+      samples = self.get_pool().map(self.get_spine_sample, self.SPINE_SW)
+      return dict(zip(self.SPINE_SW, samples))
+
+   def get_gateways_load(self, rate_mode=None, source=None):
+      """ example output :
+      { spine : byte rate }
+      from port counters, cost scale with spines instead of flows
+      """
+      if (source or self.source) == 'native':
+         return dict((int(spine), rate) for spine, rate in self.get_native_stats()['gateways'].items())
+      if self.sampler is not None and self.sampler.ports_ready():
+         return self.sampler.gateways_load(rate_mode or self.rate_mode)
+      self.get_switches()
+      sample1 = self.get_spines_sample()
+      time.sleep(self.interval)
+      sample2 = self.get_spines_sample()
+      loads = {}
+      for spine, (timestamp, rx_bytes) in sample2.items():
+         if spine in sample1:
+            delta = rx_bytes-sample1[spine][1]
+            loads[spine] = (delta if delta >= 0 else rx_bytes)/(timestamp-sample1[spine][0])
+      return loads
+
+   def get_stats(self, rate_mode=None, measure=None, source=None):
+      """ SEM and total of gateways load, arguments default to the attributes of the same name """
+      if (measure or self.measure) == 'ports':
+         gateways = self.get_gateways_load(rate_mode, source)
+         loads = [gateways.get(gw, 0) for gw in self.SPINE_SW]
+      else:
+         gateways = self.get_gateways_flows(rate_mode, source)
+         loads = [gateways[gw]["total"] for gw in gateways]
       sem, total = self.calc_sem_total(loads)
       data = {}
       data["sem"] = sem
       data["total"] = total
       return data
 
-   def send_flow_config(self, dpid, flow, pkt_type):
-      host_ori, host_dst, outport, _ = flow
-      data = {
-         "dpid": dpid,
-         "table_id": 0,
-         "actions": [{
-            "type": "OUTPUT",
-            "port": outport
-         }]
-      }
-      if pkt_type=='arp':
-         data["match"] = { "arp_tpa": host_dst, "dl_type": 2054 }
+   def exec_route_plan(self, route_plan):
+      """
+      Install RoutePlan with one request to /lb/routes of the Ryu_LB worker
+      of every source leaf, flows that keep their gateway are skipped. Only
+      flows of leaves that acknowledged the barrier get their new gateway
+      in the table, the others are counted as failed. Return moved flows
+      count
+      """
+      changed = np.flatnonzero(route_plan.changed())
+      if len(changed) == 0:
+         self.RECONFIG = {}
+         return 0
+      leaves = route_plan.table.leaf[route_plan.ids[changed]]
+      routes = {}
+      for i, leaf in zip(changed, leaves):
+         routes.setdefault(ryu_api(leaf), []).append(list(route_plan[i][:3]))
+      replies = self.post_shards('/lb/routes', dict((api, {'routes': shard}) for api, shard in routes.items()))
+      self.RECONFIG = {'flows': 0, 'switches': {}, 'time': 0}
+      for reply in replies:
+         self.RECONFIG['flows'] += reply['flows']
+         self.RECONFIG['switches'].update(reply['switches'])
+         self.RECONFIG['time'] = max(self.RECONFIG['time'], reply['time'])
+      # Unknown switch, barrier timeout or leaf not served by its worker
+      confirmed = set(str(dpid) for dpid, switch in self.RECONFIG['switches'].items()
+                      if 'error' not in switch and switch.get('barrier_time') is not None)
+      done = np.array([str(leaf) in confirmed for leaf in leaves], dtype=bool)
+      self.RECONFIG['failed'] = int(np.sum(~done))
+      if self.RECONFIG['failed']:
+         logging.warning('route plan: %s of %s flows not confirmed by their leaf', self.RECONFIG['failed'], len(changed))
+      route_plan.table.gateway[route_plan.ids[changed[done]]] = route_plan.gateway[changed[done]]
+      return int(np.sum(done))
+
+   def exec_group_weights(self, route_plan, min_weight=1):
+      """
+      Group mode, turn RoutePlan into select group bucket weights (0-100).
+      Flows with installed gateway keep their planned one, load of every
+      leaf select group aggregates is then water-filled over spines (see
+      water_fill), weight of a spine at a leaf is its share of the leaf
+      load. Every bucket get at least `min_weight`.
+      """
+      table = route_plan.table
+      leaves = table.leaf[route_plan.ids]
+      spines_num = len(self.SPINE_SW)
+      group = table.gateway[route_plan.ids] == 0
+      levels = np.bincount(route_plan.gateway[~group]-1, weights=route_plan.load[~group], minlength=spines_num)[:spines_num].astype(float)
+      leaf_loads = dict((leaf, np.sum(route_plan.load[group & (leaves == leaf)])) for leaf in np.unique(leaves[group]))
+      weights = {}
+      # Biggest leaves first, smaller ones fill what is left uneven
+      for leaf in sorted(leaf_loads, key=lambda leaf: -leaf_loads[leaf]):
+         load = leaf_loads[leaf]
+         if not load > 0:
+            continue
+         fill = water_fill(levels, load)
+         levels += fill
+         floor = min(min_weight, 100//spines_num)
+         leaf_weights = floor + (100-floor*spines_num)*fill/load
+         weights.setdefault(ryu_api(leaf), {})[str(leaf)] = [max(int(w), floor) for w in np.round(leaf_weights)]
+      if len(weights) == 0:
+         return {}
+      merged = {}
+      for reply in self.post_shards('/lb/group/weights', dict((api, {'weights': shard}) for api, shard in weights.items())):
+         merged.update(reply['weights'])
+      return merged
+
+class HoltForecaster():
+   """
+   Holt linear (double exponential) smoothing of every flow rate in one
+   numpy pass, level and trend arrays are indexed by flow id (NaN is
+   unknown flow). Flows missing from an update keep their state.
+   """
+   def __init__(self, alpha=0.5, beta=0.2, capacity=1024):
+      self.alpha = alpha
+      self.beta = beta
+      self.level = np.full(capacity, np.nan)
+      self.trend = np.zeros(capacity)
+
+   def grow(self, capacity):
+      extra = capacity-len(self.level)
+      if extra > 0:
+         self.level = np.concatenate((self.level, np.full(extra, np.nan)))
+         self.trend = np.concatenate((self.trend, np.zeros(extra)))
+
+   def remap(self, ids):
+      self.level = remap_ids(self.level, ids, np.nan)
+      self.trend = remap_ids(self.trend, ids, 0)
+
+   def update(self, rate):
+      """ rate : rate of every flow id since last update, NaN when flow is missing """
+      self.grow(len(rate))
+      seen = ~np.isnan(rate)
+      new = seen & np.isnan(self.level[:len(rate)])
+      old = np.flatnonzero(seen & ~new)
+      new = np.flatnonzero(new)
+      self.level[new] = rate[new]
+      self.trend[new] = 0
+      level = self.alpha*rate[old] + (1-self.alpha)*(self.level[old]+self.trend[old])
+      self.trend[old] = self.beta*(level-self.level[old]) + (1-self.beta)*self.trend[old]
+      self.level[old] = level
+
+   def predict(self, horizon=1):
+      """ Rate of every flow `horizon` updates ahead, never negative """
+      with np.errstate(invalid='ignore'):
+         return np.maximum(self.level + horizon*self.trend, 0)
+
+class TelemetrySampler(threading.Thread):
+   """
+   Background thread that poll leaves flow stats every `interval` seconds.
+   Byte counters of the last `window` samples are kept in a ring buffer
+   (window x flows array, NaN when flow is missing from the sample), columns
+   are flow ids of the TopologyHelper FlowTable, leaves are indexed by integer id.
+   With TopologyHelper measure 'ports' only spines port counters are polled,
+   with source 'native' nothing is polled (Ryu_LB collect stats itself).
+   """
+   def __init__(self, topoh, interval=1, window=30, alpha=0.3, capacity=1024):
+      super(TelemetrySampler, self).__init__()
+      self.daemon = True
+      self.topoh = topoh
+      self.table = topoh.table
+      self.interval = interval
+      self.window = window
+      self.alpha = alpha
+      self.lock = threading.Lock()
+      self.stopped = threading.Event()
+      self.leaf_index = {} # leaf dpid : leaf id
+      self.leaf_of = np.zeros(capacity, dtype=int)
+      self.counters = np.full((window, capacity), np.nan)
+      self.times = np.full((window, 8), np.nan)
+      self.rate = np.full(capacity, np.nan)
+      self.ewma = np.full(capacity, np.nan)
+      self.forecaster = HoltForecaster(capacity=capacity)
+      self.horizon = 2 # forecast samples ahead, route plan is installed after training
+      self.samples = 0
+      self.last_sample = 0
+      self.ports = {} # spine : (timestamp, rx_bytes) of last sample
+      self.port_rate = {} # spine : byte rate between last two samples
+      self.port_ewma = {}
+      self.last_port_sample = 0
+
+   def grow(self, flows_num, leaves_num):
+      capacity = self.counters.shape[1]
+      if flows_num > capacity:
+         capacity = max(flows_num, capacity*2)
+         extra = capacity-self.counters.shape[1]
+         self.leaf_of = np.concatenate((self.leaf_of, np.zeros(extra, dtype=int)))
+         self.counters = np.hstack((self.counters, np.full((self.window, extra), np.nan)))
+         self.rate = np.concatenate((self.rate, np.full(extra, np.nan)))
+         self.ewma = np.concatenate((self.ewma, np.full(extra, np.nan)))
+      if leaves_num > self.times.shape[1]:
+         extra = max(leaves_num, self.times.shape[1]*2)-self.times.shape[1]
+         self.times = np.hstack((self.times, np.full((self.window, extra), np.nan)))
+
+   def remap(self, ids):
+      """ Flow table was compacted, called with sampler lock held (see TopologyHelper.compact_flows) """
+      self.leaf_of = remap_ids(self.leaf_of, ids, 0)
+      self.counters = remap_ids(self.counters, ids, np.nan)
+      self.rate = remap_ids(self.rate, ids, np.nan)
+      self.ewma = remap_ids(self.ewma, ids, np.nan)
+      self.forecaster.remap(ids)
+
+   def alive(self):
+      """ Mask of flow ids in newest sample, called with sampler lock held """
+      if self.samples == 0:
+         return None
+      return ~np.isnan(self.counters[(self.samples-1) % self.window])
+
+   def leaf_id(self, leaf):
+      if leaf not in self.leaf_index:
+         self.leaf_index[leaf] = len(self.leaf_index)
+      return self.leaf_index[leaf]
+
+   def sample(self):
+      if self.topoh.source == 'native':
+         # Ryu_LB poll switches itself
+         return
+      self.topoh.get_switches()
+      if self.topoh.measure == 'ports':
+         self.sample_ports()
       else:
-         data["match"] = { "nw_dst": host_dst, "dl_type": 2048 }
-      if host_ori!='0.0.0.0':
-         if pkt_type=='arp':
-            data["match"]["arp_spa"] = host_ori
+         self.sample_flows()
+
+   def sample_ports(self):
+      """ Spines port counters only, flows are polled on demand by the optimizer """
+      samples = self.topoh.get_spines_sample()
+      with self.lock:
+         for spine, (timestamp, rx_bytes) in samples.items():
+            if spine in self.ports:
+               delta = rx_bytes-self.ports[spine][1]
+               rate = (delta if delta >= 0 else rx_bytes)/(timestamp-self.ports[spine][0])
+               self.port_rate[spine] = rate
+               ewma = self.port_ewma.get(spine, rate)
+               self.port_ewma[spine] = self.alpha*rate + (1-self.alpha)*ewma
+            self.ports[spine] = (timestamp, rx_bytes)
+         self.last_port_sample = time.time()
+
+   def sample_flows(self):
+      samples = self.topoh.get_leafes_sample()
+      with self.lock:
+         row = self.samples % self.window
+         self.counters[row] = np.nan
+         self.times[row] = np.nan
+         for leaf, (timestamp, flows) in samples.items():
+            lid = self.leaf_id(leaf)
+            ids = self.table.flow_ids(flows, leaf)
+            self.grow(self.table.size, len(self.leaf_index))
+            self.times[row, lid] = timestamp
+            self.leaf_of[ids] = lid
+            self.table.gateway[ids] = [int(flow[2]) for flow in flows]
+            self.counters[row, ids] = [flow[3] for flow in flows]
+         self.samples += 1
+         self.last_sample = time.time()
+         if self.samples > 1:
+            self.rate = self.window_rate(2)
+            ewma = np.where(np.isnan(self.ewma), self.rate, self.alpha*self.rate + (1-self.alpha)*self.ewma)
+            # Keep last average of flows missing from this sample
+            self.ewma = np.where(np.isnan(self.rate), self.ewma, ewma)
+            self.forecaster.update(self.rate)
+
+   def window_rate(self, size=None):
+      """
+      Byte rate of every flow between newest sample and `size`-1 samples before,
+      counter lower than the old one means flow was reinstalled and only
+      the new counter is counted. Flow missing from the old sample appeared
+      since then, its counter is counted from 0 (as flow_deltas).
+      """
+      size = min(size or self.window, self.samples, self.window)
+      row = (self.samples-1) % self.window
+      old = (self.samples-size) % self.window
+      flows_num = min(self.table.size, self.counters.shape[1])
+      leaf_of = self.leaf_of[:flows_num]
+      elapsed = self.times[row, leaf_of] - self.times[old, leaf_of]
+      rate = np.full(self.counters.shape[1], np.nan)
+      with np.errstate(invalid='ignore', divide='ignore'):
+         counters = self.counters[row, :flows_num]
+         old_counters = self.counters[old, :flows_num]
+         delta = counters - np.where(np.isnan(old_counters), 0, old_counters)
+         delta = np.where(delta < 0, counters, delta)
+         rate[:flows_num] = delta / elapsed
+      return rate
+
+   def ready(self):
+      """ Flows rates are available and not stale (measure changed to ports) """
+      return self.samples > 1 and time.time()-self.last_sample < 3*self.interval
+
+   def ports_ready(self):
+      return len(self.port_rate) > 0 and time.time()-self.last_port_sample < 3*self.interval
+
+   def gateways_load(self, mode='ewma'):
+      """ { spine : byte rate }, mode : ewma or last """
+      with self.lock:
+         return dict(self.port_rate if mode == 'last' else self.port_ewma)
+
+   def refresh(self, mode='ewma'):
+      """
+      Set flow table load of flows alive in last sample, return their ids
+      mode : ewma, window (rate over whole ring buffer), last (rate between
+             last two samples) or forecast (Holt prediction `horizon` samples ahead)
+      """
+      with self.lock:
+         if mode == 'window':
+            rate = self.window_rate()
+         elif mode == 'last':
+            rate = self.rate
+         elif mode == 'forecast':
+            rate = self.forecaster.predict(self.horizon)
          else:
-            data["match"]["nw_src"] = host_ori
-      _ = requests.post(RYU_API+'/stats/flowentry/modify', json=data )
-   
-   def exec_route_plan(self, flows=[]):
-      for flow in flows:
-         leaf = 200 + int(flow[0].split('.')[2])
-         self.send_flow_config(leaf, tuple(flow), 'arp')
-         self.send_flow_config(leaf, tuple(flow), 'ip4')
+            rate = self.ewma
+         flows_num = min(self.table.size, self.counters.shape[1])
+         row = (self.samples-1) % self.window
+         alive = np.flatnonzero(~np.isnan(self.counters[row, :flows_num]) & ~np.isnan(rate[:flows_num]))
+         self.table.update(alive, rate[alive])
+         return alive
+
+   def stop(self):
+      self.stopped.set()
+
+   def run(self):
+      while not self.stopped.is_set():
+         time1 = time.time()
+         try:
+            self.sample()
+         except Exception as e:
+            logging.exception('telemetry sample failed: %s', e)
+         self.stopped.wait(max(0, self.interval-(time.time()-time1)))
+
+class OptimizeJob():
+   """
+   One /optimize request. state : queued, running, done, failed or cancelled,
+   phase of running job : training or reconfig. Result fields are merged
+   into to_dict() when job is done.
+   """
+   def __init__(self, job_id, params):
+      self.id = job_id
+      self.params = params
+      self.state = 'queued'
+      self.phase = None
+      self.progress = 0.0
+      self.result = {}
+      self.error = None
+      self.created = time.time()
+      self.started = None
+      self.finished = None
+      self.cancel_event = threading.Event()
+      self.done_event = threading.Event()
+
+   def monitor(self, progress):
+      """ Training progress callback, stop training when job is cancelled """
+      if self.cancel_event.is_set():
+         raise JobCancelled()
+      self.progress = progress
+
+   def finish(self, state, error=None):
+      self.state = state
+      self.error = error
+      self.finished = time.time()
+      self.done_event.set()
+
+   def to_dict(self):
+      data = {
+         'id': self.id,
+         'state': self.state,
+         'phase': self.phase,
+         'progress': self.progress,
+         'params': self.params,
+         'created': self.created,
+         'started': self.started,
+         'finished': self.finished,
+         'error': self.error
+      }
+      data.update(self.result)
+      return data
+
+class JobManager():
+   """
+   Run OptimizeJob with `run(job)` in `workers` background threads. One
+   worker by default, route plans build on the previous one (OnlineOptimizer
+   warm start and installed gateways) so they are applied in order.
+   At most `keep` jobs are remembered, the oldest finished ones are dropped
+   first and queued or running jobs are never dropped.
+   """
+   FINISHED = ('done', 'failed', 'cancelled')
+
+   def __init__(self, run, workers=1, keep=100):
+      self.run = run
+      self.workers = workers
+      self.keep = keep
+      self.queue = Queue.Queue()
+      self.jobs = collections.OrderedDict() # job id : OptimizeJob
+      self.lock = threading.Lock()
+      self.next_id = 1
+      self.threads = []
+
+   def start(self):
+      # Started on first submit, threads don't survive the fork of run_parallel
+      for _ in range(self.workers-len(self.threads)):
+         thread = threading.Thread(target=self.worker)
+         thread.daemon = True
+         thread.start()
+         self.threads.append(thread)
+
+   def submit(self, params, replace=False):
+      """ Queue new job, with `replace` every unfinished job is cancelled first """
+      with self.lock:
+         if replace:
+            for job in self.jobs.values():
+               self.cancel_job(job)
+         job = OptimizeJob(self.next_id, params)
+         self.next_id += 1
+         self.jobs[job.id] = job
+         finished = [old.id for old in self.jobs.values() if old.state in self.FINISHED]
+         for job_id in finished[:max(0, len(self.jobs)-self.keep)]:
+            del self.jobs[job_id]
+      self.start()
+      self.queue.put(job)
+      return job
+
+   def get(self, job_id):
+      return self.jobs.get(job_id)
+
+   def cancel(self, job_id):
+      with self.lock:
+         job = self.jobs.get(job_id)
+         if job is not None:
+            self.cancel_job(job)
+         return job
+
+   def cancel_job(self, job):
+      # Reconfiguration already sent to switches is not interrupted
+      job.cancel_event.set()
+      if job.state == 'queued':
+         job.finish('cancelled')
+
+   def worker(self):
+      while True:
+         job = self.queue.get()
+         # Under the lock a job is either cancelled while queued or started
+         with self.lock:
+            if job.cancel_event.is_set():
+               continue
+            job.state = 'running'
+            job.started = time.time()
+         try:
+            job.result = self.run(job)
+            job.progress = 1.0
+            job.finish('done')
+         except JobCancelled:
+            job.finish('cancelled')
+         except Exception as e:
+            logging.exception('optimize job %s failed: %s', job.id, e)
+            job.finish('failed', str(e))
+
+class RebalanceScheduler(threading.Thread):
+   """
+   Background thread that check gateways SEM (TopologyHelper.get_stats)
+   every `interval` seconds and queue an optimize job when it goes above
+   `high`. With hysteresis the scheduler is armed again only when SEM drops
+   below `low`, a job is queued at most every `min_interval` seconds and at
+   most `max_per_minute` times in the last minute. `params` are /optimize
+   query args of the queued jobs.
+   """
+   CONFIG = ('enabled', 'high', 'low', 'interval', 'min_interval', 'max_per_minute', 'params')
+   MIN_INTERVAL = 0.1 # seconds between checks, lower would keep a core busy
+
+   def __init__(self, topoh, jobs, high=0.2, low=0.1, interval=2, min_interval=10, max_per_minute=3):
+      super(RebalanceScheduler, self).__init__()
+      self.daemon = True
+      self.topoh = topoh
+      self.jobs = jobs
+      self.enabled = False
+      self.high = high
+      self.low = low
+      self.interval = interval
+      self.min_interval = min_interval
+      self.max_per_minute = max_per_minute
+      self.params = {'solver': 'local'}
+      self.stopped = threading.Event()
+      self.armed = True
+      self.sem = None
+      self.last_trigger = 0
+      self.triggers = collections.deque() # trigger time of last minute
+      self.triggers_total = 0
+      self.job = None
+
+   def configure(self, config):
+      """ Update config from dict, unknown keys or invalid values raise ValueError """
+      if not isinstance(config, dict):
+         raise ValueError('config must be an object')
+      unknown = set(config) - set(self.CONFIG)
+      if unknown:
+         raise ValueError('unknown config %s, use %s' % (sorted(unknown), list(self.CONFIG)))
+      for name in ('high', 'low', 'interval', 'min_interval', 'max_per_minute'):
+         value = config.get(name, 0)
+         if isinstance(value, bool) or not isinstance(value, (int, long, float)) or not value >= 0:
+            raise ValueError('%s must be a number >= 0' % name)
+      if config.get('interval', self.interval) < self.MIN_INTERVAL:
+         raise ValueError('interval must be at least %s seconds' % self.MIN_INTERVAL)
+      if 'enabled' in config and not isinstance(config['enabled'], bool):
+         raise ValueError('enabled must be true or false')
+      if 'params' in config:
+         if not isinstance(config['params'], dict):
+            raise ValueError('params must be an object of /optimize query args')
+         error = params_error(optimize_params(MultiDict(config['params'])))
+         if error is not None:
+            raise ValueError(error)
+      for name in self.CONFIG:
+         if name in config:
+            setattr(self, name, config[name])
+      if self.low > self.high:
+         self.low = self.high
+
+   def status(self):
+      data = dict((name, getattr(self, name)) for name in self.CONFIG)
+      data.update({
+         'armed': self.armed,
+         'sem': self.sem,
+         'last_trigger': self.last_trigger,
+         'triggers_last_minute': len(self.triggers),
+         'triggers_total': self.triggers_total,
+         'job': self.job.id if self.job is not None else None
+      })
+      return data
+
+   def check(self, now=None):
+      """ One scheduler step, return queued job or None """
+      now = now or time.time()
+      self.sem = self.topoh.get_stats()['sem']
+      if np.isnan(self.sem):
+         return None
+      if not self.armed:
+         if self.sem < self.low:
+            self.armed = True
+         return None
+      while self.triggers and now-self.triggers[0] > 60:
+         self.triggers.popleft()
+      if (self.sem <= self.high or now-self.last_trigger < self.min_interval
+          or len(self.triggers) >= self.max_per_minute
+          or (self.job is not None and not self.job.done_event.is_set())):
+         return None
+      self.job = self.jobs.submit(optimize_params(MultiDict(self.params)))
+      self.armed = False
+      self.last_trigger = now
+      self.triggers.append(now)
+      self.triggers_total += 1
+      return self.job
+
+   def stop(self):
+      self.stopped.set()
+
+   def run(self):
+      while not self.stopped.is_set():
+         if self.enabled:
+            try:
+               self.check()
+            except Exception as e:
+               logging.exception('rebalance check failed: %s', e)
+         self.stopped.wait(self.interval)
 
 """ --- Flask API Server --- """
 app = Flask(__name__)
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 topoh = TopologyHelper()
+optimizer = OnlineOptimizer()
+
+STATS_CONFIG = {'rate': 'rate_mode', 'measure': 'measure', 'source': 'source'} # /stats arg : TopologyHelper attribute
+
+def stats_config_error(config):
+   """ Error message of invalid /stats rate, measure or source, None when they are valid """
+   if config.get('rate', 'ewma') not in RATE_MODES:
+      return 'unknown rate %s, use one of %s' % (config['rate'], RATE_MODES)
+   if config.get('measure', 'flows') not in ('flows', 'ports'):
+      return 'unknown measure %s, use flows or ports' % config['measure']
+   if config.get('source', 'ofctl') not in ('ofctl', 'native'):
+      return 'unknown source %s, use ofctl or native' % config['source']
+   return None
 
 @app.route('/stats', methods=['GET'])
 def flask_stats():
@@ -214,34 +1442,197 @@ def flask_stats():
       "sem" : ...
       "total: ...
    }
+   rate, measure and source query args apply to this request only, their
+   defaults are set with POST /stats. source=native need Ryu_LB polling,
+   which is only on when native is the default source.
    """
-   return jsonify(topoh.get_stats())
+   config = dict((name, request.args.get(name, getattr(topoh, attr))) for name, attr in STATS_CONFIG.items())
+   error = stats_config_error(config)
+   if error is None and config['source'] == 'native' and topoh.source != 'native':
+      error = 'native source is off, set it with POST /stats'
+   if error is not None:
+      return jsonify({'error': error}), 400
+   return jsonify(topoh.get_stats(config['rate'], config['measure'], config['source']))
 
-@app.route('/optimize', methods=['GET'])
-def flask_optimize():
-   episode_num = 1000
-   exploration_rate = 0.15
-   ml = MainMachineLearning(topoh.SPINE_SW, topoh.LOADS)
-   route_plan, train_time, best_reward, pred_gw_loads, predicted_sem = ml.train(episode_num, exploration_rate)
+@app.route('/stats', methods=['POST'])
+def flask_stats_config():
+   """ example input :
+   { "rate" : "ewma", "measure" : "flows", "source" : "native" }
+   defaults of /stats, scheduler checks and optimize jobs, source native
+   ask Ryu_LB to poll stats itself
+   """
+   config = request.get_json(force=True)
+   if not isinstance(config, dict) or set(config) - set(STATS_CONFIG):
+      return jsonify({'error': 'config must be an object with keys in %s' % sorted(STATS_CONFIG)}), 400
+   error = stats_config_error(config)
+   if error is not None:
+      return jsonify({'error': error}), 400
+   topoh.rate_mode = config.get('rate', topoh.rate_mode)
+   topoh.measure = config.get('measure', topoh.measure)
+   if 'source' in config:
+      topoh.set_source(config['source'])
+   return jsonify(dict((name, getattr(topoh, attr)) for name, attr in STATS_CONFIG.items()))
+
+def run_optimize_job(job):
+   """ Train and install route plan of OptimizeJob, return job result """
+   params = job.params
+   job.phase = 'training'
+   if params['reset']:
+      optimizer.reset()
+   if topoh.source == 'native' or topoh.measure == 'ports' or (topoh.sampler is not None and topoh.sampler.ready()):
+      # Fresh flow rates, from memory or polled on demand when /stats only read port counters.
+      # Balance on predicted rates by default, route plan is installed after training
+      topoh.get_leafes_stats(params['rate'] or 'forecast')
+   # Forget flows that left, before their ids are used by the optimizer
+   ids = topoh.compact_flows()
+   if ids is not None and optimizer.table is topoh.table:
+      optimizer.remap(ids)
+   route_plan, train_time, best_reward, pred_gw_loads, predicted_sem = optimizer.optimize(topoh.SPINE_SW, topoh.table,
+      params['epsilon'], params['batch'], params['seed'], params['solver'], job.monitor,
+      dict((name, params[name]) for name in OnlineOptimizer.SETTINGS))
+   # Last chance to cancel, reconfiguration is not interrupted
+   job.monitor(1.0)
+   job.phase = 'reconfig'
    time1 = time.time()
-   topoh.exec_route_plan(route_plan)
+   if params['target'] == 'group':
+      # Select group mode, rebalance by rewriting bucket weights
+      topoh.RECONFIG = {'weights': topoh.exec_group_weights(route_plan, params['min_weight'])}
+      moved = 0
+   else:
+      moved = topoh.exec_route_plan(route_plan)
    time2 = time.time()-time1
    loads = list(pred_gw_loads)
-   resp_body = {
+   return {
       'train_time': train_time,
       'totals': sum(loads),
       'sem': predicted_sem,
-      'reconfig_time': time2
+      'reconfig_time': time2,
+      'free_flows': optimizer.free_num,
+      'moved': moved,
+      'failed': topoh.RECONFIG.get('failed', 0),
+      'switches': topoh.RECONFIG.get('switches', {}),
+      'weights': topoh.RECONFIG.get('weights', {}),
+      'solver': params['solver']
+   }
+
+def optimize_params(args):
+   """ OptimizeJob params from /optimize query args (MultiDict) """
+   return {
+      'epsilon': args.get('epsilon', 0.15, type=float),
+      'batch': args.get('batch', 100, type=int),
+      'seed': args.get('seed', None, type=int),
+      'solver': args.get('solver', 'egreedy'),
+      'episodes': args.get('episodes', None, type=int),
+      'warm_episodes': args.get('warm_episodes', None, type=int),
+      'threshold': args.get('threshold', None, type=float),
+      'move_cost': args.get('move_cost', None, type=float),
+      'objective': args.get('objective', None),
+      'capacity': args.get('capacity', None, type=float),
+      'reset': args.get('reset', 0, type=int),
+      'rate': args.get('rate', None),
+      'target': args.get('target', 'flows'),
+      'min_weight': args.get('min_weight', 1, type=int)
+   }
+
+def params_error(params):
+   """ Error message of invalid optimize_params, None when they are valid """
+   if params['solver'] not in SOLVERS:
+      return 'unknown solver %s, use one of %s' % (params['solver'], sorted(SOLVERS.keys()))
+   if params['objective'] not in [None] + OBJECTIVES:
+      return 'unknown objective %s, use one of %s' % (params['objective'], OBJECTIVES)
+   if params['rate'] not in [None] + RATE_MODES:
+      return 'unknown rate %s, use one of %s' % (params['rate'], RATE_MODES)
+   return None
+
+jobs = JobManager(run_optimize_job)
+scheduler = RebalanceScheduler(topoh, jobs)
+
+@app.route('/optimize', methods=['GET'])
+def flask_optimize():
+   """ example output :
+   {
+      "id" : ...,
+      "state" : "queued",
+      ...
+   }
+   Training run in background, poll /optimize/<id> for progress and result.
+   replace=1 cancel unfinished jobs, wait=1 answer when job is finished.
+   """
+   params = optimize_params(request.args)
+   error = params_error(params)
+   if error is not None:
+      return jsonify({'error': error}), 400
+   job = jobs.submit(params, request.args.get('replace', 0, type=int))
+   if request.args.get('wait', 0, type=int):
+      job.done_event.wait()
+      return jsonify(job.to_dict())
+   return jsonify(job.to_dict()), 202
+
+@app.route('/optimize/<int:job_id>', methods=['GET'])
+def flask_optimize_job(job_id):
+   job = jobs.get(job_id)
+   if job is None:
+      return jsonify({'error': 'unknown job %s' % job_id}), 404
+   return jsonify(job.to_dict())
+
+@app.route('/optimize/<int:job_id>', methods=['DELETE'])
+def flask_optimize_cancel(job_id):
+   job = jobs.cancel(job_id)
+   if job is None:
+      return jsonify({'error': 'unknown job %s' % job_id}), 404
+   return jsonify(job.to_dict())
+
+@app.route('/rebalance', methods=['GET'])
+def flask_rebalance():
+   """ example output :
+   {
+      "enabled" : false,
+      "high" : 0.2,
+      "low" : 0.1,
+      ...
+      "armed" : true,
+      "sem" : ...
    }
-   return jsonify(resp_body)
+   """
+   return jsonify(scheduler.status())
+
+@app.route('/rebalance', methods=['POST'])
+def flask_rebalance_config():
+   """ example input :
+   {
+      "enabled" : true,
+      "high" : 0.2,
+      "params" : { "solver" : "local", "move_cost" : 0.001 }
+   }
+   """
+   try:
+      scheduler.configure(request.get_json(force=True))
+   except ValueError as e:
+      return jsonify({'error': str(e)}), 400
+   return jsonify(scheduler.status())
 
 def run_lb_api():
-   app.run(host='0.0.0.0', debug=False)
+   topoh.sampler = TelemetrySampler(topoh)
+   topoh.sampler.start()
+   scheduler.start()
+   app.run(host='0.0.0.0', debug=False, threaded=True)
 
 def run_ryu_rest():
+   """
+   One ryu-manager per shard, each on its own core. Every switch connect
+   to all workers (LB_SHARDS env of mininet/ta_topo.py too), workers
+   take master role of their partition of dpids and share LB state
+   through RYU_STORE.
+   """
    time.sleep(1)
-   proc = subprocess.Popen("PYTHONPATH=. /usr/local/bin/ryu-manager ryu.app.ofctl_rest ryu_lb.py --observe-links", shell=True)
-   proc.wait()
+   if os.path.exists(RYU_STORE):
+      os.remove(RYU_STORE)
+   procs = []
+   for i in range(RYU_SHARDS):
+      procs.append(subprocess.Popen("LB_SHARD=%s LB_SHARDS=%s LB_STORE=%s PYTHONPATH=. /usr/local/bin/ryu-manager ryu.app.ofctl_rest ryu_lb.py "
+                                    "--observe-links --ofp-tcp-listen-port %s --wsapi-port %s" % (i, RYU_SHARDS, RYU_STORE, 6653+i, 8080+i), shell=True))
+   for proc in procs:
+      proc.wait()
 
 def run_parallel(*fns):
    proc = []
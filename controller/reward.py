@@ -0,0 +1,180 @@
+from __future__ import division
+
+import numpy as np
+
+'''
+Reward engine of the optimizer. Gateways load are kept with running sums
+(total load, sum of squared deviations and its capacity weighted version),
+so the reward change of moving a flow or swapping two flows is computed
+from the two gateways involved, without rebuilding gateways load from
+every flow.
+'''
+
+LINK_CAPACITY = 100e6/8 # bytes/s of 100 Mbit spine links (bw in mininet/ta_topo.py)
+OBJECTIVES = ['sem', 'maxutil', 'wvar']
+
+class RewardEngine():
+   """
+   objective : sem     : (mean-sem)/mean of gateways load (ddof=1)
+               maxutil : 1 - max utilization (load/capacity) of gateways
+               wvar    : 1 - std/mean of gateways utilization, capacity weighted
+   capacity  : capacity (bytes/s) of every gateway or one for all, default LINK_CAPACITY
+   move_cost : reward penalty for every flow moved away from its `current`
+               gateway index (-1 unknown)
+   """
+   def __init__(self, loads, spines_num, objective='sem', capacity=None, move_cost=0, current=None):
+      if objective not in OBJECTIVES:
+         raise ValueError('unknown objective %s, use one of %s' % (objective, OBJECTIVES))
+      self.loads = np.asarray(loads, dtype=float)
+      self.spines_num = spines_num
+      self.objective = objective
+      if capacity is None:
+         capacity = LINK_CAPACITY
+      self.capacity = np.zeros(spines_num) + capacity
+      # Gateway value the objective balance, load for sem and utilization for others
+      self.scale = np.ones(spines_num) if objective == 'sem' else self.capacity
+      self.move_cost = move_cost
+      self.current = current
+      self.gw_loads = np.zeros(spines_num)
+      self.moved = 0
+      self.update_sums()
+
+   def update_sums(self):
+      self.total = np.sum(self.gw_loads)
+      self.ssd = np.sum((self.gw_loads-self.total/self.spines_num)**2)
+      self.wssd = np.sum(self.capacity*(self.gw_loads/self.capacity-self.total/np.sum(self.capacity))**2)
+
+   def reset(self, actions):
+      """ Gateways load and running sums of complete actions, return reward """
+      self.gw_loads = np.bincount(actions, weights=self.loads, minlength=self.spines_num).astype(float)
+      self.moved = int(self.count_moved(actions))
+      self.update_sums()
+      return self.reward()
+
+   def value(self, total, ssd, wssd, gw_loads=None):
+      """ Objective from running sums (maxutil need gateways load), broadcast over arrays """
+      n = self.spines_num
+      if self.objective == 'maxutil':
+         return 1 - np.max(gw_loads/self.capacity, axis=-1)
+      if self.objective == 'wvar':
+         capacity = np.sum(self.capacity)
+         return 1 - np.sqrt(np.maximum(wssd/capacity, 0))/(total/capacity)
+      return 1 - np.sqrt(np.maximum(ssd/(n-1), 0)/n)/(total/n)
+
+   def reward(self):
+      return self.value(self.total, self.ssd, self.wssd, self.gw_loads) - self.move_cost*self.moved
+
+   def levels(self):
+      return self.gw_loads/self.scale
+
+   def batch(self, actions):
+      """
+      actions : matrix (episodes x flows) of gateway index,
+      return gateways load matrix (episodes x spines) and reward of every episode
+      """
+      episodes = actions.shape[0]
+      # Offset every episode into its own block of bins, so one bincount
+      # computes the gateways load of the whole batch
+      offset = (np.arange(episodes) * self.spines_num)[:, None]
+      gw_loads = np.bincount((actions + offset).ravel(),
+                             weights=np.tile(self.loads, episodes),
+                             minlength=episodes * self.spines_num)
+      gw_loads = gw_loads.reshape(episodes, self.spines_num)
+      total = np.sum(gw_loads, axis=1)
+      ssd = np.sum((gw_loads-(total/self.spines_num)[:, None])**2, axis=1)
+      util = gw_loads/self.capacity
+      wssd = np.sum(self.capacity*(util-(total/np.sum(self.capacity))[:, None])**2, axis=1)
+      reward = self.value(total, ssd, wssd, gw_loads)
+      if self.move_cost:
+         reward = reward - self.move_cost*self.count_moved(actions)
+      return (gw_loads, reward)
+
+   def count_moved(self, actions):
+      """ Number of flows moved from current gateway (in every episode) """
+      if self.current is None:
+         return np.zeros(np.shape(actions)[:-1], dtype=int)
+      return np.count_nonzero((actions != self.current) & (self.current >= 0), axis=-1)
+
+   def moved_delta(self, idx, gw_old, gw_new):
+      """ Change of moved flows count when flows `idx` go from gw_old to gw_new """
+      if self.current is None:
+         return np.zeros(len(idx))
+      # Gateway index are >= 0, so only known flows can equal gw_old or gw_new
+      cur = self.current[idx]
+      return (cur == gw_old).astype(int) - (cur == gw_new)
+
+   def target_transfer(self, gw_from, gw_to):
+      """ Load to move from gw_from to gw_to that level both gateways """
+      if self.objective == 'sem':
+         return (self.gw_loads[gw_from]-self.gw_loads[gw_to])/2
+      cap_from, cap_to = self.capacity[gw_from], self.capacity[gw_to]
+      return (self.gw_loads[gw_from]*cap_to-self.gw_loads[gw_to]*cap_from)/(cap_from+cap_to)
+
+   def transfer_sums(self, gw_from, gw_to, xs):
+      """ Running sums after moving load `xs` (array) from gw_from to gw_to """
+      load_from = self.gw_loads[gw_from]
+      load_to = self.gw_loads[gw_to]
+      ssd = self.ssd + 2*xs*(xs-(load_from-load_to))
+      wssd = (self.wssd + (xs*xs-2*load_from*xs)/self.capacity[gw_from]
+                        + (xs*xs+2*load_to*xs)/self.capacity[gw_to])
+      return ssd, wssd
+
+   def transfer_gain(self, gw_from, gw_to, xs, moved):
+      """
+      Reward change of moving load `xs` (array, negative for swap with a
+      bigger flow) from gw_from to gw_to (one or array like xs), `moved` is
+      the change of moved flows
+      """
+      xs = np.asarray(xs, dtype=float)
+      base = self.value(self.total, self.ssd, self.wssd, self.gw_loads)
+      if self.objective == 'maxutil':
+         # Max utilization of other gateways, the second max where gw_to is the max
+         others = self.gw_loads/self.capacity
+         others[gw_from] = -np.inf
+         top = np.argsort(others)[::-1][:2]
+         second = others[top[1]] if len(top) > 1 else -np.inf
+         other_max = np.where(np.asarray(gw_to) == top[0], second, others[top[0]])
+         util = np.maximum((self.gw_loads[gw_from]-xs)/self.capacity[gw_from],
+                           (self.gw_loads[gw_to]+xs)/self.capacity[gw_to])
+         new = 1 - np.maximum(util, other_max)
+      else:
+         ssd, wssd = self.transfer_sums(gw_from, gw_to, xs)
+         new = self.value(self.total, ssd, wssd)
+      return new - base - self.move_cost*np.asarray(moved)
+
+   def apply_transfer(self, gw_from, gw_to, x, moved):
+      self.ssd, self.wssd = self.transfer_sums(gw_from, gw_to, x)
+      self.gw_loads[gw_from] -= x
+      self.gw_loads[gw_to] += x
+      self.moved += int(moved)
+
+   def delta_move(self, actions, i, gw_to):
+      """ Reward change of moving flow i to gw_to """
+      gw_from = actions[i]
+      if gw_from == gw_to:
+         return 0.0
+      moved = self.moved_delta(np.array([i]), gw_from, gw_to)
+      return self.transfer_gain(gw_from, gw_to, self.loads[i:i+1], moved)[0]
+
+   def delta_swap(self, actions, i, j):
+      """ Reward change of swapping gateways of flow i and j """
+      gw_from, gw_to = actions[i], actions[j]
+      if gw_from == gw_to:
+         return 0.0
+      moved = self.moved_delta(np.array([i]), gw_from, gw_to) + self.moved_delta(np.array([j]), gw_to, gw_from)
+      return self.transfer_gain(gw_from, gw_to, self.loads[i:i+1]-self.loads[j], moved)[0]
+
+   def apply_move(self, actions, i, gw_to):
+      gw_from = actions[i]
+      if gw_from == gw_to:
+         return
+      self.apply_transfer(gw_from, gw_to, self.loads[i], self.moved_delta(np.array([i]), gw_from, gw_to)[0])
+      actions[i] = gw_to
+
+   def apply_swap(self, actions, i, j):
+      gw_from, gw_to = actions[i], actions[j]
+      if gw_from == gw_to:
+         return
+      moved = self.moved_delta(np.array([i]), gw_from, gw_to) + self.moved_delta(np.array([j]), gw_to, gw_from)
+      self.apply_transfer(gw_from, gw_to, self.loads[i]-self.loads[j], moved[0])
+      actions[i], actions[j] = gw_to, gw_from
@@ -4,17 +4,593 @@ from ryu.controller import ofp_event, handler
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3
-from ryu.lib.packet import packet
-from ryu.lib.packet import ethernet, ipv4, arp
 from ryu.lib.packet import ether_types
 from ryu.lib import dpid as dpid_lib
+from ryu.lib import hub
+from ryu.topology import event as topo_event
 from ryu.app.wsgi import ControllerBase, WSGIApplication, route
+from eventlet import tpool
 
 from webob import Response
-import copy, netaddr, json, time
+import copy, json, time, struct, socket, logging, bisect, collections, math, random, os, sqlite3, heapq
 
 LB_INSTANCE_NAME = 'lb_instance_app'
 url = '/lb/'
+PROACTIVE_COOKIE = 0x1
+GROUP_COOKIE = 0x2
+HOST_COOKIE = 0x3
+LB_GROUP_ID = 1
+
+def ip_to_int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+def int_to_ip(ip):
+    return socket.inet_ntoa(struct.pack('!I', ip))
+
+def parse_packet_in(data):
+    """
+    Fast path decoder, read ethertype and ARP (spa, tpa) / IPv4 (src, dst)
+    addresses straight from the frame with struct.unpack_from (no copy and
+    no ryu Packet object). Return (ethertype, ip_src, ip_dst), addresses are
+    integers or None when frame is not ARP/IPv4.
+    """
+    offset = 12
+    ethertype, = struct.unpack_from('!H', data, offset)
+    if ethertype == ether_types.ETH_TYPE_8021Q:
+        offset += 4
+        ethertype, = struct.unpack_from('!H', data, offset)
+    offset += 2
+    if ethertype == ether_types.ETH_TYPE_ARP and len(data) >= offset + 28:
+        # spa after htype, ptype, hlen, plen, oper and sha, tpa after tha
+        ip_src, ip_dst = struct.unpack_from('!14xI6xI', data, offset)
+        return ethertype, ip_src, ip_dst
+    if ethertype == ether_types.ETH_TYPE_IP and len(data) >= offset + 20:
+        ip_src, ip_dst = struct.unpack_from('!12xII', data, offset)
+        return ethertype, ip_src, ip_dst
+    return ethertype, None, None
+
+class LatencyHistogram(object):
+    """
+    HDR style histogram with fixed log-scale buckets, 4 buckets per power of
+    two from 1us to ~16s (relative error ~19%), recording is one bisect.
+    """
+    BOUNDS = [1e-6 * 2 ** (i / 4) for i in range(97)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, p):
+        """ Upper bound of bucket that hold the p-th percentile """
+        if self.count == 0:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else float('inf')
+        return float('inf')
+
+class LBMetrics(object):
+    """
+    Latency histogram of every packet-in stage and packet-in counter, per
+    dpid and lb_method, exported in Prometheus text format.
+    """
+    STAGES = ['packet_in', 'parse', 'find_route', 'lb_decision', 'forward_packet', 'mod_host_flow']
+
+    def __init__(self, rate_window=10):
+        self.histograms = {} # (stage, dpid, lb_method) : LatencyHistogram
+        self.packet_in = collections.Counter() # (dpid, lb_method) : count
+        self.seconds = collections.deque(maxlen=rate_window) # [second, packet-in count]
+
+    def observe(self, stage, dpid, lb_method, value):
+        key = (stage, dpid, lb_method)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = LatencyHistogram()
+        hist.record(value)
+
+    def count_packet_in(self, dpid, lb_method, now):
+        self.packet_in[(dpid, lb_method)] += 1
+        second = int(now)
+        if len(self.seconds) == 0 or self.seconds[-1][0] != second:
+            self.seconds.append([second, 0])
+        self.seconds[-1][1] += 1
+
+    def packet_in_rate(self, now=None):
+        """ Packet-ins per second over the last complete seconds of the window """
+        now = int(now or time.time())
+        done = [count for second, count in self.seconds if second < now]
+        if len(done) == 0:
+            return 0.0
+        return sum(done) / (now - self.seconds[0][0])
+
+    def prometheus(self):
+        lines = ['# HELP ryu_lb_stage_seconds Latency of packet-in handling stages',
+                 '# TYPE ryu_lb_stage_seconds histogram']
+        quantiles = {50: [], 99: []}
+        for (stage, dpid, lb_method), hist in sorted(self.histograms.items()):
+            labels = 'stage="%s",dpid="%s",lb_method="%s"' % (stage, dpid, lb_method)
+            cumulative = 0
+            for bound, count in zip(hist.BOUNDS, hist.counts):
+                cumulative += count
+                lines.append('ryu_lb_stage_seconds_bucket{%s,le="%.9g"} %d' % (labels, bound, cumulative))
+            lines.append('ryu_lb_stage_seconds_bucket{%s,le="+Inf"} %d' % (labels, hist.count))
+            lines.append('ryu_lb_stage_seconds_sum{%s} %.9g' % (labels, hist.sum))
+            lines.append('ryu_lb_stage_seconds_count{%s} %d' % (labels, hist.count))
+            for q in quantiles:
+                quantiles[q].append('ryu_lb_stage_p%s_seconds{%s} %.9g' % (q, labels, hist.percentile(q)))
+        for q in sorted(quantiles):
+            lines += ['# HELP ryu_lb_stage_p%s_seconds p%s of packet-in handling stages (bucket upper bound)' % (q, q),
+                      '# TYPE ryu_lb_stage_p%s_seconds gauge' % (q)] + quantiles[q]
+        lines += ['# HELP ryu_lb_packet_in_total Packet-in handled',
+                  '# TYPE ryu_lb_packet_in_total counter']
+        for (dpid, lb_method), count in sorted(self.packet_in.items()):
+            lines.append('ryu_lb_packet_in_total{dpid="%s",lb_method="%s"} %d' % (dpid, lb_method, count))
+        lines += ['# HELP ryu_lb_packet_in_per_second Packet-in rate over last seconds',
+                  '# TYPE ryu_lb_packet_in_per_second gauge',
+                  'ryu_lb_packet_in_per_second %.9g' % (self.packet_in_rate())]
+        return '\n'.join(lines) + '\n'
+
+class StatsCollector(object):
+    """
+    Flow and port stats polled by Ryu_LB. Multipart replies are aggregated
+    by (dpid, xid) and when the last part arrive the rates since previous
+    sample of the switch are computed:
+    - leaf  : [ip_src, ip_dst, gw, rate] of every host flow, ips are integers
+    - spine : rx byte rate summed over ports (gateway load)
+    """
+    PENDING_TIMEOUT = 10
+
+    def __init__(self):
+        self.pending = {} # (dpid, xid) : (request time, stats bodies)
+        self.flow_counters = {} # leaf dpid : (timestamp, { (ip_src, ip_dst) : byte_count })
+        self.flows = {} # leaf dpid : [[ip_src, ip_dst, gw, rate]]
+        self.port_counters = {} # spine dpid : (timestamp, rx_bytes)
+        self.gateways = {} # spine dpid : rx byte rate
+        self.time = 0
+
+    def request(self, dpid, xid, now):
+        # Forget requests whose replies were lost (switch left or timeout)
+        for key in [key for key, (time1, _) in self.pending.items() if now-time1 > self.PENDING_TIMEOUT]:
+            del self.pending[key]
+        self.pending[(dpid, xid)] = (now, [])
+
+    def reply(self, dpid, xid, body, more, now):
+        """ Return (timestamp, bodies) when last part arrived, else None """
+        entry = self.pending.get((dpid, xid))
+        if entry is None:
+            return None
+        entry[1].extend(body)
+        if more:
+            return None
+        del self.pending[(dpid, xid)]
+        return ((entry[0]+now)/2, entry[1])
+
+    def update_flows(self, dpid, timestamp, counters):
+        """ counters : { (ip_src, ip_dst) : (gw, byte_count) } """
+        prev_time, prev = self.flow_counters.get(dpid, (None, {}))
+        flows = []
+        if prev_time is not None:
+            elapsed = timestamp-prev_time
+            for key, (gw, count) in counters.items():
+                # Counter lower than previous one means flow was reinstalled
+                delta = count-prev.get(key, 0)
+                flows.append([key[0], key[1], gw, (delta if delta >= 0 else count)/elapsed])
+        self.flow_counters[dpid] = (timestamp, dict((key, count) for key, (gw, count) in counters.items()))
+        self.flows[dpid] = flows
+        self.time = timestamp
+
+    def update_ports(self, dpid, timestamp, rx_bytes):
+        if dpid in self.port_counters:
+            prev_time, prev = self.port_counters[dpid]
+            delta = rx_bytes-prev
+            self.gateways[dpid] = (delta if delta >= 0 else rx_bytes)/(timestamp-prev_time)
+        self.port_counters[dpid] = (timestamp, rx_bytes)
+        self.time = timestamp
+
+    def drop(self, dpid):
+        for state in (self.flow_counters, self.flows, self.port_counters, self.gateways):
+            state.pop(dpid, None)
+
+    def to_dict(self):
+        return {
+            'time': self.time,
+            'gateways': dict((str(dpid), rate) for dpid, rate in self.gateways.items()),
+            'flows': dict((str(dpid), flows) for dpid, flows in self.flows.items())
+        }
+
+class RuleTable(object):
+    """
+    Host rules installed on every switch, one (eth_type, ip_src, ip_dst) key
+    per rule (ip_src 0 is wildcard) kept in LRU order: install and flow
+    stats showing new bytes (see used) move a rule to the end, eviction pop
+    from the front.
+    Rules leave on flow removed message (idle/hard timeout) or eviction.
+    ARP and IPv4 rules of a pair are used and evicted together.
+    """
+    REASONS = { 0: 'idle_timeout', 1: 'hard_timeout', 2: 'delete', 3: 'group_delete' }
+
+    def __init__(self):
+        self.rules = {} # dpid : OrderedDict(key : (install time, out port))
+        self.byte_counts = {} # dpid : { key : byte count at last flow stats }
+        self.removed = collections.Counter() # reason : count
+        self.evicted = 0
+
+    def add(self, dpid, key, now, port=None):
+        rules = self.rules.setdefault(dpid, collections.OrderedDict())
+        rules.pop(key, None)
+        rules[key] = (now, port)
+        self.byte_counts.get(dpid, {}).pop(key, None)
+
+    @staticmethod
+    def partner(key):
+        """ Key of the other rule (ARP or IPv4) of the same pair """
+        eth_type, ip_src, ip_dst = key
+        other = ether_types.ETH_TYPE_IP if eth_type == ether_types.ETH_TYPE_ARP else ether_types.ETH_TYPE_ARP
+        return (other, ip_src, ip_dst)
+
+    def touch(self, dpid, key):
+        """ Move rule and its partner to the end of LRU order """
+        rules = self.rules.get(dpid)
+        if rules is None:
+            return
+        for key in (self.partner(key), key):
+            if key in rules:
+                rules[key] = rules.pop(key)
+
+    def used(self, dpid, counts):
+        """ counts : { key : byte count } of flow stats, touch rules that forwarded bytes since last stats """
+        last = self.byte_counts.get(dpid, {})
+        for key, count in counts.items():
+            if count > last.get(key, 0):
+                self.touch(dpid, key)
+        rules = self.rules.get(dpid, {})
+        self.byte_counts[dpid] = dict((key, count) for key, count in counts.items() if key in rules)
+
+    def set_port(self, dpid, key, port):
+        """ Rule was modified to output to `port`, its LRU position is kept """
+        rules = self.rules.get(dpid)
+        if rules is not None and key in rules:
+            rules[key] = (rules[key][0], port)
+
+    def port(self, dpid, key):
+        """ Out port of installed rule, None when it is not installed """
+        rule = self.rules.get(dpid, {}).get(key)
+        return rule[1] if rule is not None else None
+
+    def remove(self, dpid, key, reason):
+        """ Return (install time, out port) of removed rule or None """
+        self.removed[self.REASONS.get(reason, reason)] += 1
+        rules = self.rules.get(dpid)
+        if rules is not None:
+            return rules.pop(key, None)
+        return None
+
+    def evict(self, dpid, num):
+        """ Pop `num` least recently used rules of the switch, with their partner """
+        rules = self.rules.get(dpid, {})
+        keys = []
+        while len(keys) < num and rules:
+            key = rules.popitem(last=False)[0]
+            keys.append(key)
+            if rules.pop(self.partner(key), None) is not None:
+                keys.append(self.partner(key))
+        self.evicted += len(keys)
+        return keys
+
+    def count(self, dpid):
+        return len(self.rules.get(dpid, {}))
+
+    def drop(self, dpid):
+        self.rules.pop(dpid, None)
+        self.byte_counts.pop(dpid, None)
+
+class SpineLoad(object):
+    """
+    Load estimate (byte rate) of every spine, index is gateway-1 (spine_switch order),
+    for load aware lb methods. Measured rate come from spines port stats, or
+    is the byte count of removed host rules decayed over `tau` seconds when
+    stats are not polled. Every flow placed since last measure add the
+    average flow rate, so a burst of packet-ins doesn't herd on one spine.
+    Least loaded spine is the top of a heap of (estimate, index), placing a
+    flow push the new estimate of its spine and outdated entries are dropped
+    when they reach the top, selection is O(log spines). Measure and removed
+    flows change every estimate, the heap is then rebuilt on next selection.
+    """
+    def __init__(self, tau=10):
+        self.tau = tau
+        self.measured = []
+        self.placed = []
+        self.flow_rate = 1.0
+        self.time = time.time()
+        self.heap = []
+        self.dirty = True
+
+    def resize(self, spine_num):
+        if len(self.measured) != spine_num:
+            self.measured = [0.0] * spine_num
+            self.placed = [0] * spine_num
+            self.dirty = True
+
+    def measure(self, rates, flows_num, now):
+        """ Fresh rates from port stats of all spines, placed flows are now part of them """
+        self.measured = list(rates)
+        self.placed = [0] * len(rates)
+        self.flow_rate = sum(rates) / flows_num if flows_num > 0 and sum(rates) > 0 else 1.0
+        self.time = now
+        self.dirty = True
+
+    def removed(self, index, byte_count, now):
+        factor = math.exp(-(now - self.time) / self.tau)
+        self.measured = [rate * factor for rate in self.measured]
+        self.measured[index] += byte_count / self.tau
+        self.time = now
+        self.dirty = True
+
+    def estimate(self, index):
+        return self.measured[index] + self.placed[index] * self.flow_rate
+
+    def place(self, index):
+        self.placed[index] += 1
+        if not self.dirty:
+            if len(self.heap) > 4 * len(self.measured):
+                # Placed by p2c or for a subset of spines, outdated entries piled up
+                self.dirty = True
+            else:
+                heapq.heappush(self.heap, (self.estimate(index), index))
+        return index
+
+    def least(self, candidates=None):
+        """ Spine with least estimated load among candidates indexes (default all) """
+        if candidates is not None and len(candidates) < len(self.measured):
+            # Leaf without uplink to every spine
+            return self.place(min(candidates, key=self.estimate))
+        if self.dirty:
+            self.heap = [(self.estimate(index), index) for index in range(len(self.measured))]
+            heapq.heapify(self.heap)
+            self.dirty = False
+        while True:
+            value, index = heapq.heappop(self.heap)
+            if value == self.estimate(index):
+                return self.place(index)
+
+    def p2c(self, candidates=None):
+        """ Power of two choices, less loaded of two random spines """
+        if candidates is None:
+            candidates = range(len(self.measured))
+        spine_num = len(candidates)
+        if spine_num < 2:
+            return self.place(candidates[0])
+        i = random.randrange(spine_num)
+        j = random.randrange(spine_num - 1)
+        if j >= i:
+            j += 1
+        i, j = candidates[i], candidates[j]
+        return self.place(i if self.estimate(i) <= self.estimate(j) else j)
+
+class Topology(object):
+    """
+    Fabric model from LLDP links of ryu.topology (--observe-links). Ports
+    without link are host ports, edge switches (tier 0) have host ports and
+    tier of other switches is their hop distance to nearest edge switch, so
+    roles don't depend on dpid and any multi-stage Clos is supported.
+    Next hops of every switch toward every edge switch (ports on all
+    shortest paths, ECMP) are precomputed, lazily after links change.
+    Hosts are learned where they send packets. The model is only used once
+    it settled (see settle), partial discovery would take uplinks for host
+    ports.
+    """
+    def __init__(self):
+        self.ports = {} # dpid : physical ports
+        self.links = {} # (dpid, port) : peer dpid
+        self.hosts = {} # ip : (edge dpid, port)
+        self.neighbors = {} # dpid : { port : peer dpid }
+        self.tiers = {} # dpid : tier
+        self.next_hops = {} # dpid : { edge dpid : [port, ...] }
+        self.dirty = False
+        self.settled = False
+        self.last_tiers = {} # tiers at previous settle
+
+    def add_switch(self, dpid, ports):
+        self.ports[dpid] = sorted(port for port in ports if port < ofproto_v1_3.OFPP_MAX)
+        self.dirty = True
+
+    def del_switch(self, dpid):
+        self.ports.pop(dpid, None)
+        for key in [key for key, peer in self.links.items() if dpid in (key[0], peer)]:
+            del self.links[key]
+        for ip in [ip for ip, (edge, port) in self.hosts.items() if edge == dpid]:
+            del self.hosts[ip]
+        self.dirty = True
+
+    def add_link(self, dpid, port, peer):
+        """ Return True when link is new """
+        if self.links.get((dpid, port)) == peer:
+            return False
+        self.links[(dpid, port)] = peer
+        # Host seen on this port before LLDP found the link was a wrong guess
+        for ip in [ip for ip, loc in self.hosts.items() if loc == (dpid, port)]:
+            del self.hosts[ip]
+        self.dirty = True
+        return True
+
+    def del_link(self, dpid, port):
+        if self.links.pop((dpid, port), None) is None:
+            return False
+        self.dirty = True
+        return True
+
+    def linked(self):
+        """ False until the model settled, Ryu_LB then use the addressing scheme """
+        return self.settled and len(self.links) > 0
+
+    def settle(self):
+        """
+        Called once link events stopped for a while. The model settle when
+        every switch has a tier and tiers didn't change since previous call,
+        it is then used for good. Return True when tiers changed.
+        """
+        self.refresh()
+        changed = self.tiers != self.last_tiers
+        self.last_tiers = dict(self.tiers)
+        if not changed and len(self.links) > 0 and all(dpid in self.tiers for dpid in self.ports):
+            self.settled = True
+        return changed
+
+    def refresh(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        self.neighbors = dict((dpid, {}) for dpid in self.ports)
+        for (dpid, port), peer in self.links.items():
+            if dpid in self.neighbors and peer in self.neighbors:
+                self.neighbors[dpid][port] = peer
+        edges = [dpid for dpid, ports in self.ports.items()
+                 if 0 < len(self.neighbors[dpid]) < len(ports)]
+        self.tiers = self.distances(edges)
+        self.next_hops = dict((dpid, {}) for dpid in self.neighbors)
+        for edge in edges:
+            dist = self.distances([edge])
+            for dpid, hops in dist.items():
+                if hops > 0:
+                    self.next_hops[dpid][edge] = sorted(port for port, peer in self.neighbors[dpid].items()
+                                                        if dist.get(peer) == hops - 1)
+
+    def distances(self, sources):
+        """ Hop count of every switch from nearest source (BFS over links) """
+        dist = dict((dpid, 0) for dpid in sources)
+        queue = collections.deque(sources)
+        while queue:
+            dpid = queue.popleft()
+            for peer in self.neighbors[dpid].values():
+                if peer not in dist:
+                    dist[peer] = dist[dpid] + 1
+                    queue.append(peer)
+        return dist
+
+    def tier(self, tier):
+        self.refresh()
+        return sorted(dpid for dpid, value in self.tiers.items() if value == tier)
+
+    def host_ports(self, dpid):
+        """ Ports without link of edge switch, none for other switches """
+        self.refresh()
+        if self.tiers.get(dpid) != 0:
+            return []
+        return [port for port in self.ports.get(dpid, []) if port not in self.neighbors.get(dpid, {})]
+
+    def port_to(self, dpid, peer):
+        """ Lowest port of dpid linked to peer, None when not linked """
+        self.refresh()
+        ports = [port for port, value in self.neighbors.get(dpid, {}).items() if value == peer]
+        return min(ports) if ports else None
+
+    def route(self, dpid, edge):
+        """ ECMP next hops of dpid toward edge switch """
+        self.refresh()
+        return self.next_hops.get(dpid, {}).get(edge, [])
+
+    def learn_host(self, ip, dpid, port):
+        """ Host behind a port of edge switch, return True when it is new or moved """
+        self.refresh()
+        if self.tiers.get(dpid) != 0 or port in self.neighbors[dpid] or self.hosts.get(ip) == (dpid, port):
+            return False
+        self.hosts[ip] = (dpid, port)
+        return True
+
+    def to_dict(self, paths=False):
+        self.refresh()
+        topology = {
+            'tiers': dict((str(dpid), tier) for dpid, tier in self.tiers.items()),
+            'links': sorted([dpid, port, peer] for (dpid, port), peer in self.links.items()),
+            'hosts': dict((int_to_ip(ip), list(loc)) for ip, loc in self.hosts.items())
+        }
+        if paths:
+            topology['paths'] = dict((str(dpid), dict((str(edge), ports) for edge, ports in hops.items()))
+                                     for dpid, hops in self.next_hops.items())
+        return topology
+
+class SharedStore(object):
+    """
+    LB state exchanged by sharded Ryu_LB workers on one box, a sqlite3 file
+    standing in for an external store (redis, etcd). Every shard replace its
+    own rows and read rows of the others:
+    - links    : (dpid, port, peer), LLDP link is found by master of its peer
+    - hosts    : (ip, dpid, port), learned at packet-in of owned leaves
+    - gateways : (dpid, rate) of owned spines
+    - packets  : (dpid, data) flooded to leaves of another shard, taken by their owner
+    Calls block on sqlite locks, Ryu_LB run them in a native thread (see
+    Ryu_LB.store_call) one at a time.
+    """
+    TABLES = {
+        'links': ('dpid', 'port', 'peer'),
+        'hosts': ('ip', 'dpid', 'port'),
+        'gateways': ('dpid', 'rate')
+    }
+
+    def __init__(self, path, shard):
+        self.shard = shard
+        self.conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        for table, columns in self.TABLES.items():
+            self.conn.execute('CREATE TABLE IF NOT EXISTS %s (shard INTEGER, %s)' % (table, ', '.join(columns)))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS packets (shard INTEGER, dpid INTEGER, data BLOB)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS generation (id INTEGER PRIMARY KEY, value INTEGER)')
+
+    def publish(self, table, rows):
+        """ Replace rows of this shard """
+        columns = self.TABLES[table]
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.execute('DELETE FROM %s WHERE shard = ?' % table, (self.shard,))
+            self.conn.executemany('INSERT INTO %s VALUES (?, %s)' % (table, ', '.join('?' * len(columns))),
+                                  [(self.shard,) + tuple(row) for row in rows])
+
+    def fetch(self, table):
+        """ Rows of the other shards """
+        columns = self.TABLES[table]
+        return self.conn.execute('SELECT %s FROM %s WHERE shard != ?' % (', '.join(columns), table), (self.shard,)).fetchall()
+
+    def relay(self, packets):
+        """ packets : [(shard, dpid, data)] to send out of leaves of other shards """
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('INSERT INTO packets VALUES (?, ?, ?)',
+                                  [(shard, dpid, sqlite3.Binary(data)) for shard, dpid, data in packets])
+
+    def take_packets(self):
+        """ Pop packets relayed to this shard, return [(dpid, data)] """
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            rows = self.conn.execute('SELECT dpid, data FROM packets WHERE shard = ?', (self.shard,)).fetchall()
+            self.conn.execute('DELETE FROM packets WHERE shard = ?', (self.shard,))
+        return [(dpid, str(data)) for dpid, data in rows]
+
+    def exchange(self, published, packets):
+        """
+        published : { table : rows of this shard }, packets : relayed packets,
+        return ({ table : rows of the other shards }, packets taken by this shard)
+        """
+        for table, rows in published.items():
+            self.publish(table, rows)
+        if packets:
+            self.relay(packets)
+        return dict((table, self.fetch(table)) for table in self.TABLES), self.take_packets()
+
+    def next_generation(self):
+        """ Increasing generation id of master/slave role requests, shared by all shards """
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.execute('INSERT OR IGNORE INTO generation VALUES (0, 0)')
+            self.conn.execute('UPDATE generation SET value = value + 1 WHERE id = 0')
+            return self.conn.execute('SELECT value FROM generation WHERE id = 0').fetchone()[0]
 
 class RESTHandler(ControllerBase):
     def __init__(self, req, link, data, **config):
@@ -24,8 +600,10 @@ class RESTHandler(ControllerBase):
     @route('lb', url+'mode', methods=['POST'])
     def set_lb_mode(self, req, **kwargs):
         req_body = json.loads(req.body)
-        self.lb_controller_app.lb_method = req_body['mode']
-        resp_body = json.dumps({ 'mode': req_body['mode'] })
+        self.lb_controller_app.set_lb_method(req_body['mode'])
+        if 'proactive' in req_body:
+            self.lb_controller_app.set_proactive(req_body['proactive'])
+        resp_body = json.dumps({ 'mode': req_body['mode'], 'proactive': self.lb_controller_app.proactive })
         return Response(content_type='application/json', body=resp_body)
 
     @route('lb', url+'time', methods=['GET'])
@@ -33,6 +611,111 @@ class RESTHandler(ControllerBase):
         resp_body = json.dumps({ 'time': self.lb_controller_app.lb_time })
         return Response(content_type='application/json', body=resp_body)
 
+    @route('lb', url+'group/weights', methods=['POST'])
+    def set_group_weights(self, req, **kwargs):
+        """ example input :
+        { "weights": { "201": [w_spine1, w_spine2, ...], ... } }
+        """
+        req_body = json.loads(req.body)
+        weights = dict((int(dpid), w) for dpid, w in req_body['weights'].items())
+        resp_body = json.dumps({ 'weights': self.lb_controller_app.set_group_weights(weights) })
+        return Response(content_type='application/json', body=resp_body)
+
+    @route('lb', url+'metrics', methods=['GET'])
+    def get_lb_metrics(self, req, **kwargs):
+        body = self.lb_controller_app.metrics.prometheus()
+        return Response(content_type='text/plain', charset='utf-8', body=body)
+
+    @route('lb', url+'stats', methods=['GET'])
+    def get_lb_stats(self, req, **kwargs):
+        """ example output :
+        {
+            "time" : ...,
+            "interval" : ...,
+            "spines" : [dpid, ...],
+            "leaves" : [dpid, ...],
+            "gateways" : { "101" : rx byte rate, ... },
+            "flows" : { "201" : [[ip_src, ip_dst, gw, rate], ...], ... },
+            "shard" : 0, "shards" : 1
+        }
+        sharded workers only report switches they are master of,
+        ips are integers, gw g is uplink toward spines[g-1], 0 is select group
+        aggregate of 10.0.<leaf>.0 or unknown
+        """
+        app = self.lb_controller_app
+        stats = app.stats.to_dict()
+        stats.update({ 'interval': app.poll_interval(), 'spines': sorted(app.sw_sp_list), 'leaves': sorted(app.sw_lf_list),
+                       'shard': app.shard, 'shards': app.shards })
+        return Response(content_type='application/json', body=json.dumps(stats))
+
+    @route('lb', url+'stats', methods=['POST'])
+    def set_lb_stats(self, req, **kwargs):
+        """ example input :
+        { "interval": 1 }
+        interval 0 stop polling, except spine port stats of least and p2c
+        methods (every load_interval)
+        """
+        req_body = json.loads(req.body)
+        self.lb_controller_app.stats_interval = float(req_body['interval'])
+        return Response(content_type='application/json', body=json.dumps({ 'interval': self.lb_controller_app.stats_interval }))
+
+    @route('lb', url+'topology', methods=['GET'])
+    def get_lb_topology(self, req, **kwargs):
+        """ example output :
+        {
+            "source" : "lldp",
+            "spines" : [dpid, ...],
+            "leaves" : [dpid, ...],
+            "uplinks" : { "201" : [port toward every spine], ... },
+            "tiers" : { "101" : 1, ... },
+            "links" : [[dpid, port, peer dpid], ...],
+            "hosts" : { "10.0.1.1" : [leaf dpid, port], ... }
+        }
+        source is addressing (dpid ranges) until the LLDP model settled,
+        paths=1 add ECMP next hops { "dpid" : { "leaf dpid" : [port, ...] } }
+        """
+        paths = req.GET.get('paths', '0') not in ('0', '')
+        resp_body = json.dumps(self.lb_controller_app.topology_status(paths))
+        return Response(content_type='application/json', body=resp_body)
+
+    @route('lb', url+'tables', methods=['GET'])
+    def get_lb_tables(self, req, **kwargs):
+        """ example output :
+        {
+            "idle_timeout" : 0, "hard_timeout" : 0, "capacity" : 0, "evict_fraction" : 0.1,
+            "rules" : { "201" : host rules count, ... },
+            "removed" : { "idle_timeout" : count, ... },
+            "evicted" : ...
+        }
+        """
+        resp_body = json.dumps(self.lb_controller_app.table_status())
+        return Response(content_type='application/json', body=resp_body)
+
+    @route('lb', url+'tables', methods=['POST'])
+    def set_lb_tables(self, req, **kwargs):
+        """ example input :
+        { "idle_timeout": 10, "hard_timeout": 0, "capacity": 1000, "evict_fraction": 0.1 }
+        timeouts apply to rules installed after the change, 0 is permanent / unlimited,
+        with a capacity flow stats are polled (every lru_interval when stats
+        are disabled) so that eviction pick least recently used rules
+        """
+        req_body = json.loads(req.body)
+        app = self.lb_controller_app
+        app.idle_timeout = int(req_body.get('idle_timeout', app.idle_timeout))
+        app.hard_timeout = int(req_body.get('hard_timeout', app.hard_timeout))
+        app.table_capacity = int(req_body.get('capacity', app.table_capacity))
+        app.evict_fraction = float(req_body.get('evict_fraction', app.evict_fraction))
+        return Response(content_type='application/json', body=json.dumps(app.table_status()))
+
+    @route('lb', url+'routes', methods=['POST'])
+    def set_routes(self, req, **kwargs):
+        """ example input :
+        { "routes": [[ip_src, ip_dst, gw], ...] }
+        """
+        req_body = json.loads(req.body)
+        resp_body = json.dumps(self.lb_controller_app.install_routes(req_body['routes']))
+        return Response(content_type='application/json', body=resp_body)
+
 class Ryu_LB(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
     _CONTEXTS = { 'wsgi': WSGIApplication }
@@ -50,15 +733,213 @@ class Ryu_LB(app_manager.RyuApp):
         self.spine_num = 0
         self.lb_method = 'rr'
         self.lb_time = 0
+        self.metrics = LBMetrics()
+        self.barrier_waiters = {}
+        self.barrier_timeout = 5
+        self.proactive = False
+        self.group_weights = {} # leaf dpid : bucket weight of every spine uplink
+        self.groups = {} # leaf dpid : spine number of installed select group
+        self.stats = StatsCollector()
+        self.stats_interval = 0 # seconds between stats requests, 0 is disabled
+        self.lru_interval = 1 # seconds between flow stats requests of LRU order when stats are disabled
+        self.load_interval = 1 # seconds between stats requests of load aware methods when stats are disabled
+        self.stats_thread = hub.spawn(self._stats_loop)
+        self.rule_table = RuleTable()
+        self.idle_timeout = 0 # host rules timeouts, 0 is permanent
+        self.hard_timeout = 0
+        self.table_capacity = 0 # host rules per switch before eviction, 0 is unlimited
+        self.evict_fraction = 0.1 # part of capacity evicted at once
+        self.spine_load = SpineLoad()
+        self.spines_pending = set() # spines whose port stats of the current round didn't come back
+        self.datapaths = {}
+        self.topology = Topology()
+        self.topology_pending = False
+        self.gateway_ports = {} # leaf dpid : uplink port toward every spine (spine_switch order)
+        self.port_gateway = {} # leaf dpid : { uplink port : gateway }, gateway is spine index+1
+        self.topology_delay = 1 # seconds without link event before roles are updated
+        # Sharded mode, worker LB_SHARD of LB_SHARDS is master of switches with dpid % LB_SHARDS == LB_SHARD
+        self.shard = int(os.environ.get('LB_SHARD', 0))
+        self.shards = int(os.environ.get('LB_SHARDS', 1))
+        self.store = None
+        self.remote_gateways = {} # spine dpid : rx byte rate polled by other shards
+        self.sync_interval = 0.5 # seconds between shared store exchanges
+        self.relay_queue = [] # (shard, dpid, data) flooded packets waiting for next exchange
+        self.roles = {} # dpid : role requested to the switch
+        self.role_retries = 3 # role requests of a switch after a rejected one
+        self.store_lock = hub.Semaphore(1)
+        if self.shards > 1:
+            self.store = SharedStore(os.environ.get('LB_STORE', '/tmp/ryu_lb_store.sqlite'), self.shard)
+            self.sync_thread = hub.spawn(self._sync_loop)
+
+    def owns(self, dpid):
+        return self.shards == 1 or dpid % self.shards == self.shard
+
+    def owned(self, datapaths):
+        """ Datapaths this shard is master of, other shards reject their flow mods """
+        return [datapath for datapath in datapaths if self.owns(datapath.id)]
 
     def find_spine_leaf(self):
-        self.spine_switch = list(self.sw_sp_list.keys())
-        self.leaf_switch = list(self.sw_lf_list.keys())
+        """
+        Spines and leaves are tier 1 and tier 0 of the topology model, or
+        follow dpid ranges (1xx spine, 2xx leaf) until the LLDP model settled.
+        Gateway g of a leaf is its uplink toward g-th spine, which is port g
+        in the addressing scheme.
+        """
+        if self.topology.linked():
+            spines = self.topology.tier(1)
+            leaves = self.topology.tier(0)
+        else:
+            spines = [dpid for dpid in self.datapaths if dpid // 100 == 1]
+            leaves = [dpid for dpid in self.datapaths if dpid // 100 != 1]
+        self.sw_sp_list = dict((dpid, self.datapaths[dpid]) for dpid in spines if dpid in self.datapaths)
+        self.sw_lf_list = dict((dpid, self.datapaths[dpid]) for dpid in leaves if dpid in self.datapaths)
+        self.spine_switch = sorted(self.sw_sp_list.keys())
+        self.leaf_switch = sorted(self.sw_lf_list.keys())
         self.spine_num = len(self.spine_switch)
+        self.gateway_ports = {}
+        for leaf in self.leaf_switch:
+            if self.topology.linked():
+                self.gateway_ports[leaf] = [self.topology.port_to(leaf, spine) for spine in self.spine_switch]
+            else:
+                self.gateway_ports[leaf] = range(1, self.spine_num+1)
+        self.port_gateway = dict((leaf, dict((port, i+1) for i, port in enumerate(ports) if port is not None))
+                                 for leaf, ports in self.gateway_ports.items())
+        self.spine_load.resize(self.spine_num)
         self.counter = {}
         for leaf in self.leaf_switch:
             self.counter[leaf] = -1
         print "Spine:", self.spine_switch, "Leaf:", self.leaf_switch, 'Spine_Num:', self.spine_num, 'Counter', self.counter, 'Algo', self.lb_method
+        if self.proactive:
+            self.install_proactive()
+        if self.lb_method == 'group' and self.spine_num > 0:
+            self.install_groups()
+
+    def set_lb_method(self, lb_method):
+        if self.lb_method == 'group' and lb_method != 'group':
+            self.remove_groups()
+        self.lb_method = lb_method
+        if self.lb_method == 'group' and self.spine_num > 0:
+            self.install_groups()
+
+    def remove_groups(self):
+        """ Leaving group mode, delete select groups and the /24 rules pointing to them """
+        for dpid in list(self.groups):
+            datapath = self.sw_lf_list.get(dpid)
+            if datapath is not None:
+                ofproto = datapath.ofproto
+                parser = datapath.ofproto_parser
+                self.del_flows(datapath, GROUP_COOKIE)
+                datapath.send_msg(parser.OFPGroupMod(datapath, ofproto.OFPGC_DELETE, ofproto.OFPGT_SELECT, LB_GROUP_ID, []))
+        self.groups = {}
+
+    def install_groups(self, dpids=None):
+        """
+        Group mode, every leaf has one OFPGT_SELECT group with a bucket for
+        every spine uplink, the switch hashes flows over buckets by their
+        weight.
+        """
+        for dpid in [dpid for dpid in dpids or list(self.sw_lf_list.keys()) if self.owns(dpid)]:
+            datapath = self.sw_lf_list[dpid]
+            ofproto = datapath.ofproto
+            parser = datapath.ofproto_parser
+            weights = self.group_weights.get(dpid)
+            if weights is None or len(weights) != self.spine_num:
+                weights = [1] * self.spine_num
+                self.group_weights[dpid] = weights
+            buckets = [parser.OFPBucket(weight=weight, watch_port=port, watch_group=ofproto.OFPG_ANY,
+                                        actions=[parser.OFPActionOutput(port)])
+                       for weight, port in zip(weights, self.gateway_ports[dpid]) if port is not None]
+            command = ofproto.OFPGC_MODIFY if dpid in self.groups else ofproto.OFPGC_ADD
+            mod = parser.OFPGroupMod(datapath, command, ofproto.OFPGT_SELECT, LB_GROUP_ID, buckets)
+            datapath.send_msg(mod)
+            self.groups[dpid] = self.spine_num
+
+    def set_group_weights(self, weights):
+        """ Rewrite bucket weights of leaves select group, return weights in use """
+        for dpid, leaf_weights in weights.items():
+            if dpid in self.sw_lf_list and len(leaf_weights) == self.spine_num:
+                self.group_weights[dpid] = [int(w) for w in leaf_weights]
+        if self.lb_method == 'group':
+            self.install_groups([dpid for dpid in weights if dpid in self.sw_lf_list])
+        return self.group_weights
+
+    def forward_group(self, datapath, msg):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        actions = [parser.OFPActionGroup(LB_GROUP_ID)]
+        out = parser.OFPPacketOut(datapath=datapath, actions=actions, in_port=msg.match['in_port'], data=msg.data, buffer_id=ofproto.OFP_NO_BUFFER)
+        datapath.send_msg(out)
+
+    def mod_group_flow(self, datapath, ip4_dst):
+        """ One rule per destination leaf (10.0.<leaf>.0/24) pointing to select group """
+        parser = datapath.ofproto_parser
+        subnet = (ip4_dst & 0xffffff00, 0xffffff00)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Flow: all -> %s/24 via leaf_%s group %s", int_to_ip(subnet[0]), datapath.id, LB_GROUP_ID)
+        actions = [parser.OFPActionGroup(LB_GROUP_ID)]
+        self.add_flow(datapath, 1, parser.OFPMatch(eth_type=0x0806, arp_tpa=subnet), actions, cookie=GROUP_COOKIE)
+        self.add_flow(datapath, 1, parser.OFPMatch(eth_type=0x800, ipv4_dst=subnet), actions, cookie=GROUP_COOKIE)
+
+    def set_proactive(self, proactive):
+        self.proactive = bool(proactive)
+        if self.proactive:
+            self.install_proactive()
+        else:
+            for datapath in self.owned(list(self.sw_sp_list.values()) + list(self.sw_lf_list.values())):
+                self.del_flows(datapath, PROACTIVE_COOKIE)
+
+    def install_proactive(self):
+        """
+        Proactive mode, destination rules follow addressing scheme so they are
+        installed when switch join, only uplink choice at source leaf (the
+        load balancing decision) is left to packet-in:
+        - spine : 10.0.<leaf>.0/24 -> port <leaf>+1
+        - leaf  : 10.0.<leaf>.<host> -> port spine_num+<host>, for every host port
+        Rules are reinstalled on every topology change because host ports
+        depend on number of spines. With the topology model, rules follow
+        learned hosts instead (see install_host_routes).
+        """
+        if self.topology.linked():
+            for datapath in self.owned(self.datapaths.values()):
+                self.del_flows(datapath, PROACTIVE_COOKIE)
+            for ip in list(self.topology.hosts):
+                self.install_host_routes(ip)
+            return
+        for datapath in self.owned(self.sw_sp_list.values()):
+            parser = datapath.ofproto_parser
+            self.del_flows(datapath, PROACTIVE_COOKIE)
+            for leaf in self.leaf_switch:
+                subnet = ('10.0.%s.0' % (leaf % 100), '255.255.255.0')
+                actions = [parser.OFPActionOutput(leaf % 100 + 1, 0)]
+                self.add_flow(datapath, 1, parser.OFPMatch(eth_type=0x0806, arp_tpa=subnet), actions, cookie=PROACTIVE_COOKIE)
+                self.add_flow(datapath, 1, parser.OFPMatch(eth_type=0x800, ipv4_dst=subnet), actions, cookie=PROACTIVE_COOKIE)
+        for datapath in self.owned(self.sw_lf_list.values()):
+            ofproto = datapath.ofproto
+            parser = datapath.ofproto_parser
+            self.del_flows(datapath, PROACTIVE_COOKIE)
+            for port in [port for port in datapath.ports if self.spine_num < port < ofproto.OFPP_MAX]:
+                host = '10.0.%s.%s' % (datapath.id % 100, port - self.spine_num)
+                actions = [parser.OFPActionOutput(port, 0)]
+                self.add_flow(datapath, 1, parser.OFPMatch(eth_type=0x0806, arp_tpa=host), actions, cookie=PROACTIVE_COOKIE)
+                self.add_flow(datapath, 1, parser.OFPMatch(eth_type=0x800, ipv4_dst=host), actions, cookie=PROACTIVE_COOKIE)
+
+    def install_host_routes(self, ip):
+        """
+        Proactive rules toward a learned host: at its edge switch and at
+        every other switch where only one next hop lead to it, source edge
+        switches are left to packet-in.
+        """
+        edge, host_port = self.topology.hosts[ip]
+        host = int_to_ip(ip)
+        for datapath in self.owned(self.datapaths.values()):
+            dpid = datapath.id
+            ports = [host_port] if dpid == edge else self.topology.route(dpid, edge)
+            if len(ports) != 1 or (dpid != edge and dpid in self.sw_lf_list):
+                continue
+            parser = datapath.ofproto_parser
+            actions = [parser.OFPActionOutput(ports[0], 0)]
+            self.add_flow(datapath, 1, parser.OFPMatch(eth_type=0x0806, arp_tpa=host), actions, cookie=PROACTIVE_COOKIE)
+            self.add_flow(datapath, 1, parser.OFPMatch(eth_type=0x800, ipv4_dst=host), actions, cookie=PROACTIVE_COOKIE)
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
@@ -70,15 +951,258 @@ class Ryu_LB(app_manager.RyuApp):
                                           ofproto.OFPCML_NO_BUFFER)]
         self.add_flow(datapath, 0, match, actions)
 
-    def add_flow(self, datapath, priority, match, actions):
+    def add_flow(self, datapath, priority, match, actions, command=None, cookie=0, idle_timeout=0, hard_timeout=0, flags=0):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
+        if command is None:
+            command = ofproto.OFPFC_ADD
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
                                              actions)]
-        mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
-                                match=match, instructions=inst)
+        mod = parser.OFPFlowMod(datapath=datapath, priority=priority, cookie=cookie,
+                                command=command, match=match, instructions=inst,
+                                idle_timeout=idle_timeout, hard_timeout=hard_timeout, flags=flags)
+        datapath.send_msg(mod)
+
+    def table_status(self):
+        return {
+            'idle_timeout': self.idle_timeout,
+            'hard_timeout': self.hard_timeout,
+            'capacity': self.table_capacity,
+            'evict_fraction': self.evict_fraction,
+            'rules': dict((str(dpid), self.rule_table.count(dpid)) for dpid in self.rule_table.rules),
+            'removed': dict(self.rule_table.removed),
+            'evicted': self.rule_table.evicted
+        }
+
+    def topology_status(self, paths=False):
+        status = self.topology.to_dict(paths)
+        status.update({
+            'source': 'lldp' if self.topology.linked() else 'addressing',
+            'spines': self.spine_switch,
+            'leaves': self.leaf_switch,
+            'uplinks': dict((str(dpid), ports) for dpid, ports in self.gateway_ports.items())
+        })
+        return status
+
+    def host_match(self, parser, key):
+        """ OFPMatch of host rule (eth_type, ip_src, ip_dst), ip_src 0 is wildcard """
+        eth_type, ip4_src, ip4_dst = key
+        if eth_type == ether_types.ETH_TYPE_ARP:
+            if ip4_src == 0:
+                return parser.OFPMatch(eth_type=eth_type, arp_tpa=ip4_dst)
+            return parser.OFPMatch(eth_type=eth_type, arp_spa=ip4_src, arp_tpa=ip4_dst)
+        if ip4_src == 0:
+            return parser.OFPMatch(eth_type=eth_type, ipv4_dst=ip4_dst)
+        return parser.OFPMatch(eth_type=eth_type, ipv4_src=ip4_src, ipv4_dst=ip4_dst)
+
+    def evict_rules(self, datapath):
+        """ Delete least recently used host rules when switch reach table capacity """
+        if self.table_capacity <= 0 or self.rule_table.count(datapath.id) < self.table_capacity:
+            return
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        num = max(1, int(self.table_capacity*self.evict_fraction))
+        for key in self.rule_table.evict(datapath.id, num):
+            mod = parser.OFPFlowMod(datapath=datapath, priority=1, command=ofproto.OFPFC_DELETE_STRICT,
+                                    out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY,
+                                    match=self.host_match(parser, key))
+            datapath.send_msg(mod)
+
+    def host_key(self, match):
+        """ Key of host rule match (see host_match), None for other rules """
+        eth_type = match.get('eth_type')
+        if eth_type == ether_types.ETH_TYPE_ARP:
+            ip_src, ip_dst = match.get('arp_spa'), match.get('arp_tpa')
+        else:
+            ip_src, ip_dst = match.get('ipv4_src'), match.get('ipv4_dst')
+        if ip_dst is None or isinstance(ip_dst, tuple):
+            return None
+        return (eth_type, ip_to_int(ip_src) if ip_src is not None else 0, ip_to_int(ip_dst))
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, ev):
+        msg = ev.msg
+        key = self.host_key(msg.match)
+        if key is None:
+            return
+        rule = self.rule_table.remove(msg.datapath.id, key, msg.reason)
+        if rule is not None and key[0] == ether_types.ETH_TYPE_IP and key[1] != 0:
+            gw = self.port_gateway.get(msg.datapath.id, {}).get(rule[1])
+            if gw is not None:
+                # Host flow at source leaf, its bytes went through spine of the uplink
+                self.spine_load.removed(gw - 1, msg.byte_count, time.time())
+
+    def del_flows(self, datapath, cookie):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        mod = parser.OFPFlowMod(datapath=datapath, cookie=cookie, cookie_mask=0xffffffffffffffff,
+                                command=ofproto.OFPFC_DELETE, out_port=ofproto.OFPP_ANY,
+                                out_group=ofproto.OFPG_ANY, match=parser.OFPMatch())
         datapath.send_msg(mod)
 
+    def send_barrier(self, datapath):
+        """ Send barrier request, return its xid and event that is set when reply come back """
+        parser = datapath.ofproto_parser
+        req = parser.OFPBarrierRequest(datapath)
+        datapath.set_xid(req)
+        waiter = hub.Event()
+        self.barrier_waiters[(datapath.id, req.xid)] = waiter
+        datapath.send_msg(req)
+        return req.xid, waiter
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def _barrier_reply_handler(self, ev):
+        msg = ev.msg
+        waiter = self.barrier_waiters.pop((msg.datapath.id, msg.xid), None)
+        if waiter is not None:
+            waiter.set()
+
+    def install_routes(self, routes):
+        """
+        Modify host flow of every route at its source leaf (see locate), gw
+        is turned into the uplink port toward that spine. Flow mods of a
+        switch are sent back to back and closed by one barrier, leaves of other
+        shards are left to them. Return timing of every switch.
+        """
+        time1 = time.time()
+        per_leaf = {}
+        for ip_src, ip_dst, gw in [route[:3] for route in routes]:
+            ip_src = ip_to_int(ip_src)
+            loc = self.locate(ip_src)
+            dpid = loc[0] if loc is not None else None
+            per_leaf.setdefault(dpid, []).append((ip_src, ip_to_int(ip_dst), int(gw)))
+        switches = {}
+        waiters = {}
+        for dpid, leaf_routes in per_leaf.items():
+            if dpid is not None and not self.owns(dpid):
+                # Installed by the shard that is master of the leaf
+                continue
+            datapath = self.sw_lf_list.get(dpid)
+            if datapath is None:
+                switches[dpid] = { 'flows': len(leaf_routes), 'error': 'unknown switch' }
+                continue
+            time2 = time.time()
+            ports = self.gateway_ports[dpid]
+            for ip_src, ip_dst, gw in leaf_routes:
+                if 0 < gw <= len(ports) and ports[gw-1] is not None:
+                    self.mod_host_flow(datapath, ip_src, ip_dst, ports[gw-1], datapath.ofproto.OFPFC_MODIFY)
+            waiters[dpid] = self.send_barrier(datapath)
+            switches[dpid] = { 'flows': len(leaf_routes), 'send_time': time.time()-time2 }
+        for dpid, (xid, waiter) in waiters.items():
+            ack = waiter.wait(timeout=self.barrier_timeout)
+            self.barrier_waiters.pop((dpid, xid), None)
+            switches[dpid]['barrier_time'] = time.time()-time1 if ack else None
+        return { 'flows': len(routes), 'switches': switches, 'time': time.time()-time1 }
+
+    def poll_interval(self):
+        """ Seconds between stats requests, least and p2c need spine rates even when stats are disabled """
+        if self.stats_interval > 0:
+            return self.stats_interval
+        if self.lb_method in ('least', 'p2c'):
+            return self.load_interval
+        return 0
+
+    def _stats_loop(self):
+        while True:
+            interval = self.poll_interval()
+            if interval > 0:
+                self.request_stats()
+                hub.sleep(interval)
+            elif self.table_capacity > 0:
+                # LRU order of host rules follow their byte counters
+                self.request_flow_stats(self.owned(self.datapaths.values()))
+                hub.sleep(self.lru_interval)
+            else:
+                hub.sleep(1)
+
+    def request_flow_stats(self, datapaths):
+        now = time.time()
+        for datapath in datapaths:
+            ofproto = datapath.ofproto
+            parser = datapath.ofproto_parser
+            req = parser.OFPFlowStatsRequest(datapath, 0, ofproto.OFPTT_ALL, ofproto.OFPP_ANY, ofproto.OFPG_ANY,
+                                             0, 0, parser.OFPMatch())
+            datapath.set_xid(req)
+            self.stats.request(datapath.id, req.xid, now)
+            datapath.send_msg(req)
+
+    def request_stats(self):
+        """
+        Flow stats of every leaf and port stats of every spine, replies come
+        back as events. With table capacity, flow stats of spines too for
+        the LRU order of their host rules.
+        """
+        now = time.time()
+        if self.table_capacity > 0:
+            self.request_flow_stats(self.owned(self.datapaths.values()))
+        else:
+            self.request_flow_stats(self.owned(self.sw_lf_list.values()))
+        spines = self.owned(self.sw_sp_list.values())
+        self.spines_pending = set(datapath.id for datapath in spines)
+        for datapath in spines:
+            ofproto = datapath.ofproto
+            parser = datapath.ofproto_parser
+            req = parser.OFPPortStatsRequest(datapath, 0, ofproto.OFPP_ANY)
+            datapath.set_xid(req)
+            self.stats.request(datapath.id, req.xid, now)
+            datapath.send_msg(req)
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def _flow_stats_reply_handler(self, ev):
+        msg = ev.msg
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        done = self.stats.reply(datapath.id, msg.xid, msg.body, msg.flags & ofproto.OFPMPF_REPLY_MORE, time.time())
+        if done is None:
+            return
+        timestamp, body = done
+        # Host rules that forwarded bytes since last stats are recently used
+        used = {}
+        for stat in body:
+            if stat.cookie == HOST_COOKIE:
+                key = self.host_key(stat.match)
+                if key is not None:
+                    used[key] = stat.byte_count
+        self.rule_table.used(datapath.id, used)
+        if datapath.id not in self.sw_lf_list:
+            return
+        counters = {}
+        port_gateway = self.port_gateway.get(datapath.id, {})
+        for stat in body:
+            match = stat.match
+            if match.get('eth_type') != ether_types.ETH_TYPE_IP or 'ipv4_dst' not in match or len(stat.instructions) == 0:
+                continue
+            action = stat.instructions[0].actions[0]
+            if action.type == ofproto.OFPAT_GROUP:
+                # Select group mode: aggregate of the leaf to one destination leaf, gateway is unknown
+                ip_dst = match['ipv4_dst']
+                ip_dst = ip_dst[0] if isinstance(ip_dst, tuple) else ip_dst
+                key = (ip_to_int('10.0.%s.0' % (datapath.id % 100)), ip_to_int(ip_dst))
+                counters[key] = (0, stat.byte_count)
+            elif action.type == ofproto.OFPAT_OUTPUT and 'ipv4_src' in match:
+                # Gateway 0 is unknown, output is not a spine uplink
+                counters[(ip_to_int(match['ipv4_src']), ip_to_int(match['ipv4_dst']))] = (port_gateway.get(action.port, 0), stat.byte_count)
+        self.stats.update_flows(datapath.id, timestamp, counters)
+
+    @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
+    def _port_stats_reply_handler(self, ev):
+        msg = ev.msg
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        done = self.stats.reply(datapath.id, msg.xid, msg.body, msg.flags & ofproto.OFPMPF_REPLY_MORE, time.time())
+        if done is None:
+            return
+        timestamp, body = done
+        rx_bytes = sum(stat.rx_bytes for stat in body if stat.port_no < ofproto.OFPP_MAX)
+        self.stats.update_ports(datapath.id, timestamp, rx_bytes)
+        self.spines_pending.discard(datapath.id)
+        if self.spines_pending:
+            # Load aware methods are fed once per polling round, with rates of every spine
+            return
+        rates = [self.stats.gateways.get(dpid, self.remote_gateways.get(dpid, 0.0)) for dpid in self.spine_switch]
+        flows_num = sum(len(flows) for flows in self.stats.flows.values())
+        self.spine_load.measure(rates, flows_num, time.time())
+
     def forward_packet(self, datapath, msg, outport):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
@@ -86,64 +1210,151 @@ class Ryu_LB(app_manager.RyuApp):
         out = parser.OFPPacketOut(datapath=datapath, actions=actions, in_port=msg.match['in_port'], data=msg.data, buffer_id=ofproto.OFP_NO_BUFFER)
         datapath.send_msg(out)
 
-    def mod_host_flow(self, datapath, ip4_src, ip4_dst, outport):
+    def mod_host_flow(self, datapath, ip4_src, ip4_dst, outport, command=None, eth_types=None):
+        """ ARP and IPv4 rules of the pair, or only the `eth_types` ones """
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
-        if ip4_src!='0.0.0.0':
-            self.logger.info("Flow: %s -> %s via gateway %s" % (ip4_src, ip4_dst, outport))
-            match_ip = parser.OFPMatch(
-                           eth_type = 0x800,
-                           ipv4_src = ip4_src,
-                           ipv4_dst = ip4_dst
-                       )
-            match_arp = parser.OFPMatch(
-                           eth_type = 0x0806,
-                           arp_spa = ip4_src,
-                           arp_tpa = ip4_dst
-                       )
-        else:
-            self.logger.info("Flow: all -> %s, via leaf_%s:%s" % (ip4_dst, datapath.id, outport))
-            match_ip = parser.OFPMatch(
-                           eth_type = 0x800,
-                           ipv4_dst = ip4_dst
-                       )
-            match_arp = parser.OFPMatch(
-                           eth_type = 0x0806,
-                           arp_tpa = ip4_dst
-                       )
+        if self.logger.isEnabledFor(logging.DEBUG):
+            if ip4_src!=0:
+                self.logger.debug("Flow: %s -> %s via gateway %s", int_to_ip(ip4_src), int_to_ip(ip4_dst), outport)
+            else:
+                self.logger.debug("Flow: all -> %s, via leaf_%s:%s", int_to_ip(ip4_dst), datapath.id, outport)
+        keys = [(eth_type, ip4_src, ip4_dst) for eth_type in eth_types or (ether_types.ETH_TYPE_ARP, ether_types.ETH_TYPE_IP)]
         actions = [parser.OFPActionOutput(outport,0)]
-        self.add_flow(datapath, 1, match_arp, actions)
-        self.add_flow(datapath, 1, match_ip, actions)
+        if command is not None and command != ofproto.OFPFC_ADD:
+            # Modify keep timeouts and LRU position of installed rules
+            for key in keys:
+                self.add_flow(datapath, 1, self.host_match(parser, key), actions, command)
+                self.rule_table.set_port(datapath.id, key, outport)
+            return
+        self.evict_rules(datapath)
+        now = time.time()
+        for key in keys:
+            self.add_flow(datapath, 1, self.host_match(parser, key), actions, command, cookie=HOST_COOKIE,
+                          idle_timeout=self.idle_timeout, hard_timeout=self.hard_timeout,
+                          flags=ofproto.OFPFF_SEND_FLOW_REM)
+            self.rule_table.add(datapath.id, key, now, outport)
 
-    def _round_robin(self, dpid):
-        self.counter[dpid] += 1
-        if self.counter[dpid] == self.spine_num:
+    def _round_robin(self, dpid, num):
+        self.counter[dpid] = self.counter.get(dpid, -1) + 1
+        if self.counter[dpid] >= num:
             self.counter[dpid] = 0
         return self.counter[dpid]
 
     def _ip_hashing(self, ip_src, ip_dst, sp_num):
-        ip1 = int(hex(netaddr.IPAddress(ip_src)), 16)
-        ip2 = int(hex(netaddr.IPAddress(ip_dst)), 16)
-        xor_mod = (ip1 ^ ip2) % sp_num
+        xor_mod = (ip_src ^ ip_dst) % sp_num
         return xor_mod
 
+    def switch_role(self, dpid):
+        if dpid in self.sw_sp_list:
+            return 'Spine Switch'
+        if dpid in self.sw_lf_list:
+            return 'Leaf Switch'
+        return 'Switch'
+
+    def store_call(self, fn, *args):
+        """ Blocking SharedStore call in a native thread, the eventlet hub keep serving switches """
+        with self.store_lock:
+            return tpool.execute(fn, *args)
+
+    def request_role(self, datapath, retries=None):
+        """
+        Master of owned switches and slave of others, packet-ins of a switch
+        only reach its master. Generation id come from the shared counter,
+        a request rejected as stale is sent again with a new one (see
+        _error_msg_handler), at most role_retries times.
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        role = ofproto.OFPCR_ROLE_MASTER if self.owns(datapath.id) else ofproto.OFPCR_ROLE_SLAVE
+        generation = self.store_call(self.store.next_generation)
+        self.roles[datapath.id] = (role, self.role_retries if retries is None else retries)
+        datapath.send_msg(parser.OFPRoleRequest(datapath, role, generation))
+
+    def retry_role(self, datapath, reason):
+        role, retries = self.roles.get(datapath.id, (None, 0))
+        if retries <= 0 or datapath.id not in self.datapaths:
+            self.logger.error('Role of switch %s not set (%s)', datapath.id, reason)
+            return
+        self.logger.warning('Role of switch %s not set (%s), retrying', datapath.id, reason)
+        hub.spawn(self.request_role, datapath, retries-1)
+
+    @set_ev_cls(ofp_event.EventOFPRoleReply, MAIN_DISPATCHER)
+    def _role_reply_handler(self, ev):
+        msg = ev.msg
+        role = self.roles.get(msg.datapath.id, (None, 0))[0]
+        if role is not None and msg.role != role:
+            self.retry_role(msg.datapath, 'role %s in reply, %s requested' % (msg.role, role))
+
+    @set_ev_cls(ofp_event.EventOFPErrorMsg, MAIN_DISPATCHER)
+    def _error_msg_handler(self, ev):
+        msg = ev.msg
+        if msg.type == msg.datapath.ofproto.OFPET_ROLE_REQUEST_FAILED and self.store is not None:
+            self.retry_role(msg.datapath, 'role request failed with code %s' % msg.code)
+
+    def _sync_loop(self):
+        while True:
+            hub.sleep(self.sync_interval)
+            try:
+                self.sync_store()
+            except sqlite3.Error as e:
+                self.logger.warning('Shared store sync failed: %s', e)
+
+    def sync_store(self):
+        """
+        Publish links, hosts and spine rates found by this shard and relay
+        packets flooded to leaves of other shards, merge the ones of other
+        shards and send packets they flooded to owned leaves. sqlite calls
+        run in a native thread (store_call), the model is updated here.
+        """
+        topology = self.topology
+        published = {
+            'links': [(dpid, port, peer) for (dpid, port), peer in topology.links.items() if self.owns(peer)],
+            'hosts': [(ip, dpid, port) for ip, (dpid, port) in topology.hosts.items() if self.owns(dpid)],
+            'gateways': self.stats.gateways.items()
+        }
+        packets, self.relay_queue = self.relay_queue, []
+        fetched, taken = self.store_call(self.store.exchange, published, packets)
+        links = dict(((dpid, port), peer) for dpid, port, peer in fetched['links'])
+        changed = False
+        for key, peer in topology.links.items():
+            if not self.owns(peer) and links.get(key) != peer:
+                changed = topology.del_link(*key) or changed
+        for (dpid, port), peer in links.items():
+            if not self.owns(peer):
+                changed = topology.add_link(dpid, port, peer) or changed
+        if changed:
+            self.topology_changed()
+        hosts = dict((ip, (dpid, port)) for ip, dpid, port in fetched['hosts'])
+        for ip, (dpid, port) in topology.hosts.items():
+            if not self.owns(dpid) and ip not in hosts:
+                del topology.hosts[ip]
+        topology.hosts.update((ip, loc) for ip, loc in hosts.items() if not self.owns(loc[0]))
+        self.remote_gateways = dict(fetched['gateways'])
+        if self.remote_gateways and not any(self.owns(dpid) for dpid in self.spine_switch):
+            # No spine polled here, load aware methods follow the other shards
+            rates = [self.remote_gateways.get(dpid, 0.0) for dpid in self.spine_switch]
+            self.spine_load.measure(rates, sum(len(flows) for flows in self.stats.flows.values()), time.time())
+        for dpid, data in taken:
+            if dpid in self.datapaths:
+                self.output_hosts(self.datapaths[dpid], data)
+
     def _add_switch(self, dp):
-        if(dp.id // 100) == 1:
-            self.sw_sp_list[dp.id] = dp
-            msg = 'Spine Switch'
-        else:
-            self.sw_lf_list[dp.id] = dp
-            msg = 'Leaf Switch'
-        print 'Switch join dpid=%s as %s' % (dp.id, msg)
+        self.datapaths[dp.id] = dp
+        if self.store is not None:
+            hub.spawn(self.request_role, dp)
+        self.topology.add_switch(dp.id, dp.ports)
         self.find_spine_leaf()
-    
+        print 'Switch join dpid=%s as %s' % (dp.id, self.switch_role(dp.id))
+
     def _del_switch(self, dp):
-        if(dp.id // 100) == 1:
-            del self.sw_sp_list[dp.id]
-            msg = 'Spine Switch'
-        else:
-            del self.sw_lf_list[dp.id]
-            msg = 'Leaf Switch'
+        msg = self.switch_role(dp.id)
+        self.datapaths.pop(dp.id, None)
+        self.topology.del_switch(dp.id)
+        self.groups.pop(dp.id, None)
+        self.roles.pop(dp.id, None)
+        self.stats.drop(dp.id)
+        self.rule_table.drop(dp.id)
         print 'Switch quit dpid=%s as %s' % (dp.id, msg)
         self.find_spine_leaf()
 
@@ -160,69 +1371,183 @@ class Ryu_LB(app_manager.RyuApp):
         elif ev.state == handler.DEAD_DISPATCHER:
             self._del_switch(dp)
 
-    def _find_route(self, datapath, ip_src, ip_dst, msg):
-        ip_src_split = ip_src.split('.') # Splitting IP into segments array [0, 1, 2, 3], 2nd is Leaf id, and 3rd is host id in leaf
-        ip_dst_split = ip_dst.split('.')
-        outport = 1
+    @set_ev_cls(topo_event.EventLinkAdd)
+    def _link_add_handler(self, ev):
+        src = ev.link.src
+        if self.topology.add_link(src.dpid, src.port_no, ev.link.dst.dpid):
+            self.topology_changed()
+
+    @set_ev_cls(topo_event.EventLinkDelete)
+    def _link_delete_handler(self, ev):
+        src = ev.link.src
+        if self.topology.del_link(src.dpid, src.port_no):
+            self.topology_changed()
+
+    def topology_changed(self):
+        """ LLDP report links one by one, roles and groups are updated once they settle """
+        if not self.topology_pending:
+            self.topology_pending = True
+            hub.spawn_after(self.topology_delay, self._apply_topology)
+
+    def _apply_topology(self):
+        linked = self.topology.linked()
+        self.topology_pending = False
+        if self.topology.settle() and not self.topology.linked():
+            # Discovery still going on, check again after a quiet delay
+            self.topology_changed()
+        if self.topology.linked() and not linked:
+            self.flush_host_rules()
+        self.find_spine_leaf()
+
+    def flush_host_rules(self):
+        """ Topology source changed, reactive host rules may point to wrong ports """
+        for datapath in self.owned(self.datapaths.values()):
+            self.del_flows(datapath, HOST_COOKIE)
+            self.rule_table.drop(datapath.id)
+
+    def locate(self, ip):
+        """
+        (leaf dpid, port) of host, learned from its packets or from the
+        addressing scheme (10.0.<leaf>.<host> is on port spine_num+<host> of
+        dpid 200+<leaf>). None when that guess is not a host port of the
+        topology model.
+        """
+        loc = self.topology.hosts.get(ip)
+        if loc is not None:
+            return loc
+        dpid = 200 + ((ip >> 8) & 0xff)
+        uplinks = [port for port in self.gateway_ports.get(dpid, ()) if port is not None]
+        port = len(uplinks) + (ip & 0xff)
+        if self.topology.linked() and port not in self.topology.host_ports(dpid):
+            return None
+        return dpid, port
+
+    def route_ports(self, dpid, ip_dst):
+        """
+        Return (candidate output ports toward ip_dst, balance), balance is
+        True at source leaf and where paths split, packet then take a port
+        chosen by lb method and get a per flow rule. None when destination
+        is unknown.
+        """
+        if not self.topology.linked():
+            # IPs are integers, 3rd octet is Leaf id and 4th is host id in leaf
+            dst_leaf = (ip_dst >> 8) & 0xff
+            if dpid // 100 == 1:
+                # Packet come from Spine Switch
+                return [dst_leaf + 1], False # +1 because port 0 is for controller connection
+            if dpid % 100 == dst_leaf:
+                # Packet come from leaf switch that link with destination host
+                return [self.spine_num + (ip_dst & 0xff)], False
+            # Packet come from leaf switch that link with source host
+            ports = self.gateway_ports.get(dpid)
+            return (ports, True) if ports else None
+        loc = self.locate(ip_dst)
+        if loc is None:
+            return None
+        if loc[0] == dpid:
+            return [loc[1]], False
+        ports = self.topology.route(dpid, loc[0])
+        if len(ports) == 0:
+            return None
+        return ports, len(ports) > 1 or dpid in self.sw_lf_list
+
+    def choose_port(self, dpid, ports, ip_src, ip_dst):
+        """ LB decision between candidate ports """
+        if self.lb_method=='rr':
+            return ports[self._round_robin(dpid, len(ports))]
+        if self.lb_method in ('least', 'p2c'):
+            gateways = self.port_gateway.get(dpid, {})
+            candidates = [gateways[port]-1 for port in ports if port in gateways]
+            # Load is only known for spines, paths splitting above them are hashed
+            if len(candidates) == len(ports):
+                choose = self.spine_load.least if self.lb_method=='least' else self.spine_load.p2c
+                return self.gateway_ports[dpid][choose(candidates)]
+        return ports[self._ip_hashing(ip_src, ip_dst, len(ports))]
+
+    def flood_hosts(self, datapath, msg):
+        """
+        Destination is not learned yet, send packet out of host ports of
+        every leaf, the reply of the host teach its location.
+        """
+        for dpid in self.leaf_switch:
+            if not self.owns(dpid):
+                # Slave can't send packet out, master of the leaf will after next exchange
+                self.relay_queue.append((dpid % self.shards, dpid, msg.data))
+                continue
+            exclude = msg.match['in_port'] if dpid == datapath.id else None
+            self.output_hosts(self.datapaths[dpid], msg.data, exclude)
+
+    def output_hosts(self, datapath, data, exclude=None):
+        """ Packet out of every host port of leaf, never out of an uplink """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        if self.topology.linked():
+            ports = self.topology.host_ports(datapath.id)
+        else:
+            # Addressing scheme, host ports follow the uplinks
+            ports = [port for port in self.topology.ports.get(datapath.id, []) if port > len(self.gateway_ports.get(datapath.id, ()))]
+        actions = [parser.OFPActionOutput(port) for port in ports if port != exclude]
+        if actions:
+            out = parser.OFPPacketOut(datapath=datapath, actions=actions, in_port=ofproto.OFPP_CONTROLLER, data=data, buffer_id=ofproto.OFP_NO_BUFFER)
+            datapath.send_msg(out)
+
+    def _find_route(self, datapath, ethertype, ip_src, ip_dst, msg):
         dpid = datapath.id
-        if dpid // 100 == 1:
-            """
-            If packet come from Spine Switch
-            """
-            outport = int(ip_dst_split[2]) + 1 # +1 because port 0 is for controller connection
-            ip_src = '0.0.0.0'
+        route = self.route_ports(dpid, ip_dst)
+        if route is None:
+            self.flood_hosts(datapath, msg)
+            return
+        ports, balance = route
+        eth_types = None
+        if not balance:
+            outport = ports[0]
+            ip_src = 0
         else:
-            if dpid % 100 == int(ip_dst_split[2]):
-                """
-                If Packet come from leaf switch that link with destination host
-                """
-                outport = self.spine_num + int(ip_dst_split[3])
-                ip_src = '0.0.0.0'
+            if self.lb_method=='group' and dpid in self.groups:
+                # Spine is chosen by select group hashing in the switch
+                self.forward_group(datapath, msg)
+                self.mod_group_flow(datapath, ip_dst)
+                return
+            # ARP and IPv4 rules of a pair idle out apart, the one left keep its
+            # (maybe optimized) gateway and only the missing rule is installed
+            outport = self.rule_table.port(dpid, RuleTable.partner((ethertype, ip_src, ip_dst)))
+            if outport is not None:
+                eth_types = [ethertype]
             else:
-                """
-                If Packet come from leaf switch that link with source host
-                """
-                if self.lb_method=='rr':
-                    time1 = time.time()
-                    outport = self._round_robin(dpid) + 1 # +1 because port 0 is for controller connection
-                    self.lb_time += time.time()-time1
-                else:
-                    time1 = time.time()
-                    outport = self._ip_hashing(ip_src, ip_dst, self.spine_num) + 1 # +1 because port 0 is for controller connection
-                    self.lb_time += time.time()-time1
-                print 'Packet (', ip_src, ip_dst ,') in', dpid, '->',outport
+                time1 = time.time()
+                outport = self.choose_port(dpid, ports, ip_src, ip_dst)
+                lb_time = time.time()-time1
+                self.lb_time += lb_time
+                self.metrics.observe('lb_decision', dpid, self.lb_method, lb_time)
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("Packet (%s %s) in %s -> %s", int_to_ip(ip_src), int_to_ip(ip_dst), dpid, outport)
         # Forward current packet
+        time1 = time.time()
         self.forward_packet(datapath, msg, outport)
+        time2 = time.time()
         # Create new flow rule to avoid same packet forwarded into controller in future
-        self.mod_host_flow(datapath, ip_src, ip_dst, outport)
+        self.mod_host_flow(datapath, ip_src, ip_dst, outport, eth_types=eth_types)
+        self.metrics.observe('forward_packet', dpid, self.lb_method, time2-time1)
+        self.metrics.observe('mod_host_flow', dpid, self.lb_method, time.time()-time2)
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
+        time1 = time.time()
         msg = ev.msg
-        datapath = msg.datapath
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
-        in_port = msg.match['in_port']
-        pkt = packet.Packet(msg.data)
-        eth_pkt = pkt.get_protocols(ethernet.ethernet)[0]
-        if eth_pkt.ethertype == ether_types.ETH_TYPE_LLDP:
-            # ignore lldp packet
+        ethertype, ip_src, ip_dst = parse_packet_in(msg.data)
+        if ip_src is None:
+            # ignore lldp and other non ARP/IPv4 packet
             return
-        dpid = datapath.id
-        outport = 0
-        if len(pkt.get_protocols(ipv4.ipv4))>0 :
-            ip4_pkt = pkt.get_protocols(ipv4.ipv4)[0]
-            host_src = ip4_pkt.src
-            host_dst = ip4_pkt.dst
-        if len(pkt.get_protocols(arp.arp))>0:
-            arp_pkt = pkt.get_protocols(arp.arp)[0]
-            ip_src = arp_pkt.src_ip
-            ip_dst = arp_pkt.dst_ip
-            self._find_route(datapath, ip_src, ip_dst, msg)
-        if outport>0:
-            data = None
-            if msg.buffer_id == ofproto.OFP_NO_BUFFER:
-                data = msg.data
-            actions = [parser.OFPActionOutput(outport)]
-            out = parser.OFPPacketOut(datapath=datapath, in_port=in_port, actions=actions, data=data, buffer_id=msg.buffer_id)
-            datapath.send_msg(out)
\ No newline at end of file
+        time2 = time.time()
+        dpid = msg.datapath.id
+        if not self.owns(dpid):
+            # Switch kept this worker in equal role (rejected role request), its master handle it
+            return
+        if self.topology.linked() and self.topology.learn_host(ip_src, dpid, msg.match['in_port']) and self.proactive:
+            self.install_host_routes(ip_src)
+        self._find_route(msg.datapath, ethertype, ip_src, ip_dst, msg)
+        time3 = time.time()
+        self.metrics.count_packet_in(dpid, self.lb_method, time3)
+        self.metrics.observe('parse', dpid, self.lb_method, time2-time1)
+        self.metrics.observe('find_route', dpid, self.lb_method, time3-time2)
+        self.metrics.observe('packet_in', dpid, self.lb_method, time3-time1)
@@ -0,0 +1,295 @@
+from __future__ import division
+
+import unittest, json, threading, time
+
+import numpy as np
+from scipy import stats as sc_stats
+
+import main
+from main import MainMachineLearning, FlowTable, TelemetrySampler, TopologyHelper, RoutePlan, OnlineOptimizer, JobManager, water_fill
+from bench_ml import build_flows
+
+'''
+Unit tests of the optimizer and flow table, no Ryu or Mininet needed.
+usage: python -m unittest discover -p 'test_*.py' (from controller directory)
+'''
+
+def train_per_episode(ml, episodes, epsilon, seed):
+   """
+   Reference epsilon greedy loop, one episode at a time with python loops
+   over flows, as the trainer was before batching. Every flow take one draw
+   per episode, like MainMachineLearning.sample_actions.
+   """
+   rng = np.random.RandomState(seed)
+   best_actions = None
+   best_reward = None
+   for i in range(episodes):
+      draws = rng.random_sample(ml.flows_num)
+      actions = []
+      for j in range(ml.flows_num):
+         if best_actions is None:
+            actions.append(min(int(draws[j]*ml.spines_num), ml.spines_num-1))
+         elif draws[j] < epsilon:
+            actions.append(min(int(draws[j]/epsilon*ml.spines_num), ml.spines_num-1))
+         else:
+            actions.append(best_actions[j])
+      gateways_load = np.zeros(ml.spines_num)
+      for j in range(ml.flows_num):
+         gateways_load[actions[j]] += ml.loads_arr[j]
+      mean = np.mean(gateways_load)
+      reward = (mean-sc_stats.sem(gateways_load))/mean
+      if best_actions is None or reward > best_reward:
+         best_actions = actions
+         best_reward = reward
+   return np.array(best_actions), best_reward
+
+class TrainTest(unittest.TestCase):
+   def test_batch_size_one_is_per_episode_path(self):
+      ml = MainMachineLearning(range(101, 105), build_flows(200, 4, 'lognormal', 1))
+      route_plan, _, reward, _, _ = ml.train(50, 0.15, batch_size=1, seed=3)
+      actions, ref_reward = train_per_episode(ml, 50, 0.15, 3)
+      np.testing.assert_array_equal(route_plan.gateway-1, actions)
+      self.assertAlmostEqual(reward, ref_reward)
+
+   def test_chunks_dont_change_result(self):
+      # One row per chunk against the whole default batch at once
+      flows = build_flows(300, 4, 'lognormal', 1)
+      start = np.array([int(flow[2])-1 for flow in flows])
+      free = np.arange(len(flows)) % 3 != 0
+      for init_actions, free_mask in ((None, None), (start, free)):
+         results = []
+         for chunk_cells in (len(flows), 10**6):
+            ml = MainMachineLearning(range(101, 105), flows)
+            ml.CHUNK_CELLS = chunk_cells
+            results.append(ml.train(500, 0.15, seed=3, init_actions=init_actions, free=free_mask))
+         np.testing.assert_array_equal(results[0][0].gateway, results[1][0].gateway)
+         self.assertEqual(results[0][2], results[1][2])
+
+   def test_default_batch_improve_feasible_plan(self):
+      flows = build_flows(300, 4, 'lognormal', 2)
+      ml = MainMachineLearning(range(101, 105), flows)
+      start = np.array([int(flow[2])-1 for flow in flows])
+      free = np.arange(len(flows)) % 4 != 0
+      route_plan, _, reward, _, _ = ml.train(2000, 0.15, seed=5, init_actions=start, free=free)
+      actions = route_plan.gateway-1
+      self.assertTrue(np.all((actions >= 0) & (actions < 4)))
+      np.testing.assert_array_equal(actions[~free], start[~free])
+      self.assertAlmostEqual(ml.getReward(actions)[1], reward)
+      self.assertGreater(reward, ml.getReward(start)[1])
+      # Random restart of the same budget is not better
+      self.assertGreaterEqual(reward, ml.train(2000, 1.0, seed=5)[2])
+
+class FakeTopology(TopologyHelper):
+   """ TopologyHelper answering leaves samples from a list, no Ryu needed """
+   def __init__(self, samples):
+      TopologyHelper.__init__(self)
+      self.samples = samples
+
+   def get_switches(self):
+      pass
+
+   def get_leafes_sample(self):
+      return self.samples.pop(0)
+
+class SamplerTest(unittest.TestCase):
+   def test_new_flow_counted_from_zero(self):
+      topoh = FakeTopology([
+         {201: (10.0, [('10.0.1.1', '10.0.2.1', '1', 1000)])},
+         {201: (12.0, [('10.0.1.1', '10.0.2.1', '1', 3000), ('10.0.1.2', '10.0.2.1', '2', 500)])}
+      ])
+      sampler = TelemetrySampler(topoh)
+      sampler.sample()
+      sampler.sample()
+      ids = topoh.table.flow_ids([('10.0.1.1', '10.0.2.1'), ('10.0.1.2', '10.0.2.1')], 201)
+      np.testing.assert_allclose(sampler.rate[ids], [1000, 250])
+      alive = sampler.refresh('ewma')
+      self.assertEqual(sorted(alive), sorted(ids))
+
+class FakeResponse():
+   def __init__(self, data):
+      self.data = data
+
+   def json(self):
+      return self.data
+
+class FakeSession():
+   """ requests.Session answering GET of every url from a dict """
+   def __init__(self, replies):
+      self.replies = replies
+
+   def get(self, url):
+      return FakeResponse(self.replies[url])
+
+class FlowTableTest(unittest.TestCase):
+   def test_group_mode_ofctl_stats(self):
+      topoh = TopologyHelper()
+      topoh.UPLINKS = {201: {1: 1, 2: 2}}
+      topoh.session = FakeSession({main.ryu_api(201)+'/stats/flow/201': {'201': [
+         {'match': {'dl_type': 2048, 'nw_dst': '10.0.2.0/255.255.255.0'}, 'actions': ['GROUP:1'], 'byte_count': 1000},
+         {'match': {'dl_type': 2048, 'nw_src': '10.0.1.1', 'nw_dst': '10.0.3.1'}, 'actions': ['OUTPUT:2'], 'byte_count': 500},
+         {'match': {}, 'actions': ['OUTPUT:CONTROLLER'], 'byte_count': 0}
+      ]}})
+      flows = topoh.get_switch_stats(201)
+      self.assertEqual(flows, [('10.0.1.0', '10.0.2.0', '0', 1000), ('10.0.1.1', '10.0.3.1', '2', 500)])
+      ids = topoh.table.flow_ids(flows, 201)
+      self.assertEqual(list(ids), [0, 1])
+      self.assertEqual(main.int_to_ip(topoh.table.ip_dst[0]), '10.0.2.0')
+
+   def test_compact_remaps_state(self):
+      topoh = FakeTopology([
+         {201: (10.0, [('10.0.1.%s' % host, '10.0.2.1', '1', 1000*host) for host in range(1, 5)])},
+         {201: (12.0, [('10.0.1.4', '10.0.2.1', '1', 8000), ('10.0.1.5', '10.0.2.1', '2', 600)])}
+      ])
+      sampler = TelemetrySampler(topoh)
+      topoh.sampler = sampler
+      sampler.sample()
+      table = topoh.table
+      table.update(np.arange(4), [1000, 2000, 3000, 4000])
+      optimizer = OnlineOptimizer(move_cost=0.01)
+      optimizer.optimize([101, 102], table, 0.15, seed=1)
+      self.assertIsNone(table.compact(sampler.alive()))
+      sampler.sample()
+      sampler.refresh('last')
+      old = table.flow_ids([('10.0.1.4', '10.0.2.1'), ('10.0.1.5', '10.0.2.1')], 201)
+      old_action = optimizer.actions[old[0]]
+      self.assertTrue(old_action >= 0)
+      ids = topoh.compact_flows()
+      optimizer.remap(ids)
+      np.testing.assert_array_equal(ids, old)
+      self.assertEqual(table.size, 2)
+      self.assertEqual(list(table.flow_ids([('10.0.1.4', '10.0.2.1'), ('10.0.1.5', '10.0.2.1')], 201)), [0, 1])
+      self.assertEqual(sorted(table.ips), ['10.0.1.4', '10.0.1.5', '10.0.2.1'])
+      np.testing.assert_allclose(sampler.rate[:2], [2000, 300])
+      np.testing.assert_array_equal(optimizer.actions, [old_action, -1])
+      # Flow seen again get a new id
+      self.assertEqual(list(table.flow_ids([('10.0.1.1', '10.0.2.1')], 201)), [2])
+
+class GroupWeightsTest(unittest.TestCase):
+   def setUp(self):
+      self.topoh = TopologyHelper()
+      self.topoh.SPINE_SW = [101, 102, 103, 104]
+      self.posted = {}
+      def post_shards(path, bodies):
+         for body in bodies.values():
+            self.posted.update(body['weights'])
+         return [body for body in bodies.values()]
+      self.topoh.post_shards = post_shards
+
+   def test_water_fill(self):
+      np.testing.assert_allclose(water_fill(np.array([1., 3., 7.]), 4), [3, 1, 0])
+      np.testing.assert_allclose(water_fill(np.zeros(4), 8), [2, 2, 2, 2])
+
+   def test_leaf_aggregates_are_split(self):
+      # One select group aggregate per leaf, the plan pinned every leaf to one spine
+      table = FlowTable()
+      ids = np.concatenate([table.flow_ids([('10.0.%s.0' % leaf, '10.0.0.0', '0', 100)], 200+leaf) for leaf in range(1, 5)])
+      table.update(ids, [100]*4, [0]*4)
+      self.topoh.exec_group_weights(RoutePlan(table, ids, [3, 1, 4, 2], table.load[ids]))
+      self.assertEqual(self.posted, dict(('%s' % (200+leaf), [25]*4) for leaf in range(1, 5)))
+
+   def test_pinned_flows_and_floor(self):
+      table = FlowTable()
+      ids = table.flow_ids([('10.0.1.0', '10.0.0.0', '0', 0), ('10.0.2.1', '10.0.3.1', '1', 0)], 201)
+      table.update(ids, [300, 600], [0, 1])
+      self.topoh.exec_group_weights(RoutePlan(table, ids, [1, 1], table.load[ids]))
+      # Spine 101 already carries 600, the aggregate is split over the others
+      self.assertEqual(self.posted['201'], [1, 33, 33, 33])
+      self.topoh.exec_group_weights(RoutePlan(table, ids, [1, 1], table.load[ids]), min_weight=0)
+      self.assertEqual(self.posted['201'], [0, 33, 33, 33])
+
+class RoutePlanTest(unittest.TestCase):
+   def test_only_confirmed_flows_committed(self):
+      topoh = TopologyHelper()
+      table = FlowTable()
+      ids = np.concatenate([table.flow_ids([('10.0.%s.1' % leaf, '10.0.9.1', '1', 0)], 200+leaf) for leaf in range(1, 5)])
+      table.update(ids, [100]*4, [1]*4)
+      # 202 is unknown, 203 barrier timed out and 204 is not in the reply
+      switches = {
+         '201': {'flows': 1, 'send_time': 0.001, 'barrier_time': 0.002},
+         '202': {'flows': 1, 'error': 'unknown switch'},
+         '203': {'flows': 1, 'send_time': 0.001, 'barrier_time': None}
+      }
+      topoh.post_shards = lambda path, bodies: [{'flows': 4, 'switches': switches, 'time': 0.01}]
+      self.assertEqual(topoh.exec_route_plan(RoutePlan(table, ids, [2]*4, table.load[ids])), 1)
+      self.assertEqual(list(table.gateway[ids]), [2, 1, 1, 1])
+      self.assertEqual(topoh.RECONFIG['failed'], 3)
+
+class OptimizerTest(unittest.TestCase):
+   def test_settings_of_one_run(self):
+      table = FlowTable()
+      ids = table.flow_ids([('10.0.1.%s' % host, '10.0.2.1', '1', 0) for host in range(1, 9)], 201)
+      table.update(ids, np.arange(1, 9)*1000.)
+      optimizer = OnlineOptimizer()
+      optimizer.optimize([101, 102], table, 0.15, seed=1, solver='local',
+                         settings={'objective': 'maxutil', 'move_cost': 0.5, 'episodes': 10, 'threshold': None})
+      self.assertEqual((optimizer.objective, optimizer.move_cost, optimizer.episodes, optimizer.threshold), ('sem', 0, 1000, 0.1))
+
+class JobManagerTest(unittest.TestCase):
+   def wait_state(self, job, state):
+      for _ in range(200):
+         if job.state == state:
+            return
+         time.sleep(0.01)
+      self.fail('job %s is %s' % (job.id, job.state))
+
+   def test_unfinished_jobs_kept_cancelled_not_run(self):
+      release = threading.Event()
+      ran = []
+      def run(job):
+         ran.append(job.id)
+         release.wait()
+         return {}
+      manager = JobManager(run, keep=2)
+      first = manager.submit({})
+      self.wait_state(first, 'running')
+      second, third = manager.submit({}), manager.submit({})
+      # Nothing finished, nothing dropped
+      self.assertEqual(list(manager.jobs), [first.id, second.id, third.id])
+      manager.cancel(second.id)
+      fourth = manager.submit({})
+      self.assertEqual(list(manager.jobs), [first.id, third.id, fourth.id])
+      release.set()
+      self.assertTrue(fourth.done_event.wait(2))
+      self.assertEqual(ran, [first.id, third.id, fourth.id])
+      self.assertEqual(second.state, 'cancelled')
+
+class FlaskTest(unittest.TestCase):
+   def test_unknown_rate_rejected(self):
+      client = main.app.test_client()
+      self.assertEqual(client.get('/stats?rate=avg').status_code, 400)
+      self.assertEqual(client.get('/optimize?rate=avg').status_code, 400)
+
+   def test_stats_args_apply_to_request(self):
+      client = main.app.test_client()
+      topoh = main.topoh
+      calls = []
+      topoh.get_stats = lambda *args: calls.append(args) or {'sem': 0, 'total': 0}
+      try:
+         self.assertEqual(client.get('/stats?rate=last&measure=ports').status_code, 200)
+         self.assertEqual(calls, [('last', 'ports', 'ofctl')])
+         self.assertEqual((topoh.rate_mode, topoh.measure, topoh.source), ('ewma', 'flows', 'ofctl'))
+         self.assertEqual(client.get('/stats?source=native').status_code, 400)
+         self.assertEqual(client.post('/stats', data=json.dumps({'rate': 'avg'})).status_code, 400)
+         self.assertEqual(client.post('/stats', data=json.dumps({'interval': 1})).status_code, 400)
+         reply = client.post('/stats', data=json.dumps({'rate': 'window'}))
+         self.assertEqual(reply.get_json(), {'rate': 'window', 'measure': 'flows', 'source': 'ofctl'})
+         client.get('/stats')
+         self.assertEqual(calls[-1], ('window', 'flows', 'ofctl'))
+      finally:
+         del topoh.get_stats
+         topoh.rate_mode = 'ewma'
+
+   def test_rebalance_config_validated(self):
+      client = main.app.test_client()
+      status = client.get('/rebalance').get_json()
+      for config in ({'interval': 0}, {'interval': -1}, {'high': 'x'}, {'enabled': 1}, {'params': ['local']},
+                     {'params': {'solver': 'nope'}}, {'params': {'rate': 'avg'}}, ['enabled']):
+         self.assertEqual(client.post('/rebalance', data=json.dumps(config)).status_code, 400, config)
+      self.assertEqual(client.get('/rebalance').get_json(), status)
+      reply = client.post('/rebalance', data=json.dumps({'interval': 5, 'params': {'solver': 'greedy'}}))
+      self.assertEqual(reply.status_code, 200)
+      self.assertEqual(reply.get_json()['interval'], 5)
+      main.scheduler.configure({'interval': status['interval'], 'params': status['params']})
+
+if __name__ == '__main__':
+   unittest.main()
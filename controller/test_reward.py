@@ -0,0 +1,89 @@
+from __future__ import division
+
+import unittest
+
+import numpy as np
+
+from reward import RewardEngine, OBJECTIVES
+from main import MainMachineLearning
+from bench_ml import build_flows
+
+'''
+Incremental reward of RewardEngine against full recompute, for every objective.
+usage: python -m unittest discover -p 'test_*.py' (from controller directory)
+'''
+
+class RewardEngineTest(unittest.TestCase):
+   def engine(self, objective, seed):
+      rng = np.random.RandomState(seed)
+      flows_num, spines_num = 40, 5
+      loads = rng.lognormal(10, 1.5, flows_num)
+      capacity = rng.uniform(0.5, 2, spines_num)*np.sum(loads)/spines_num
+      current = rng.randint(-1, spines_num, flows_num)
+      engine = RewardEngine(loads, spines_num, objective, capacity, 0.001, current)
+      actions = rng.randint(spines_num, size=flows_num)
+      engine.reset(actions)
+      return engine, actions, rng
+
+   def full_reward(self, engine, actions):
+      return engine.batch(actions.reshape(1, -1))[1][0]
+
+   def assert_sums(self, engine, actions):
+      """ Running sums after moves equal the ones rebuilt from actions """
+      fresh = RewardEngine(engine.loads, engine.spines_num, engine.objective, engine.capacity, engine.move_cost, engine.current)
+      fresh.reset(actions)
+      np.testing.assert_allclose(engine.gw_loads, fresh.gw_loads)
+      self.assertAlmostEqual(engine.ssd/fresh.ssd, 1)
+      self.assertAlmostEqual(engine.wssd/fresh.wssd, 1)
+      self.assertEqual(engine.moved, fresh.moved)
+      self.assertAlmostEqual(engine.reward(), fresh.reward())
+
+   def test_delta_move(self):
+      for objective in OBJECTIVES:
+         engine, actions, rng = self.engine(objective, 1)
+         for _ in range(50):
+            i, gw = rng.randint(len(actions)), rng.randint(engine.spines_num)
+            moved = actions.copy()
+            moved[i] = gw
+            delta = engine.delta_move(actions, i, gw)
+            self.assertAlmostEqual(delta, self.full_reward(engine, moved)-self.full_reward(engine, actions), msg=objective)
+            engine.apply_move(actions, i, gw)
+            np.testing.assert_array_equal(actions, moved)
+         self.assert_sums(engine, actions)
+
+   def test_delta_swap(self):
+      for objective in OBJECTIVES:
+         engine, actions, rng = self.engine(objective, 2)
+         for _ in range(50):
+            i, j = rng.randint(len(actions), size=2)
+            swapped = actions.copy()
+            swapped[i], swapped[j] = actions[j], actions[i]
+            delta = engine.delta_swap(actions, i, j)
+            self.assertAlmostEqual(delta, self.full_reward(engine, swapped)-self.full_reward(engine, actions), msg=objective)
+            engine.apply_swap(actions, i, j)
+            np.testing.assert_array_equal(actions, swapped)
+         self.assert_sums(engine, actions)
+
+   def test_transfer_gain_to_many(self):
+      # Candidates to several gateways at once, as local_search check them
+      for objective in OBJECTIVES:
+         engine, actions, rng = self.engine(objective, 4)
+         gws_to = np.array([1, 2, 3, 4, 2, 4])
+         xs = rng.uniform(-1, 1, len(gws_to))*engine.loads.mean()
+         moved = rng.randint(-1, 2, len(gws_to))
+         gains = engine.transfer_gain(0, gws_to, xs, moved)
+         for k in range(len(gws_to)):
+            self.assertAlmostEqual(gains[k], engine.transfer_gain(0, gws_to[k], xs[k:k+1], moved[k:k+1])[0], msg=objective)
+
+   def test_local_search_sums(self):
+      for objective in OBJECTIVES:
+         flows = build_flows(300, 6, 'lognormal', 3)
+         ml = MainMachineLearning(range(101, 107), flows, move_cost=0.0001, objective=objective, capacity=[1e6, 2e6, 1e6, 2e6, 1e6, 2e6])
+         start = np.array([int(flow[2])-1 for flow in flows])
+         start_reward = ml.getReward(start)[1]
+         route_plan, _, reward, _, _ = ml.train_local(1000, 0, init_actions=start)
+         self.assertGreater(reward, start_reward, msg=objective)
+         self.assert_sums(ml.engine, route_plan.gateway-1)
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,206 @@
+from __future__ import division
+
+import unittest, os, tempfile
+
+from ryu.controller import ofp_event
+from ryu.ofproto import ofproto_v1_3_parser
+from ryu.lib.packet import packet, ethernet, ipv4, udp
+from ryu.lib.packet import ether_types
+from ryu.lib import hub
+
+from ryu_lb import HOST_COOKIE, ip_to_int
+from bench_lb import build_fabric, quiet
+
+'''
+Unit tests of Ryu_LB on the fake fabric of bench_lb, no Mininet/OVS needed.
+usage: python -m unittest discover -p 'test_*.py' (from controller directory)
+'''
+
+def packet_in(datapath, in_port, ip_src, ip_dst):
+   pkt = packet.Packet()
+   pkt.add_protocol(ethernet.ethernet(ethertype=ether_types.ETH_TYPE_IP))
+   pkt.add_protocol(ipv4.ipv4(src=ip_src, dst=ip_dst, proto=17))
+   pkt.add_protocol(udp.udp(src_port=5001, dst_port=5001))
+   pkt.serialize()
+   parser = ofproto_v1_3_parser
+   msg = parser.OFPPacketIn(datapath, buffer_id=datapath.ofproto.OFP_NO_BUFFER,
+                            match=parser.OFPMatch(in_port=in_port), data=str(pkt.data))
+   return ofp_event.EventOFPPacketIn(msg)
+
+def packet_outs(datapaths):
+   """ { dpid : [out ports of every packet-out] }, sent messages are cleared """
+   outs = {}
+   for dpid, datapath in datapaths.items():
+      for msg in datapath.sent:
+         if isinstance(msg, ofproto_v1_3_parser.OFPPacketOut):
+            outs.setdefault(dpid, []).append([action.port for action in msg.actions])
+      del datapath.sent[:]
+   return outs
+
+def run_green():
+   """ Let green threads spawned by Ryu_LB run, their store calls go through a native thread """
+   for _ in range(10):
+      hub.sleep(0.01)
+
+def link_fabric(app, spine_num, leaf_num):
+   for x in range(1, spine_num+1):
+      for leaf in range(0, leaf_num+1):
+         app.topology.add_link(100+x, leaf+1, 200+leaf)
+         app.topology.add_link(200+leaf, x, 100+x)
+
+class TopologyTest(unittest.TestCase):
+   def test_partial_discovery_keep_addressing(self):
+      app, datapaths = build_fabric('rr', 4, 4, 2)
+      app.topology.add_link(101, 2, 201)
+      app.topology.add_link(201, 1, 101)
+      with quiet():
+         app._apply_topology()
+         app._apply_topology()
+      self.assertEqual(app.topology_status()['source'], 'addressing')
+      packet_outs(datapaths)
+      app._packet_in_handler(packet_in(datapaths[201], 5, '10.0.1.1', '10.0.3.1'))
+      # Routed by the addressing scheme to one uplink, nothing is flooded
+      self.assertEqual(packet_outs(datapaths), {201: [[1]]})
+
+   def test_settled_model_flush_rules_and_flood_host_ports(self):
+      app, datapaths = build_fabric('rr', 4, 4, 2)
+      app._packet_in_handler(packet_in(datapaths[201], 5, '10.0.1.1', '10.0.2.1'))
+      self.assertEqual(app.rule_table.count(201), 2)
+      link_fabric(app, 4, 4)
+      with quiet():
+         app._apply_topology()
+         self.assertEqual(app.topology_status()['source'], 'addressing')
+         app._apply_topology()
+      self.assertEqual(app.topology_status()['source'], 'lldp')
+      self.assertEqual(app.rule_table.count(201), 0)
+      deleted = [msg.cookie for msg in datapaths[201].sent
+                 if isinstance(msg, ofproto_v1_3_parser.OFPFlowMod) and msg.command == datapaths[201].ofproto.OFPFC_DELETE]
+      self.assertIn(HOST_COOKIE, deleted)
+      packet_outs(datapaths)
+      app._packet_in_handler(packet_in(datapaths[201], 5, '10.0.1.1', '10.9.9.9'))
+      outs = packet_outs(datapaths)
+      self.assertEqual(sorted(outs), [200, 201, 202, 203, 204])
+      self.assertEqual(outs[201], [[6]])
+      for dpid in (202, 203, 204):
+         self.assertEqual(outs[dpid], [[5, 6]])
+
+class LoadTest(unittest.TestCase):
+   def test_load_aware_methods_poll_spines(self):
+      app, datapaths = build_fabric('rr', 2, 2, 2)
+      self.assertEqual(app.poll_interval(), 0)
+      for method in ('least', 'p2c'):
+         app.set_lb_method(method)
+         self.assertEqual(app.poll_interval(), app.load_interval)
+      for datapath in datapaths.values():
+         del datapath.sent[:]
+      app.request_stats()
+      for dpid in (101, 102):
+         self.assertTrue(any(isinstance(msg, ofproto_v1_3_parser.OFPPortStatsRequest) for msg in datapaths[dpid].sent))
+      app.stats_interval = 5
+      self.assertEqual(app.poll_interval(), 5)
+
+class RuleTableTest(unittest.TestCase):
+   def flow_stats_reply(self, app, datapath, counts):
+      """ Answer the pending flow stats request of datapath with host rules byte counts """
+      parser = ofproto_v1_3_parser
+      xid = max(xid for dpid, xid in app.stats.pending if dpid == datapath.id)
+      body = [parser.OFPFlowStats(table_id=0, duration_sec=0, duration_nsec=0, priority=1, idle_timeout=0,
+                                  hard_timeout=0, flags=0, cookie=HOST_COOKIE, packet_count=0, byte_count=count,
+                                  match=app.host_match(parser, key), instructions=[])
+              for key, count in counts.items()]
+      reply = parser.OFPFlowStatsReply(datapath, flags=0, body=body)
+      reply.xid = xid
+      app._flow_stats_reply_handler(ofp_event.EventOFPFlowStatsReply(reply))
+
+   def test_eviction_follow_flow_stats(self):
+      app, datapaths = build_fabric('rr', 2, 2, 4)
+      app.table_capacity = 6
+      datapath = datapaths[201]
+      for host in (1, 2, 3):
+         app._packet_in_handler(packet_in(datapath, 2+host, '10.0.1.%s' % host, '10.0.2.1'))
+      keys = list(app.rule_table.rules[201])
+      # Stats disabled, flow stats are still polled for the LRU order
+      del datapath.sent[:]
+      app.request_flow_stats([datapath])
+      self.assertEqual(len(datapath.sent), 1)
+      # Oldest pair forward bytes, the second one is evicted first
+      self.flow_stats_reply(app, datapath, dict((key, 1000 if key[1] == keys[0][1] else 0) for key in keys))
+      app._packet_in_handler(packet_in(datapath, 6, '10.0.1.4', '10.0.2.1'))
+      sources = set(key[1] for key in app.rule_table.rules[201])
+      self.assertEqual(sources, set(ip_to_int('10.0.1.%s' % host) for host in (1, 3, 4)))
+
+class ShardTest(unittest.TestCase):
+   def setUp(self):
+      self.store = tempfile.mktemp(suffix='.sqlite')
+      self.apps = []
+      for shard in (0, 1):
+         os.environ.update({ 'LB_SHARD': str(shard), 'LB_SHARDS': '2', 'LB_STORE': self.store })
+         with quiet():
+            self.apps.append(build_fabric('rr', 2, 3, 2))
+         # Exchanges are driven by the tests
+         hub.kill(self.apps[-1][0].sync_thread)
+      # Role requests are sent by green threads
+      run_green()
+
+   def tearDown(self):
+      for key in ('LB_SHARD', 'LB_SHARDS', 'LB_STORE'):
+         os.environ.pop(key, None)
+      if os.path.exists(self.store):
+         os.remove(self.store)
+
+   def role_requests(self, datapath):
+      return [msg for msg in datapath.sent if isinstance(msg, ofproto_v1_3_parser.OFPRoleRequest)]
+
+   def test_packet_in_of_other_shard_dropped(self):
+      app, datapaths = self.apps[0]
+      packet_outs(datapaths)
+      app._packet_in_handler(packet_in(datapaths[201], 3, '10.0.1.1', '10.0.2.1'))
+      self.assertEqual(packet_outs(datapaths), {})
+      self.assertEqual(app.rule_table.count(201), 0)
+
+   def test_stale_role_request_retried(self):
+      app, datapaths = self.apps[0]
+      datapath = datapaths[201]
+      first = self.role_requests(datapath)
+      self.assertEqual([msg.role for msg in first], [datapath.ofproto.OFPCR_ROLE_SLAVE])
+      parser = ofproto_v1_3_parser
+      error = parser.OFPErrorMsg(datapath, datapath.ofproto.OFPET_ROLE_REQUEST_FAILED, datapath.ofproto.OFPRRFC_STALE)
+      app._error_msg_handler(ofp_event.EventOFPErrorMsg(error))
+      run_green()
+      retried = self.role_requests(datapath)[len(first):]
+      self.assertEqual([msg.role for msg in retried], [datapath.ofproto.OFPCR_ROLE_SLAVE])
+      self.assertGreater(retried[0].generation_id, first[0].generation_id)
+      # Reply with an other role is retried too, until retries are spent
+      for _ in range(app.role_retries+1):
+         reply = parser.OFPRoleReply(datapath, datapath.ofproto.OFPCR_ROLE_EQUAL, 0)
+         app._role_reply_handler(ofp_event.EventOFPRoleReply(reply))
+         run_green()
+      self.assertEqual(len(self.role_requests(datapath)), 1+app.role_retries)
+
+   def test_flood_relayed_through_store(self):
+      for app, datapaths in self.apps:
+         # A link is found by the master of its peer
+         for x in (1, 2):
+            for leaf in range(0, 4):
+               for dpid, port, peer in ((100+x, leaf+1, 200+leaf), (200+leaf, x, 100+x)):
+                  if app.owns(peer):
+                     app.topology.add_link(dpid, port, peer)
+      for _ in range(2):
+         for app, datapaths in self.apps:
+            app.sync_store()
+            with quiet():
+               app._apply_topology()
+      (app0, datapaths0), (app1, datapaths1) = self.apps
+      self.assertEqual(app1.topology_status()['source'], 'lldp')
+      packet_outs(datapaths0)
+      packet_outs(datapaths1)
+      app1._packet_in_handler(packet_in(datapaths1[201], 3, '10.0.1.1', '10.9.9.9'))
+      self.assertEqual(packet_outs(datapaths1), {201: [[4]], 203: [[3, 4]]})
+      self.assertEqual(len(app1.relay_queue), 2)
+      app1.sync_store()
+      app0.sync_store()
+      self.assertEqual(app1.relay_queue, [])
+      self.assertEqual(packet_outs(datapaths0), {200: [[3, 4]], 202: [[3, 4]]})
+
+if __name__ == '__main__':
+   unittest.main()
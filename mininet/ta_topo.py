@@ -9,7 +9,7 @@ from mininet.link import Intf, TCLink
 from mininet.log import setLogLevel, info
 from mininet.util import quietRun, run
 
-import time, json, sys, subprocess, sys, pprint, datetime, csv
+import time, json, sys, os, subprocess, sys, pprint, datetime, csv
 from random import randint
 import requests
 import pandas as pd
@@ -20,7 +20,8 @@ src: https://www.cisco.com/c/dam/en/us/products/collateral/switches/nexus-7000-s
 '''
 CONTROLLER_IP = '10.148.0.2'
 CONTROLLER_ML_REST = 'http://'+CONTROLLER_IP+':5000/' # Default flask port (used as ML-LB API) is 5000 for development
-CONTROLLER_RYU_REST = 'http://'+CONTROLLER_IP+':8080/' # Default ryu wsgi port is 8080
+CONTROLLER_SHARDS = int(os.environ.get('LB_SHARDS', 1)) # Ryu_LB workers (LB_SHARDS env, as controller/main.py), worker i listen on 6653+i and 8080+i
+CONTROLLER_RYU_RESTS = ['http://%s:%s/' % (CONTROLLER_IP, 8080+i) for i in range(CONTROLLER_SHARDS)]
 
 SCENARIO = {
 "2": {        #h1  h2  h3  h4
@@ -56,7 +57,14 @@ SCENARIO = {
 }}
 
 class LeafSpine( Topo ):
-   def __init__( self, spine_num, leaf_num, host_per_leaf ):
+   """
+   server_leaves : 1 put svr1 and svr2 behind l2_sw, 2 give svr2 its own
+                   switch (dpid 200+leaf_num+1), so server traffic is
+                   balanced across the uplinks of two server leaves. svr2
+                   address don't follow the addressing scheme, Ryu_LB learns
+                   it through the LLDP topology model (--observe-links).
+   """
+   def __init__( self, spine_num, leaf_num, host_per_leaf, server_leaves=1 ):
       # Initialize topology
       Topo.__init__( self )
       of_ver = "OpenFlow13"
@@ -66,11 +74,17 @@ class LeafSpine( Topo ):
       leaf_sw = []
       # Creating L2 Switch
       l2_sw = self.addSwitch( name = "l2_sw", dpid = "%x" % (200), protocols = of_ver )
+      svr_sw = [l2_sw]
+      if server_leaves == 2:
+         svr_sw.append(self.addSwitch( name = "l2_sw2", dpid = "%x" % (200 + leaf_num + 1), protocols = of_ver ))
       # Creating SVR Hosts & linking to L2 Switch
       for x in xrange(1, 3):
          hname = "svr%s" % (x)
          svr = self.addHost( hname, ip = '10.0.0.%s' % (x) )
-         self.addLink( l2_sw, svr, port1 = spine_num + x, delay = '1ms', use_htb = True)
+         if len(svr_sw) == 1:
+            self.addLink( l2_sw, svr, port1 = spine_num + x, delay = '1ms', use_htb = True)
+         else:
+            self.addLink( svr_sw[x-1], svr, port1 = spine_num + 1, delay = '1ms', use_htb = True)
       # Creating Spine Switch
       for x in xrange(1, spine_num+1):
          spine_sw.append(self.addSwitch( name = "sp_sw%s" % (x), dpid = "%x" % (100 + x), protocols = of_ver))
@@ -83,20 +97,28 @@ class LeafSpine( Topo ):
             hname = "lf%s_h%s" % (x, y)
             host = self.addHost(hname, ip='10.0.%s.%s' % (x, y))
             self.addLink( leaf, host, port1=spine_num+y, bw=100, delay='1ms', use_htb=True)
-      # Linking Spine Switch and L2 Switch/Leaf Switch
+      # Linking Spine Switch and L2 Switch/Leaf Switch, spine port of leaf 200+y is y+1
+      # as in the addressing scheme of Ryu_LB, l2_sw2 (200+leaf_num+1) comes after the leaves
       for x in xrange(0, spine_num):
-         self.addLink( spine_sw[x], l2_sw, port2=x+1, bw=100, delay='1ms', use_htb=True )
-         for y in xrange(0, leaf_num):
-            self.addLink( spine_sw[x], leaf_sw[y], port2=x+1, bw=100, delay='1ms', use_htb=True )
+         for sw in [svr_sw[0]] + leaf_sw + svr_sw[1:]:
+            self.addLink( spine_sw[x], sw, port2=x+1, bw=100, delay='1ms', use_htb=True )
 
 def send_req_lb(cmd):
    try:
-      resp = requests.get(CONTROLLER_LB_REST+cmd)
+      resp = requests.get(CONTROLLER_ML_REST+cmd)
       return resp.json()
    except Exception as e:
       print eval(e)
       return {}
 
+def wait_optimize(job, timeout=300):
+   """ /optimize only queue the job, poll /optimize/<id> until it is finished """
+   time1 = time.time()
+   while job.get('state') in ('queued', 'running') and time.time()-time1 < timeout:
+      time.sleep(0.5)
+      job = send_req_lb('optimize/'+str(job['id']))
+   return job
+
 def start_iperf_server(iperf_server, num_hosts):
    print '*** Starting Iperf Server *** '
    for i in range(num_hosts):
@@ -104,12 +126,13 @@ def start_iperf_server(iperf_server, num_hosts):
    print '(ok)'
    time.sleep(3)
 
-def start_iperf_client(hosts, loads):
+def start_iperf_client(hosts, loads, servers=1):
+   """ servers=2 alternate clients between svr1 and svr2 """
    print '*** Starting Iperf Client *** '
    i = 0
    for host in hosts:
       if 'lf' in host.name:
-         host.cmd('iperf3 -u -b %sM -p %s -t 200 -c 10.0.0.1 &' % (loads[i], 5001+i))
+         host.cmd('iperf3 -u -b %sM -p %s -t 200 -c 10.0.0.%s &' % (loads[i], 5001+i, i % servers + 1))
          i += 1
    print '(ok)'
    time.sleep(3)
@@ -127,7 +150,7 @@ def parsing_voip_data(gw_num, load_var, lb_mode):
    proc = subprocess.Popen(script, shell=True)
    proc.wait()
 
-def run_ta(gw_num, load_var, voip=False, sleep_time=10):
+def run_ta(gw_num, load_var, voip=False, sleep_time=10, server_leaves=1):
    """
    run_mode : - rr : testing round robin with ml optimization
               - iphash : testing round robin with ml optimization
@@ -136,22 +159,26 @@ def run_ta(gw_num, load_var, voip=False, sleep_time=10):
    spine_num = int(gw_num)
    leaf_num = spine_num
    num_lf_host = leaf_num*2
-   topo = LeafSpine(spine_num, leaf_num, 2)
+   topo = LeafSpine(spine_num, leaf_num, 2, server_leaves)
    net = Mininet(topo, controller=None, link=TCLink)
-   net.addController(RemoteController(name='c0', ip=CONTROLLER_IP))
+   # Every switch connect to all workers, each worker is master of its partition
+   for i in range(CONTROLLER_SHARDS):
+      net.addController(RemoteController(name='c%s' % (i), ip=CONTROLLER_IP, port=6653+i))
    net.start()
    net.pingAll()
    if voip:
       # CLI(net)
       start_voip_test(net.hosts)
    start_iperf_server(net.get('svr1'), num_lf_host)
-   start_iperf_client(net.hosts, SCENARIO[gw_num]['loads'][int(load_var)-1])
+   if server_leaves == 2:
+      start_iperf_server(net.get('svr2'), num_lf_host)
+   start_iperf_client(net.hosts, SCENARIO[gw_num]['loads'][int(load_var)-1], server_leaves)
    time.sleep(sleep_time)
    print '*** Get Network Stats *** '
    run_data['before'] = send_req_lb('stats')
    run_data['before']['lb_time'] = get_lb_time()
    print '*** Trigger LB Optimization *** '
-   run_data['prediction'] = send_req_lb('optimize')
+   run_data['prediction'] = wait_optimize(send_req_lb('optimize'))
    print '(ok)'
    time.sleep(sleep_time)
    print '*** Get Network Stats *** '
@@ -161,14 +188,19 @@ def run_ta(gw_num, load_var, voip=False, sleep_time=10):
    return run_data
 
 def settings_lb_mode(mode):
-   resp = requests.post(CONTROLLER_RYU_REST+'lb/mode', json={'mode': mode})
-   print resp.json()
+   for rest in CONTROLLER_RYU_RESTS:
+      resp = requests.post(rest+'lb/mode', json={'mode': mode})
+      print resp.json()
 
 def get_lb_time():
-   resp = requests.get(CONTROLLER_RYU_REST+'lb/time')
-   resp_dict = resp.json()
-   print 'lb_time', resp_dict
-   return resp_dict['time']
+   """ Sum of lb decision time of every worker """
+   lb_time = 0
+   for rest in CONTROLLER_RYU_RESTS:
+      resp = requests.get(rest+'lb/time')
+      resp_dict = resp.json()
+      print 'lb_time', resp_dict
+      lb_time += resp_dict['time']
+   return lb_time
 
 def run_scenario(config, lb_mode, iteration, voip):
    settings_lb_mode(lb_mode)